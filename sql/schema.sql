@@ -1,10 +1,8 @@
 -- schema
 -- DDL for redux programs and utilities
 
-/* enable write-ahead log (this is a persistent database setting) */
-PRAGMA journal_mode=WAL;
-/* 20MiB default cache size (persistent db setting) */
-PRAGMA default_cache_size=20000;
+/* journal mode, cache size and other PRAGMAs are set by the connection
+   profiles in db.py */
 
 
 /* a person who supplied DNA, or if needed, some other person */
@@ -138,6 +136,47 @@ create table vcfcalls(
 create index vcfidx on vcfcalls(vID);
 create index vcfpidx on vcfcalls(pID);
 
+/* zip files that were loaded for each data set; a kit is only re-loaded
+   when its zip file content or the parser changes, or when it can now be
+   lifted over to hg38 */
+drop table if exists loadmanifest;
+create table loadmanifest(
+    pID INTEGER REFERENCES dataset(ID),
+    zipNm TEXT,                -- path of the loaded zip file
+    size INTEGER,              -- size of the zip file in bytes
+    mtime REAL,                -- modification time of the zip file
+    md5 TEXT,                  -- md5 hash of the zip file contents
+    parserVer INTEGER,         -- KIT_PARSER_VERSION the kit was loaded with
+    loadDt TEXT,               -- when the kit was loaded
+    loadBuildID INTEGER,       -- build the kit's data was stored in (hg38 if lifted)
+    unique(pID)
+    );
+
+/* timed stages of profiled runs (redux.py --profile), see src/runstats.py */
+drop table if exists runstats;
+create table runstats(
+    runID INTEGER,             -- one per profiled run
+    stage TEXT,                -- name of the timed stage
+    parent TEXT,               -- stages it ran inside, separated by /
+    pID INTEGER,               -- the kit, for per-kit stages
+    startDt TEXT,              -- when the stage started (UTC)
+    wall REAL,                 -- elapsed seconds
+    cpu REAL,                  -- CPU seconds of the main process
+    maxrss INTEGER,            -- peak resident set size so far, in kB
+    nrows INTEGER,             -- rows processed, where the stage counts them
+    failed SMALLINT            -- 1 if the stage raised an exception
+    );
+
+/* per-kit numpy arrays, e.g. the calls when call_store is blob */
+drop table if exists kitarrays;
+create table kitarrays(
+    pID INTEGER REFERENCES dataset(ID),
+    name TEXT,                 -- which array, e.g. vid or callinfo
+    dtype TEXT,                -- numpy dtype string of the data
+    data BLOB,                 -- the raw array contents
+    primary key(pID, name)
+    );
+
 /* per-kit call statistics */
 drop table if exists vcfstats;
 create table vcfstats(
@@ -158,6 +197,19 @@ create table bedstats(
     nranges INTEGER
 );
 
+/* the closest kits of each kit (see matching.py) */
+drop table if exists matches;
+create table matches(
+    pID INTEGER REFERENCES dataset(ID),
+    rank INTEGER,              -- 1 for the closest match
+    matchID INTEGER REFERENCES dataset(ID),
+    nshared INTEGER,           -- variants both kits are positive for
+    ndiff INTEGER,             -- variants only one kit is positive for
+    covered INTEGER,           -- bases both kits cover (estimated)
+    distance REAL,             -- ndiff per million covered bases
+    PRIMARY KEY(pID, rank)
+    );
+
 /* per-kit calls that are classified REJECTs */
 drop table if exists vcfrej;
 create table vcfrej(
@@ -220,6 +272,9 @@ create table snpnames(
     -- unique(snpname,vID)
     );
 
+create index snpidx on snpnames(snpname);
+create index snpvidx on snpnames(vID);
+
 /* build (reference genome assembly) associated with data sets */
 drop table if exists build;
 create table build(
@@ -235,8 +290,34 @@ create table agebed(
     bID INTEGER REFERENCES bedranges(ID)
     );
 
-/* tree data structure - this probably still needs work */
-/* fixme? store trees using some commonly used tree standard? */
+/* rules from implications.txt (see implications.py): kind '>' means a kit
+   positive for ifpos1 (and ifpos2, if not null) is positive for pos; kinds
+   '^' and '<' are variants to insert and reference positives at pos */
+drop table if exists implications;
+create table implications(
+    ID INTEGER PRIMARY KEY,
+    kind CHARACTER(1),
+    buildID INTEGER REFERENCES build(ID),
+    pos INTEGER,
+    ifpos1 INTEGER,
+    ifpos2 INTEGER,
+    anc TEXT,
+    der TEXT,
+    names TEXT
+    );
+
+create index implidx on implications(kind, buildID, pos);
+
+/* the tree clade that each kit is placed in */
+drop table if exists treekits;
+create table treekits(
+    pID INTEGER REFERENCES dataset(ID),
+    cladeID INTEGER REFERENCES tree(id),
+    unique(pID)
+    );
+
+/* tree data structure - BLOBs are encoded as in src/treeio.py, which also */
+/* exports the tree as Newick or PhyloXML */
 drop table if exists tree;
 CREATE TABLE tree(
     id INTEGER PRIMARY KEY,
@@ -273,4 +354,5 @@ CREATE TABLE tree(
     combage SMALLINT,
     combagelo SMALLINT,
     combagehi SMALLINT,
-    combagepdf BLOB);
+    combagepdf BLOB,
+    dirty SMALLINT DEFAULT 1); /* coverage and ages need recomputing */
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# SNP ages of the clades of the stored tree
+#
+# This is the age stage of versions/redux_1-0-1/redux.bash, with the PDFs of
+# all clades held as one array over the time grid 0, age_step, ... age_max
+# years:
+#  - the likelihood of a kit with S singletons (age-countable SNPs that no
+#    other kit has) and age coverage c is Poisson(S; t*c*rate/1e9), scaled
+#    so that its maximum is 1; it is evaluated in log space for all kits
+#    at once, instead of interpolating poisson.tbl
+#  - bottom-up, level by level: a clade's PDF is the product of the
+#    likelihoods of its kits that are in no subclade, and, for each
+#    subclade, of the subclade's PDF convolved with the likelihood of the
+#    subclade's own SNPs at the subclade's average coverage
+#  - top-down: each clade's PDF is multiplied by its parent's PDF
+#    correlated with that same likelihood, so that subclades form after
+#    their parents
+#  - the age is the median of the PDF, and the bounds of the age_ci
+#    interval are scaled by rate/age_rate_hi and rate/age_rate_lo
+# The convolutions of a level are done for all of its clades at once by FFT.
+# raw_ages is the simpler estimate that redux.bash computes first
+# (raw-ages-err.txt), from SNP counts and the cpoisson table.
+# Age-countable SNPs are SNPs (single-base alleles) inside the age.bed ranges
+# (agebed table), as in redux.bash; kits without age coverage are left out.
+
+import numpy as np
+from reduxconfig import config
+from runstats import timed
+
+
+# the time grid of the PDFs, in years
+def age_grid(maxage=None, step=None):
+    if maxage is None:
+        maxage = config['age_max']
+    if step is None:
+        step = config['age_step']
+    return np.arange(0, maxage + step/2, step, dtype=np.float64)
+
+# log-likelihood over the time grid t of observing nsnps SNPs in coverage
+# bases, one row per element of nsnps and coverage; the maximum of a row is 0
+# (at t = nsnps*1e9/rate/coverage)
+def snp_loglik(nsnps, coverage, t, rate):
+    nsnps = np.asarray(nsnps, dtype=np.float64)[:, None]
+    lam = np.asarray(coverage, dtype=np.float64)[:, None] * t[None, :] * (rate / 1e9)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loglik = nsnps*np.log(lam) - lam
+        peak = np.where(nsnps > 0, nsnps*np.log(nsnps) - nsnps, 0)
+    return np.where(nsnps > 0, loglik - peak, -lam)
+
+# normalize PDFs given as log values, one per row
+def _normalize_log(logpdf):
+    top = logpdf.max(axis=1, keepdims=True)
+    pdf = np.exp(logpdf - np.where(np.isfinite(top), top, 0))
+    return _normalize(pdf)
+
+def _normalize(pdf):
+    total = pdf.sum(axis=1, keepdims=True)
+    return pdf / np.where(total > 0, total, 1)
+
+# row-wise convolution a*b (corr=False) or correlation sum_s a[t+s] b[s]
+# (corr=True), truncated to the grid
+def _fftconv(a, b, corr=False):
+    nt = a.shape[1]
+    fa = np.fft.rfft(a, 2*nt, axis=1)
+    fb = np.fft.rfft(b, 2*nt, axis=1)
+    out = np.fft.irfft(fa * (np.conj(fb) if corr else fb), 2*nt, axis=1)[:, :nt]
+    # rounding leaves tiny negative values
+    return np.maximum(out, 0)
+
+# the value of each row of pdf at which the cumulative probability passes p,
+# interpolated linearly within a grid step as redux.bash does
+def _quantile(pdf, t, p):
+    cum = np.cumsum(pdf, axis=1)
+    idx = np.argmax(cum > p, axis=1)
+    rows = np.arange(len(pdf))
+    last = np.where(idx > 0, cum[rows, np.maximum(idx-1, 0)], 0)
+    step = t[1] - t[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(cum[rows, idx] > last, (p - last) / (cum[rows, idx] - last), 0)
+    return frac*step + t[idx] - step
+
+# ages of the clades of a tree
+# parent: parent index of each clade, -1 for the root
+# kitclade, singles, kitcov: clade index, number of singletons and age
+#     coverage of each kit
+# nsnps: number of age-countable SNPs of each clade
+# returns the PDFs (nclades x len(t)) and the lower, median and upper ages
+def clade_ages(parent, kitclade, singles, kitcov, nsnps, t=None,
+               rate=None, ratelo=None, ratehi=None, ci=None):
+    if t is None:
+        t = age_grid()
+    if rate is None:
+        rate = config['age_rate']
+    if ratelo is None:
+        ratelo = config['age_rate_lo']
+    if ratehi is None:
+        ratehi = config['age_rate_hi']
+    if ci is None:
+        ci = config['age_ci']
+    parent = np.asarray(parent, dtype=np.int64)
+    kitclade = np.asarray(kitclade, dtype=np.int64)
+    kitcov = np.asarray(kitcov, dtype=np.float64)
+    nclades, nt = len(parent), len(t)
+    depth = _depths(parent)
+
+    # kits without age coverage are left out
+    use = kitcov > 0
+    kitclade, singles, kitcov = kitclade[use], np.asarray(singles)[use], kitcov[use]
+    # average coverage of the kits in each clade's subtree
+    covsum = _subtree_sums(parent, depth, np.bincount(kitclade, kitcov, minlength=nclades))
+    covnum = _subtree_sums(parent, depth, np.bincount(kitclade, minlength=nclades))
+    avgcov = covsum / np.maximum(covnum, 1)
+    # likelihood of each clade's own SNPs, the time from its parent's
+    # formation to its own
+    branch = np.exp(snp_loglik(nsnps, avgcov, t, rate))
+
+    # bottom-up
+    logpdf = np.zeros((nclades, nt))
+    for start in range(0, len(kitclade), 1024):
+        np.add.at(logpdf, kitclade[start:start+1024],
+                  snp_loglik(singles[start:start+1024], kitcov[start:start+1024], t, rate))
+    pdf = np.zeros((nclades, nt))
+    for d in range(depth.max(), -1, -1):
+        level = np.flatnonzero(depth == d)
+        pdf[level] = _normalize_log(logpdf[level])
+        if d:
+            sub = _fftconv(pdf[level], branch[level])
+            with np.errstate(divide='ignore'):
+                np.add.at(logpdf, parent[level], np.log(sub))
+
+    # top-down
+    for d in range(1, depth.max() + 1):
+        level = np.flatnonzero(depth == d)
+        pdf[level] = _normalize(pdf[level] * _fftconv(pdf[parent[level]], branch[level], corr=True))
+
+    p0 = (1 - ci) / 2
+    lo = _quantile(pdf, t, p0) * rate / ratehi
+    mid = _quantile(pdf, t, .5)
+    hi = _quantile(pdf, t, 1 - p0) * rate / ratelo
+    return pdf, lo, mid, hi
+
+# the simple age estimate of each clade: the number of age-countable SNPs
+# below the clade per kit, divided by the rate and the average coverage, with
+# the Poisson interval of sigma standard deviations from a cpoisson table
+# (see poissontables.py); 0.67 SNPs stand in for a count of zero
+# nsnps is the total number of SNPs below each clade over its nkits kits
+# returns the lower, central and upper ages
+def raw_ages(table, nsnps, nkits, avgcov, rate=None, ratelo=None, ratehi=None, sigma=1.96):
+    from poissontables import poisson_interval
+    if rate is None:
+        rate = config['age_rate']
+    if ratelo is None:
+        ratelo = config['age_rate_lo']
+    if ratehi is None:
+        ratehi = config['age_rate_hi']
+    nsnps = np.asarray(nsnps, dtype=np.float64)
+    scale = 1e9 / np.maximum(nkits, 1) / np.maximum(avgcov, 1)
+    lo, hi = poisson_interval(table, nsnps, sigma)
+    return (lo * scale / ratehi, np.where(nsnps > 0, nsnps, .67) * scale / rate,
+            hi * scale / ratelo)
+
+# sums over the subtree of each clade of values given per clade
+def _subtree_sums(parent, depth, values):
+    sums = np.array(values, dtype=np.float64)
+    for d in range(depth.max(initial=0), 0, -1):
+        level = np.flatnonzero(depth == d)
+        np.add.at(sums, parent[level], sums[level])
+    return sums
+
+# depth of each clade from the parent indexes; the root is at depth 0
+def _depths(parent):
+    depth = np.zeros(len(parent), dtype=np.int64)
+    known = parent < 0
+    while not known.all():
+        ready = ~known & known[np.maximum(parent, 0)]
+        depth[ready] = depth[parent[ready]] + 1
+        known |= ready
+    return depth
+
+
+# age-countable variants among vids: SNPs inside the age ranges
+def _age_countable(dbo, vids):
+    from lib import get_age_ranges
+    starts, ends = get_age_ranges(dbo)
+    countable = np.zeros(len(vids), dtype=bool)
+    for start in range(0, len(vids), 500):
+        part = vids[start:start+500]
+        rows = dbo.dc.execute('''select v.id, v.pos from variants v
+                                 inner join alleles a on a.id=v.anc
+                                 inner join alleles d on d.id=v.der
+                                 where length(a.allele)=1 and length(d.allele)=1
+                                 and d.allele!='.' and v.id in ({})'''.format(
+                                     ','.join('?'*len(part))), part).fetchall()
+        if not rows:
+            continue
+        ids, pos = np.array(rows, dtype=np.int64).T
+        # inside a range, ends included
+        ii = np.searchsorted(starts, pos, side='right') - 1
+        inside = (ii >= 0) & (pos <= ends[np.maximum(ii, 0)])
+        countable[start:start+500] = np.isin(part, ids[inside])
+    return countable
+
+# number of singletons of each kit: age-countable variants for which the kit
+# has a passed, non-mixed call and no other kit has a call
+def kit_singletons(dbo, pids):
+    from lib import unpack_calls, get_callinfo_version
+    from kitstore import call_store
+    store = call_store(dbo)
+    version = get_callinfo_version(dbo)
+    calls = []
+    for pid in pids:
+        vids, callinfo = store.get_calls(pid)
+        info = unpack_calls(callinfo, version)
+        good = info['passfail'].astype(bool) & (info['passrate'] >= config['mixed_call_rate'])
+        calls.append((np.asarray(vids, dtype=np.int64), good))
+    allvids, counts = np.unique(np.concatenate(
+        [v for v, g in calls] + [np.zeros(0, dtype=np.int64)]), return_counts=True)
+    once = allvids[counts == 1]
+    once = once[_age_countable(dbo, once.tolist())]
+    return np.array([np.count_nonzero(g & np.isin(v, once)) for v, g in calls],
+                    dtype=np.int64)
+
+# compute the ages of the stored tree and fill its snpage, snpagelo,
+# snpagehi and snpagepdf columns (snpagepdf is a PDF over
+# age_grid), clearing the dirty flags
+# Ages depend on the whole tree, so all clades are recomputed, but only if
+# some clade is dirty, unless force is set.
+@timed('ages')
+def populate_ages(dbo, force=False):
+    from lib import trace
+    from haplotree import load_tree
+    from treeio import encode
+    if not force and not dbo.dc.execute('select count(*) from tree where dirty').fetchone()[0]:
+        return
+    ids, parents, variants = load_tree(dbo)
+    if not len(ids):
+        return
+    index = dict(zip(ids.tolist(), range(len(ids))))
+    parent = np.array([index.get(p, -1) for p in parents.tolist()], dtype=np.int64)
+    rows = dbo.dc.execute('''select t.pID, t.cladeID, coalesce(b.coverage2, 0)
+                             from treekits t left join bedstats b on b.pID=t.pID
+                             order by t.pID''').fetchall()
+    pids = [r[0] for r in rows]
+    kitclade = [index[r[1]] for r in rows]
+    kitcov = [r[2] for r in rows]
+    trace(1, 'ages of {} clades from {} kits'.format(len(ids), len(pids)))
+    singles = kit_singletons(dbo, pids)
+    # the age-countable variants of all clades at once, summed per clade
+    sizes = [len(v) for v in variants]
+    countable = _age_countable(dbo, np.concatenate(variants).tolist())
+    nsnps = np.bincount(np.repeat(np.arange(len(variants)), sizes),
+                        weights=countable, minlength=len(variants)).astype(np.int64).tolist()
+    t = age_grid()
+    pdf, lo, mid, hi = clade_ages(parent, kitclade, singles, kitcov, nsnps, t)
+    if config['verbosity'] >= 3:
+        _trace_raw_ages(dbo, ids, parent, kitclade, singles, kitcov, nsnps, mid)
+    dbo.dc.executemany('''update tree set snpage=?, snpagelo=?, snpagehi=?,
+                          snpagepdf=?, dirty=0 where id=?''',
+                       zip(np.rint(mid).astype(int).tolist(),
+                           np.rint(lo).astype(int).tolist(),
+                           np.rint(hi).astype(int).tolist(),
+                           [encode('pdf', p) for p in pdf],
+                           ids.tolist()))
+    dbo.commit()
+
+# show the simple age estimates next to the computed ages
+def _trace_raw_ages(dbo, ids, parent, kitclade, singles, kitcov, nsnps, ages):
+    from lib import trace
+    from poissontables import cpoisson_table
+    depth = _depths(parent)
+    # SNPs from the root down to each clade
+    above = np.array(nsnps, dtype=np.float64)
+    for d in range(1, depth.max(initial=0) + 1):
+        level = np.flatnonzero(depth == d)
+        above[level] += above[parent[level]]
+    kitclade = np.asarray(kitclade)
+    nclades = len(parent)
+    nkits = _subtree_sums(parent, depth, np.bincount(kitclade, minlength=nclades))
+    below = _subtree_sums(parent, depth, np.bincount(kitclade, singles + above[kitclade],
+                                                     minlength=nclades)) - nkits*above
+    avgcov = _subtree_sums(parent, depth, np.bincount(kitclade, kitcov, minlength=nclades))
+    avgcov /= np.maximum(nkits, 1)
+    lo, mid, hi = raw_ages(cpoisson_table(dbo), below, nkits, avgcov)
+    for clade in range(nclades):
+        trace(3, 'clade {}: raw age {:.0f} ({:.0f}-{:.0f}), age {:.0f}'.format(
+            ids[clade], mid[clade], lo[clade], hi[clade], ages[clade]))
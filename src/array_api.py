@@ -12,43 +12,112 @@
 # ppl is a 1-d array of dataset IDs we're interested in
 def get_variant_array(db, ppl):
     from collections import defaultdict
-    c1 = db.dc
-    c1.execute('drop table if exists tmpt')
-    c1.execute('create temporary table tmpt(id integer)')
-    c1.executemany('insert into tmpt values(?)', [(p,) for p in ppl])
-    c1 = c1.execute('''select distinct v.id,c.pid from variants v
-                     inner join vcfcalls c on c.vid=v.id
-                     inner join tmpt t on c.pid=t.id''')
+    from kitstore import call_store
+    store = call_store(db)
     # build a 2d array
     arr = {}
     var = set()
     for pp in ppl:
         arr[pp] = defaultdict()
-
-    for (v,p) in c1:
-        arr[p][v] = 1
-        var.add(v)
-    c1.execute('drop table tmpt')
+        vids, callinfo = store.get_calls(pp)
+        for v in vids.tolist():
+            arr[pp][v] = 1
+            var.add(v)
 
     return arr, ppl, list(var)
 
-# create a csv file of 2d person x variant array
+# create a csv file of 2d person x variant array, as a string
+# see write_variant_csv; only for small numbers of kits
 def get_variant_csv(db, ppl):
-    arr, pl, vl = get_variant_array(db, ppl)
-    out = ',' + ','.join(['{}'.format(v) for v in ppl]) + '\n'
-    for vv in vl:
-        out += '{},'.format(vv)
-        for pp in pl:
-            try:
-                out += '{},'.format(arr[pp][vv])
-            except:
-                out += ','
-        out += '\n'
-    return out
+    import io
+    out = io.BytesIO()
+    write_variant_csv(db, out, ppl)
+    return out.getvalue().decode('ascii')
+
+# cells of call matrix written at a time by write_variant_csv
+CSV_BLOCK_CELLS = 1 << 24
+
+# write the call matrix of the kits in ppl (default: all kits with calls) to
+# a CSV file, a block of rows at a time
+# fname is a file name or a binary file object. There is one row per
+# variant: its ID, position, ancestral and derived allele, then the call code
+# of each kit (see callmatrix.py). Rows are ordered by position, or by variant
+# ID with order='id'. The file is gzip-compressed if compress is set, or if
+# compress is None and fname ends in .gz.
+# The matrix is built once, dense; above call_matrix_max_dense cells it is
+# memory-mapped from call_matrix_spill. It is written chunk rows at a time
+# (default: about CSV_BLOCK_CELLS cells), so the text of the whole file is
+# never held in memory.
+# returns the number of rows written
+def write_variant_csv(db, fname, ppl=None, order='pos', compress=None, chunk=None):
+    import gzip
+    import numpy as np
+    from callmatrix import build_call_matrix
+    cm = build_call_matrix(db, ppl, dense=True)
+    if order == 'id':
+        rowidx = cm.vorder
+    elif order != 'pos':
+        raise ValueError('unknown row order {}'.format(order))
+    if chunk is None:
+        chunk = max(1, CSV_BLOCK_CELLS // max(len(cm.pids), 1))
+    if hasattr(fname, 'write'):
+        out = gzip.GzipFile(fileobj=fname, mode='wb') if compress else fname
+    elif compress or (compress is None and fname.endswith('.gz')):
+        out = gzip.open(fname, 'wb')
+    else:
+        out = open(fname, 'wb')
+    try:
+        out.write(','.join(['vid', 'pos', 'anc', 'der'] +
+                           [str(p) for p in cm.pids.tolist()]).encode('ascii') + b'\n')
+        for start in range(0, len(cm.vids), chunk):
+            if order == 'id':
+                idx = rowidx[start:start+chunk]
+                block = cm.take(idx)
+            else:
+                idx = slice(start, start+chunk)
+                block = cm.rows(start, start+chunk)
+            out.write(_csv_rows(db, cm.vids[idx], cm.positions[idx], block))
+    finally:
+        if out is not fname:
+            out.close()
+    return len(cm.vids)
+
+# CSV lines for a block of call matrix rows, as bytes
+def _csv_rows(db, vids, positions, block):
+    import numpy as np
+    alleles = _variant_alleles(db, vids.tolist())
+    # the kit columns, if any, follow a comma
+    sep = ',' if block.shape[1] else ''
+    heads = ['{},{},{},{}{}'.format(v, p, *alleles[v], sep).encode('ascii')
+             for v, p in zip(vids.tolist(), positions.tolist())]
+    if block.shape[1] and block.min() >= 0 and block.max() <= 9:
+        # single digits: lay out digits, commas and newlines as bytes
+        cells = np.empty((block.shape[0], 2*block.shape[1]), dtype=np.uint8)
+        cells[:, 0::2] = block + ord('0')
+        cells[:, 1::2] = ord(',')
+        cells[:, -1] = ord('\n')
+        return b''.join([h + c.tobytes() for h, c in zip(heads, cells)])
+    return b''.join([h + ','.join(map(str, r)).encode('ascii') + b'\n'
+                     for h, r in zip(heads, block.tolist())])
+
+# dictionary of variant ID to (ancestral, derived) allele
+def _variant_alleles(db, vids):
+    alleles = {}
+    # stay below the SQLite limit on the number of parameters
+    for start in range(0, len(vids), 500):
+        part = vids[start:start+500]
+        rows = db.dc.execute('''select v.id, a.allele, d.allele from variants v
+                                inner join alleles a on a.id=v.anc
+                                inner join alleles d on d.id=v.der
+                                where v.id in ({})'''.format(','.join('?'*len(part))), part)
+        for vid, anc, der in rows:
+            alleles[vid] = (anc, der)
+    return alleles
 
-# get the list of populated (ones that have vcfcalls entries) DNAIDs
+# get the list of populated (ones that have calls) DNAIDs
 def get_dna_ids(db):
-    return [x[0] for x in db.dc.execute('select distinct(pID) from vcfcalls')]
+    from kitstore import call_store
+    return call_store(db).kit_ids()
 
 
 # get build identifier by its name; creates new entry if needed
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# end-to-end benchmark on synthetic cohorts (see synth.py)
+#
+# For each cohort size, a cohort is generated (or reused) under the work
+# directory and these stages are timed with runstats spans, from an empty
+# database:
+#   db_creation            - lib.db_creation, with the cohort's metadata
+#   populate_from_dataset  - loading all kits; rows are calls
+#   coverage               - populate_bedstats for all kits; rows are kits
+#   matrix build           - callmatrix.build_call_matrix; rows are cells
+#   tree build             - haplotree.build_tree; rows are variants
+#   matches                - matching.match_all; rows are kits
+# Each size runs in a process of its own, so that the peak memory of one
+# size does not carry over to the next. One JSON line per stage and size is
+# appended to the results file, with wall and CPU seconds, peak RSS in kB,
+# rows, rows and kits per second, and the settings that affect speed.
+#
+# Run as a command: benchmark.py [-n 100 1000 5000] [-w WORKDIR] [-o RESULTS]
+
+import os,sys,json,time,shutil,subprocess
+from reduxconfig import config
+
+SIZES = (100, 1000, 5000)
+STAGES = ('db_creation', 'populate_from_dataset', 'coverage', 'matrix build',
+          'tree build', 'matches')
+
+
+# run the stages on a cohort of nkits kits under workdir and append the
+# results to results; returns the result records
+def run_size(nkits, workdir, results, seed=0, workers=None):
+    import lib, runstats
+    from synth import make_cohort
+    from callmatrix import build_call_matrix
+    from haplotree import build_tree
+    from matching import match_all
+    cohort = os.path.join(workdir, 'cohort{}'.format(nkits))
+    make_cohort(cohort, nkits, seed)
+    config.update({'REDUX_DATA': cohort, 'DB_FILE': os.path.join(cohort, 'bench.db'),
+                   'use_web_api': False, 'drop_tables': True, 'max_snpdef_age': -1,
+                   'kitlimit': max(config['kitlimit'], nkits)})
+    if workers is None:
+        workers = config['ingest_workers']
+    # db_creation reads json.out and age.bed from the working directory
+    shutil.copy(os.path.join(config['REDUX_PATH'], 'age.bed'), cohort)
+    os.chdir(cohort)
+    for fname in ('bench.db', config['call_matrix_spill'], config['match_index']):
+        if os.path.exists(fname):
+            os.unlink(fname)
+    shutil.rmtree(config['kit_array_dir'], ignore_errors=True)
+    runstats.enable()
+    runstats.clear()
+    with runstats.span('db_creation') as sp:
+        db = lib.db_creation()
+        db.commit()
+        sp.rows = db.dc.execute('select count(*) from dataset').fetchone()[0]
+    with runstats.span('populate_from_dataset') as sp:
+        lib.populate_from_dataset(db, workers=workers)
+        sp.rows = sum(s['rows'] or 0 for s in runstats.spans() if s['stage'] == 'load kit')
+    with runstats.span('coverage') as sp:
+        lib.populate_bedstats(db)
+        db.commit()
+        sp.rows = db.dc.execute('select count(*) from bedstats').fetchone()[0]
+    with runstats.span('matrix build') as sp:
+        cm = build_call_matrix(db)
+        sp.rows = cm.shape[0] * cm.shape[1]
+    with runstats.span('tree build') as sp:
+        tree = build_tree(cm)
+        sp.rows = cm.shape[0]
+    with runstats.span('matches') as sp:
+        match_all(db, cm=cm)
+        sp.rows = cm.shape[1]
+    db.close()
+    top = [s for s in runstats.spans() if not s['parent']]
+    records = []
+    for s in top:
+        records.append({'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                        'version': config['VERSION'], 'nkits': nkits, 'seed': seed,
+                        'stage': s['stage'], 'wall': round(s['wall'], 4),
+                        'cpu': round(s['cpu'], 4), 'maxrss_kb': s['maxrss'],
+                        'rows': s['rows'],
+                        'rows_per_s': round(s['rows'] / s['wall'], 1) if s['wall'] else None,
+                        'kits_per_s': round(nkits / s['wall'], 1) if s['wall'] else None,
+                        'workers': workers, 'call_store': config['call_store'],
+                        'bed_store': config['bed_store']})
+    for rec in records:
+        if rec['stage'] == 'tree build':
+            rec['clades'] = tree.nclades
+    with open(results, 'a') as f:
+        for rec in records:
+            f.write(json.dumps(rec) + '\n')
+    return records
+
+# run each size in a process of its own and show the results
+def run_benchmark(sizes, workdir, results, seed=0, workers=None):
+    from lib import trace
+    os.makedirs(workdir, exist_ok=True)
+    for nkits in sizes:
+        cmd = [sys.executable, os.path.abspath(__file__), '--one', str(nkits),
+               '-w', workdir, '-o', results, '-s', str(seed)]
+        if workers is not None:
+            cmd += ['-j', str(workers)]
+        subprocess.run(cmd, check=True)
+    trace(0, '{:>6} {:<22} {:>9} {:>9} {:>10} {:>12} {:>9}'.format(
+        'kits', 'stage', 'wall s', 'cpu s', 'peak MB', 'rows/s', 'kits/s'))
+    with open(results) as f:
+        recs = [json.loads(line) for line in f]
+    for nkits in sizes:
+        # the latest run of each size
+        mine = [r for r in recs if r['nkits'] == nkits][-len(STAGES):]
+        for r in mine:
+            trace(0, '{:>6} {:<22} {:>9.3f} {:>9.3f} {:>10.1f} {:>12} {:>9}'.format(
+                nkits, r['stage'], r['wall'], r['cpu'], (r['maxrss_kb'] or 0) / 1024,
+                r['rows_per_s'], r['kits_per_s']))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='time the stages of redux on synthetic cohorts')
+    parser.add_argument('-n', '--nkits', help='cohort sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('-w', '--workdir', help='where the cohorts and databases are made',
+                        default=os.path.join(config['REDUX_DATA'], 'benchmark'))
+    parser.add_argument('-o', '--results', help='file the results are appended to (JSON lines)')
+    parser.add_argument('-s', '--seed', help='random seed of the cohorts', type=int, default=0)
+    parser.add_argument('-j', '--jobs', help='number of processes parsing kits', type=int)
+    parser.add_argument('--one', help=argparse.SUPPRESS, type=int)
+    args = parser.parse_args()
+    workdir = os.path.abspath(args.workdir)
+    results = os.path.abspath(args.results or os.path.join(workdir, 'results.jsonl'))
+    if args.one:
+        run_size(args.one, workdir, results, args.seed, args.jobs)
+    else:
+        run_benchmark(args.nkits, workdir, results, args.seed, args.jobs)
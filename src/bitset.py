@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# packed bitsets of kits, one row per variant
+#
+# A set of kits is a row of np.packbits bits (kit k is bit 7-k%8 of byte
+# k//8), zero-padded to whole 64-bit words and viewed as uint64, so that the
+# set operations of the clade logic work a word of 64 kits at a time:
+#   band, bandnot, popcount - intersection, difference and size
+#   equal_rows, subset_rows - all rows of a bitset array that are equal to or
+#       a subset of one set
+#   group_rows - rows whose sets are identical get the same group number
+# KitSets holds the positive, negative and no-call sets of each variant of a
+# call matrix (see callmatrix.py for the call codes); build_tree groups the
+# variants with identical positive and negative sets with group_rows.
+
+import numpy as np
+from callmatrix import CALL_MASK, CALL_FAILMIXED
+
+# number of bits set in each byte, for numpy without bitwise_count
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# pack a bool array (... x nkits) into uint64 words along the last axis
+def pack(mask):
+    mask = np.asarray(mask, dtype=bool)
+    nkits = mask.shape[-1]
+    nbytes = 8 * ((nkits + 63) // 64)
+    bits = np.zeros(mask.shape[:-1] + (nbytes,), dtype=np.uint8)
+    bits[..., :(nkits + 7) // 8] = np.packbits(mask, axis=-1)
+    return bits.view(np.uint64)
+
+# the bool array of nkits kits of packed sets
+def unpack(bits, nkits):
+    return np.unpackbits(bits.view(np.uint8), axis=-1, count=nkits).astype(bool)
+
+def band(a, b):
+    return np.bitwise_and(a, b)
+
+# kits in a but not in b
+def bandnot(a, b):
+    return np.bitwise_and(a, np.bitwise_not(b))
+
+# number of kits in each set
+def popcount(bits):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(bits).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT8[bits.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+# bool vector of the rows of sets equal to the set x
+def equal_rows(sets, x):
+    return (sets == x).all(axis=-1)
+
+# bool vector of the rows of sets that are a subset of x
+def subset_rows(sets, x):
+    return ~bandnot(sets, x).any(axis=-1)
+
+# group number of each row, the same for rows whose sets are identical in
+# all of the bitset arrays given; groups are numbered in order of first
+# occurrence
+def group_rows(*sets):
+    rows = np.ascontiguousarray(np.hstack(sets))
+    if not len(rows):
+        return np.zeros(0, dtype=np.int64)
+    keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1])))
+    _, first, inverse = np.unique(keys.ravel(), return_index=True, return_inverse=True)
+    # renumber from sorted key order to order of first occurrence
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse.ravel()]
+
+
+# the positive, negative and no-call kit sets of each variant
+# pos holds the positive and mixed calls (code 4 and up, passed or failed),
+# neg the negative calls (codes 1-3) and nocall the uncalled kits
+class KitSets(object):
+
+    def __init__(self, pos, neg, nocall, nkits):
+        self.pos = pos
+        self.neg = neg
+        self.nocall = nocall
+        self.nkits = nkits
+
+    # from a dense array of call codes (variants x kits), block rows at a time
+    @classmethod
+    def from_calls(cls, calls, block=4096):
+        nvar, nkits = calls.shape
+        nwords = (nkits + 63) // 64
+        sets = [np.zeros((nvar, nwords), dtype=np.uint64) for _ in range(3)]
+        for start in range(0, nvar, block):
+            codes = np.asarray(calls[start:start+block]) & CALL_MASK
+            sets[0][start:start+block] = pack(codes >= CALL_FAILMIXED)
+            sets[1][start:start+block] = pack((codes >= 1) & (codes < CALL_FAILMIXED))
+            sets[2][start:start+block] = pack(codes == 0)
+        return cls(sets[0], sets[1], sets[2], nkits)
+
+    def __len__(self):
+        return len(self.pos)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# the variant x kit call matrix that the tree is built from
+#
+# Each cell holds one of the call codes of examples/fakeHaplotreeCode.py in
+# its low four bits:
+#   7 CALL_POS        positive, call PASS
+#   6 CALL_MIXED      mixed, call PASS
+#   5 CALL_FAILPOS    positive, call FAIL
+#   4 CALL_FAILMIXED  mixed, call FAIL
+#   3 CALL_FAILNEG    negative, call FAIL
+#   2 CALL_BEDNEG     no call, but inside one of the kit's BED ranges
+#   1 CALL_NEG        negative, call PASS
+#   0 CALL_UNCALLED   no call and no BED coverage
+# A kit is negative for a variant if it has a call at the same position for
+# another allele, including a reference call (a variant with der '.'). A call
+# is mixed if fewer than mixed_call_rate of its reads support it. The high
+# bits hold the assignment that tree building makes: ASSIGN_JUNK,
+# ASSIGN_NEG or ASSIGN_POS, so that code & CALL_MASK is the original call and
+# code & ASSIGN_MASK the assignment. CALL_IMPLIED marks a positive call that
+# a rule of implications.txt implied (see implications.py).
+#
+# Rows are variants, sorted by position; columns are kits, sorted by pID. The
+# matrix is a dense int8 array, in memory or memory-mapped from a .npy file.
+# When it would be larger than call_matrix_max_dense cells, it is held as a
+# scipy CSR matrix of the called cells, and the uncalled and BED-negative
+# cells come from a bit-packed coverage matrix. A large dense matrix, without
+# scipy or when one is asked for, is spilled to call_matrix_spill under
+# REDUX_DATA instead.
+
+import os
+import numpy as np
+from reduxconfig import config
+from runstats import timed
+
+CALL_UNCALLED = 0
+CALL_NEG = 1
+CALL_BEDNEG = 2
+CALL_FAILNEG = 3
+CALL_FAILMIXED = 4
+CALL_FAILPOS = 5
+CALL_MIXED = 6
+CALL_POS = 7
+CALL_MASK = 15
+
+ASSIGN_NONE = 0
+ASSIGN_JUNK = 16
+ASSIGN_NEG = 32
+ASSIGN_POS = 48
+ASSIGN_MASK = 48
+
+CALL_IMPLIED = 64
+
+
+class CallMatrix(object):
+
+    # vids, positions: the variants of the rows; pids: the kits of the columns
+    # calls: dense int8 array, or CSR matrix of the called cells, in which
+    # case coverage is the CoverageMatrix of the same variants and kits
+    def __init__(self, vids, positions, pids, calls, coverage=None):
+        self.vids = vids
+        self.positions = positions
+        self.pids = pids
+        self.calls = calls
+        self.coverage = coverage
+        self.vorder = np.argsort(vids, kind='stable')
+
+    @property
+    def shape(self):
+        return (len(self.vids), len(self.pids))
+
+    @property
+    def sparse(self):
+        return self.coverage is not None
+
+    # row indexes of variant IDs; -1 for variants not in the matrix
+    def variant_index(self, vids):
+        vids = np.asarray(vids)
+        ii = np.minimum(np.searchsorted(self.vids, vids, sorter=self.vorder),
+                        len(self.vids)-1)
+        rows = self.vorder[ii]
+        return np.where(self.vids[rows] == vids, rows, -1)
+
+    # column indexes of pIDs; -1 for kits not in the matrix
+    def kit_index(self, pids):
+        pids = np.asarray(pids)
+        ii = np.minimum(np.searchsorted(self.pids, pids), len(self.pids)-1)
+        return np.where(self.pids[ii] == pids, ii, -1)
+
+    # rows start to stop as a dense int8 array
+    def rows(self, start, stop):
+        stop = min(stop, len(self.vids))
+        if not self.sparse:
+            return np.asarray(self.calls[start:stop])
+        return self.take(np.arange(start, stop))
+
+    # the rows with the given indexes as a dense int8 array
+    def take(self, rowidx):
+        rowidx = np.asarray(rowidx, dtype=np.int64)
+        if not self.sparse:
+            return np.asarray(self.calls[rowidx])
+        block = self.calls[rowidx].toarray().astype(np.int8)
+        # BED-negative where there is no call but coverage
+        shift = (7 - (rowidx & 7)).astype(np.uint8)
+        covered = ((self.coverage.bits[:, rowidx >> 3] >> shift) & 1).T
+        block[(block == CALL_UNCALLED) & (covered == 1)] = CALL_BEDNEG
+        return block
+
+    # the whole matrix as a dense int8 array
+    def toarray(self):
+        return self.rows(0, len(self.vids))
+
+
+# variant IDs, positions and derived alleles of a build, sorted by ID
+def variant_table(dbo, buildid):
+    rows = dbo.dc.execute('''select id, pos, der from variants where buildID=?
+                             order by id''', (buildid,)).fetchall()
+    table = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    return table[:,0], table[:,1].astype(np.int32), table[:,2]
+
+# call codes of one kit's calls for the rows of the matrix
+# rowvids, rowpos: the variants of the matrix, sorted by position, with
+# roworder sorting rowvids; covered: the kit's BED coverage of the rows
+def kit_call_codes(rowvids, rowpos, roworder, covered, kvids, kpos, passfail,
+                   passrate, mixed):
+    col = np.where(covered, CALL_BEDNEG, CALL_UNCALLED).astype(np.int8)
+    if len(kvids) == 0 or len(rowvids) == 0:
+        return col
+    # negative: a call at the same position
+    korder = np.argsort(kpos, kind='stable')
+    spos = kpos[korder]
+    ii = np.minimum(np.searchsorted(spos, rowpos), len(spos)-1)
+    hit = spos[ii] == rowpos
+    kpass = passfail[korder][ii[hit]]
+    col[hit] = np.where(kpass, CALL_NEG, CALL_FAILNEG)
+    # positive or mixed: a call for the variant itself
+    ii = np.minimum(np.searchsorted(rowvids, kvids, sorter=roworder),
+                    len(rowvids)-1)
+    rows = roworder[ii]
+    hit = rowvids[rows] == kvids
+    full = passrate[hit] >= mixed
+    col[rows[hit]] = np.where(passfail[hit],
+                              np.where(full, CALL_POS, CALL_MIXED),
+                              np.where(full, CALL_FAILPOS, CALL_FAILMIXED))
+    return col
+
+# build the call matrix for the kits in pids (default: all kits with calls)
+# and the variants in vids (default: every variant, other than reference
+# calls, that one of the kits has a call for)
+# dense forces a dense (True) or sparse (False) matrix; by default, the matrix
+# is dense up to call_matrix_max_dense cells. spill is the name of a .npy file
+# to hold a dense matrix; it is memory-mapped instead of held in memory. A
+# dense matrix of more than call_matrix_max_dense cells is always spilled, by
+# default to call_matrix_spill.
+@timed('call matrix')
+def build_call_matrix(dbo, pids=None, vids=None, dense=None, spill=None, buildname='hg38'):
+    from lib import trace, unpack_calls, get_callinfo_version
+    from kitstore import call_store, bed_store
+    from array_api import get_build_byname
+    from coverage import coverage_matrix, _sorted_coverage
+    cstore = call_store(dbo)
+    bstore = bed_store(dbo)
+    if pids is None:
+        pids = cstore.kit_ids()
+    pids = np.unique(np.asarray(pids, dtype=np.int64))
+    version = get_callinfo_version(dbo)
+    allids, allpos, allder = variant_table(dbo, get_build_byname(dbo, buildname))
+    refder = dbo.dc.execute("select id from alleles where allele='.'").fetchone()
+    refder = refder[0] if refder else -1
+
+    # index into the variant table of the variant IDs v
+    def lookup(v):
+        return np.minimum(np.searchsorted(allids, v), max(len(allids)-1, 0))
+
+    if vids is None:
+        vids = np.zeros(0, dtype=np.int64)
+        for pid in pids.tolist():
+            kvids = cstore.get_calls(pid)[0]
+            kvids = kvids[allder[lookup(kvids)] != refder]
+            vids = np.union1d(vids, kvids)
+    vids = np.unique(np.asarray(vids, dtype=np.int64))
+    ii = lookup(vids)
+    if len(vids) and (allids[ii] != vids).any():
+        raise ValueError('unknown variant ID')
+    positions = allpos[ii]
+    order = np.lexsort((vids, positions))
+    vids = vids[order]
+    positions = positions[order]
+    roworder = np.argsort(vids, kind='stable')
+    nrows, nkits = len(vids), len(pids)
+    trace(1, 'call matrix of {} variants x {} kits'.format(nrows, nkits))
+
+    large = nrows*nkits > config['call_matrix_max_dense']
+    if dense is None:
+        dense = not large
+    if not dense:
+        try:
+            import scipy.sparse
+        except ImportError:
+            trace(1, 'scipy is not available - call matrix is dense')
+            dense = True
+    if dense and large and spill is None:
+        spill = os.path.join(config['REDUX_DATA'], config['call_matrix_spill'])
+
+    mixed = config['mixed_call_rate']
+    if dense:
+        if spill:
+            calls = np.lib.format.open_memmap(spill, mode='w+', dtype=np.int8,
+                                              shape=(nrows, nkits))
+        else:
+            calls = np.zeros((nrows, nkits), dtype=np.int8)
+        coverage = None
+    else:
+        coverage = coverage_matrix(dbo, pids.tolist(), positions)
+        crow, ccol, cdata = [], [], []
+
+    # fill a block of kits at a time, which writes contiguous bytes of each
+    # row of a dense matrix
+    block = 64
+    for start in range(0, nkits, block):
+        kits = pids[start:start+block].tolist()
+        buf = np.zeros((nrows, len(kits)), dtype=np.int8)
+        for jj, pid in enumerate(kits):
+            kvids, callinfo = cstore.get_calls(pid)
+            unpacked = unpack_calls(callinfo, version)
+            kpos = allpos[lookup(kvids)]
+            if dense:
+                starts, ends = bstore.get_ranges(pid)
+                covered = _sorted_coverage(starts, ends, positions)[0]
+            else:
+                covered = np.zeros(nrows, dtype=bool)
+            buf[:,jj] = kit_call_codes(vids, positions, roworder, covered,
+                                       np.asarray(kvids), kpos,
+                                       unpacked['passfail'].astype(bool),
+                                       unpacked['passrate'], mixed)
+        if dense:
+            calls[:, start:start+len(kits)] = buf
+        else:
+            rr, cc = np.nonzero(buf)
+            crow.append(rr.astype(np.int32))
+            ccol.append((cc + start).astype(np.int32))
+            cdata.append(buf[rr, cc])
+        trace(2, 'call matrix: {} of {} kits'.format(start+len(kits), nkits))
+
+    if not dense:
+        crow = np.concatenate(crow or [np.zeros(0, dtype=np.int32)])
+        ccol = np.concatenate(ccol or [np.zeros(0, dtype=np.int32)])
+        cdata = np.concatenate(cdata or [np.zeros(0, dtype=np.int8)])
+        calls = scipy.sparse.csr_matrix((cdata, (crow, ccol)), shape=(nrows, nkits),
+                                        dtype=np.int8)
+    elif spill:
+        calls.flush()
+    return CallMatrix(vids, positions, pids, calls, coverage)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# BED range coverage of variants, for all kits at once
+#
+# A variant at position pos is covered by a kit if pos lies strictly inside
+# one of the kit's BED ranges (minaddr < pos < maxaddr), the same test as
+# lib.in_range. A variant that falls on a range end is not covered; instead it
+# gets one of the edge flags used by examples/clades.py:
+#   EDGE_CBLU - on a range of length zero (minaddr = maxaddr = pos)
+#   EDGE_CBL  - on the lower end of a range
+#   EDGE_CBU  - on the upper end of a range
+# in that order of precedence. Edges are rare, so they are kept in a sparse
+# side array next to the bit-packed coverage matrix.
+#
+# coverage_stats sums up, per kit, the number of bases covered by the kit's
+# BED ranges in total and within the age regions of age.bed, for the bedstats
+# table. binned_coverage does the same for fixed-size bins, from which the
+# shared coverage of pairs of kits is estimated (see matching.py).
+
+import numpy as np
+
+EDGE_NONE = 0
+EDGE_CBLU = 1
+EDGE_CBU = 2
+EDGE_CBL = 3
+EDGE_NAMES = {EDGE_NONE: '', EDGE_CBLU: 'cblu', EDGE_CBU: 'cbu', EDGE_CBL: 'cbl'}
+
+
+# coverage of positions by one kit's ranges
+# starts and ends are the kit's range ends, sorted by start; positions may be
+# in any order
+# returns a bool array (covered) and an int8 array of edge flags, both
+# aligned with positions
+def kit_coverage(starts, ends, positions):
+    positions = np.asarray(positions)
+    order = np.argsort(positions, kind='stable')
+    scovered, sedge = _sorted_coverage(starts, ends, positions[order])
+    covered = np.empty_like(scovered)
+    edge = np.empty_like(sedge)
+    covered[order] = scovered
+    edge[order] = sedge
+    return covered, edge
+
+# kit_coverage for sorted positions
+# Rather than looking up every position in the ranges, the range ends are
+# looked up in the positions, and the runs of positions they delimit are
+# marked with a difference array. Positions on range ends are found the same
+# way.
+def _sorted_coverage(starts, ends, spos):
+    n = len(spos)
+    edge = np.zeros(n, dtype=np.int8)
+    if len(starts) == 0:
+        return np.zeros(n, dtype=bool), edge
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    covered = _mark(n, np.searchsorted(spos, starts, side='right'),
+                    np.searchsorted(spos, ends, side='left'))
+    edge[_hits(spos, ends)] = EDGE_CBU
+    edge[_hits(spos, starts)] = EDGE_CBL
+    edge[_hits(spos, starts[starts == ends])] = EDGE_CBLU
+    # a range end can still be inside another, overlapping range
+    edge[covered] = EDGE_NONE
+    return covered, edge
+
+# indices of the sorted positions that are equal to one of values
+def _hits(spos, values):
+    lo = np.searchsorted(spos, values, side='left')
+    cnt = np.searchsorted(spos, values, side='right') - lo
+    first = np.cumsum(cnt) - cnt
+    return np.arange(cnt.sum()) - np.repeat(first - lo, cnt)
+
+# bool vector of length n that is True inside any of the runs [lo, hi)
+def _mark(n, lo, hi):
+    keep = hi > lo
+    diff = np.bincount(lo[keep], minlength=n+1) - np.bincount(hi[keep], minlength=n+1)
+    return np.cumsum(diff[:n]) > 0
+
+
+# bit-packed coverage of nvariants positions by nkits kits
+# bits holds one packed row per kit, in the order of pids; the edge flags are
+# held as (kit index, variant index, flag) triples
+class CoverageMatrix(object):
+
+    def __init__(self, pids, positions, bits, edge_kits, edge_vars, edge_flags):
+        self.pids = list(pids)
+        self.positions = positions
+        self.bits = bits
+        self.edge_kits = edge_kits
+        self.edge_vars = edge_vars
+        self.edge_flags = edge_flags
+        self.index = dict((p, ii) for ii, p in enumerate(self.pids))
+
+    # bool vector of covered variants for one kit
+    def covered(self, pid):
+        row = self.bits[self.index[pid]]
+        return np.unpackbits(row, count=len(self.positions)).astype(bool)
+
+    # int8 vector of edge flags for one kit
+    def edges(self, pid):
+        edge = np.zeros(len(self.positions), dtype=np.int8)
+        sel = self.edge_kits == self.index[pid]
+        edge[self.edge_vars[sel]] = self.edge_flags[sel]
+        return edge
+
+    # unpacked (nkits, nvariants) bool matrix
+    def dense(self):
+        return np.unpackbits(self.bits, axis=1, count=len(self.positions)).astype(bool)
+
+    # number of kits covering each variant, unpacking a block of kits at a
+    # time
+    def counts(self, block=256):
+        counts = np.zeros(len(self.positions), dtype=np.int64)
+        for ii in range(0, len(self.pids), block):
+            counts += np.unpackbits(self.bits[ii:ii+block], axis=1,
+                                    count=len(self.positions)).sum(axis=0, dtype=np.int64)
+        return counts
+
+
+# compute the coverage matrix of the given variant positions for the kits in
+# pids, reading each kit's ranges from the BED store
+def coverage_matrix(dbo, pids, positions):
+    from kitstore import bed_store
+    store = bed_store(dbo)
+    positions = np.asarray(positions, dtype=np.int32)
+    # sort the positions once for all kits
+    order = np.argsort(positions, kind='stable')
+    spos = positions[order]
+    covered = np.empty(len(positions), dtype=bool)
+    edge = np.empty(len(positions), dtype=np.int8)
+    bits = np.zeros((len(pids), (len(positions)+7)//8), dtype=np.uint8)
+    ekits, evars, eflags = [], [], []
+    for ii, pid in enumerate(pids):
+        starts, ends = store.get_ranges(pid)
+        scovered, sedge = _sorted_coverage(starts, ends, spos)
+        covered[order] = scovered
+        edge[order] = sedge
+        bits[ii] = np.packbits(covered)
+        ev = np.flatnonzero(edge)
+        ekits.append(np.full(len(ev), ii, dtype=np.int32))
+        evars.append(ev.astype(np.int32))
+        eflags.append(edge[ev])
+    if len(pids):
+        ekits = np.concatenate(ekits)
+        evars = np.concatenate(evars)
+        eflags = np.concatenate(eflags)
+    else:
+        ekits = np.zeros(0, dtype=np.int32)
+        evars = np.zeros(0, dtype=np.int32)
+        eflags = np.zeros(0, dtype=np.int8)
+    return CoverageMatrix(pids, positions, bits, ekits, evars, eflags)
+
+# positions of the variants with IDs vids, as an int32 array aligned with vids
+def variant_positions(dbo, vids):
+    vids = np.asarray(vids, dtype=np.int64)
+    rows = dbo.dc.execute('select id, pos from variants order by id').fetchall()
+    table = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    ii = np.searchsorted(table[:,0], vids)
+    if len(vids) and (ii.max() >= len(table) or (table[ii,0] != vids).any()):
+        raise ValueError('unknown variant ID')
+    return table[ii,1].astype(np.int32)
+
+
+# ranges of all kits are kept in one array, each kit's positions offset by
+# its index times KIT_STRIDE, so that one sweep handles every kit
+KIT_STRIDE = 1 << 32
+
+# total coverage, coverage within the age ranges and number of ranges for a
+# list of kits
+# kitranges is a list of (starts, ends) per kit; agestarts, ageends are the age
+# ranges
+# returns three int64 arrays, aligned with kitranges
+# Overlapping or adjacent ranges are counted once.
+def coverage_stats(kitranges, agestarts, ageends):
+    nkits = len(kitranges)
+    nranges = np.array([len(s) for (s, e) in kitranges], dtype=np.int64)
+    kits = np.repeat(np.arange(nkits, dtype=np.int64), nranges)
+    if len(kits):
+        starts = kits*KIT_STRIDE + np.concatenate([s for (s, e) in kitranges])
+        ends = kits*KIT_STRIDE + np.concatenate([e for (s, e) in kitranges])
+    else:
+        starts = ends = np.zeros(0, dtype=np.int64)
+    starts, ends = _union(starts, ends)
+    total = np.bincount(starts // KIT_STRIDE, weights=ends-starts,
+                        minlength=nkits).astype(np.int64)
+    astarts, aends = _union(np.asarray(agestarts, dtype=np.int64),
+                            np.asarray(ageends, dtype=np.int64))
+    # the kit's coverage below each end of each age range, per kit
+    offsets = np.arange(nkits, dtype=np.int64)[:,None] * KIT_STRIDE
+    below = _measure_below(starts, ends, offsets + aends) - \
+        _measure_below(starts, ends, offsets + astarts)
+    return total, below.sum(axis=1, dtype=np.int64), nranges
+
+# covered bases of each kit in nbins bins of binsize bases from lo, as a
+# float32 (nkits, nbins) array; kitranges as for coverage_stats
+def binned_coverage(kitranges, lo, binsize, nbins):
+    edges = lo + binsize * np.arange(nbins+1, dtype=np.int64)
+    binned = np.zeros((len(kitranges), nbins), dtype=np.float32)
+    for ii, (starts, ends) in enumerate(kitranges):
+        starts, ends = _union(np.asarray(starts, dtype=np.int64),
+                              np.asarray(ends, dtype=np.int64))
+        binned[ii] = np.diff(_measure_below(starts, ends, edges))
+    return binned
+
+# the union of ranges as sorted, disjoint ranges
+def _union(starts, ends):
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = ends[order]
+    if len(starts) == 0:
+        return starts, ends
+    reach = np.maximum.accumulate(ends)
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > reach[:-1]
+    last = np.append(np.flatnonzero(first)[1:] - 1, len(starts) - 1)
+    return starts[first], reach[last]
+
+# the number of bases of the sorted, disjoint ranges that lie below x, for an
+# array of x
+def _measure_below(starts, ends, x):
+    if len(starts) == 0:
+        return np.zeros(x.shape, dtype=np.int64)
+    cum = np.cumsum(ends - starts)
+    # ranges before the last one that starts below x lie entirely below x
+    ii = np.searchsorted(starts, x, side='left') - 1
+    jj = np.maximum(ii, 0)
+    part = np.minimum(x, ends[jj]) - starts[jj]
+    return np.where(ii >= 0, cum[jj] - (ends[jj]-starts[jj]) + part, 0)
@@ -8,25 +8,137 @@
 # version 3 (29 June 2007)
 # https://www.gnu.org/licenses/gpl.html
 
-import sys,os,sqlite3,yaml,time,csv,json,numpy as np
+import os,sqlite3
+from contextlib import contextmanager
+from urllib.parse import quote
+from array_api import get_build_byname
+from reduxconfig import config
+from runstats import span
 
-REDUX_CONF = 'config.yaml'
-config = yaml.load(open(REDUX_CONF))
+
+# the PRAGMAs of a connection profile, in the order they are set
+#   default  - every connection: the write-ahead log (a persistent setting
+#              of the file), no waiting for writes to reach the disk, and
+#              exclusive locking, as the DB object is the only user
+#   bulk     - loading: a large page cache, memory-mapped reads, temporary
+#              tables and sorts in memory and the rollback journal kept in
+#              memory instead of the log; see DB.bulk_load
+#   query    - reading, once data is loaded: the write-ahead log with
+#              normal locking, so that other connections can read while
+#              this one writes; see DB.query_mode, which the loaders end
+#              with and the query service runs before serving
+#   readonly - read-only connections, DB(readonly=True): no changes, with
+#              the cache, map and temporary storage of the query profile
+# With db_readers in config.yaml, the default and bulk profiles keep the
+# write-ahead log with normal locking, so that read-only connections of
+# other processes (see queryservice.py) read the last committed data while
+# kits load, rather than waiting for the writer.
+# Cache and map sizes are db_cache_mb and db_mmap_mb in config.yaml.
+def profile_pragmas(name):
+    cache = -1024 * config['db_cache_mb']
+    mmap = 1024 * 1024 * config['db_mmap_mb']
+    shared = config['db_readers']
+    query = (('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+             ('locking_mode', 'NORMAL'), ('cache_size', cache),
+             ('mmap_size', mmap), ('temp_store', 'MEMORY'))
+    profiles = {
+        'default': (('journal_mode', 'WAL'), ('synchronous', 'OFF'),
+                    ('locking_mode', 'NORMAL' if shared else 'EXCLUSIVE'),
+                    ('cache_size', -20000), ('analysis_limit', 1000)),
+        'bulk': (('journal_mode', 'WAL' if shared else 'MEMORY'), ('synchronous', 'OFF'),
+                 ('cache_size', cache), ('mmap_size', mmap), ('temp_store', 'MEMORY')),
+        'query': query,
+        'readonly': (('query_only', 'ON'),) + query[3:],
+        }
+    if name not in profiles:
+        raise ValueError('unknown connection profile {}'.format(name))
+    return profiles[name]
+
+
+# in-memory interning of allele and variant IDs, kept for a whole load
+# Alleles are keyed by their string, variants by (pos, anc, der) per build,
+# where anc and der are allele IDs. Each is read from the database once, on
+# first use. New entries are bulk-inserted with IDs assigned here; this is
+# safe because the DB object is the only writer. Anything that inserts into
+# alleles or variants behind the cache's back must call
+# DB.reset_variant_cache(). Read-only connections (DB(readonly=True), the
+# query service) never write, so they do not affect this.
+class VariantCache(object):
+
+    def __init__(self, dbo):
+        self.dbo = dbo
+        self.alleles = dict(dbo.dc.execute('select allele, id from alleles'))
+        self.next_allele = dbo.dc.execute(
+            'select coalesce(max(id),0)+1 from alleles').fetchone()[0]
+        self.next_variant = dbo.dc.execute(
+            'select coalesce(max(id),0)+1 from variants').fetchone()[0]
+        self.variants = {}
+
+    # IDs for a list of allele strings, inserting any new alleles
+    def allele_ids(self, alleles):
+        new = []
+        for allele in sorted(set(alleles) - set(self.alleles)):
+            self.alleles[allele] = self.next_allele
+            new.append((self.next_allele, allele))
+            self.next_allele += 1
+        if new:
+            self.dbo.dc.executemany('insert into alleles(id,allele) values(?,?)', new)
+        return [self.alleles[a] for a in alleles]
+
+    # the (pos, anc, der) -> ID dictionary for a build
+    def build_variants(self, buildid):
+        if buildid not in self.variants:
+            vd = {}
+            for (vid, pos, anc, der) in self.dbo.dc.execute(
+                    'select id, pos, anc, der from variants where buildID=?',
+                    (buildid,)):
+                vd[(pos, anc, der)] = vid
+            self.variants[buildid] = vd
+        return self.variants[buildid]
+
+    # IDs for vectors of variant positions and allele strings, inserting any
+    # new variants
+    def variant_ids(self, buildid, pos, anc, der):
+        vd = self.build_variants(buildid)
+        keys = zip([int(p) for p in pos], self.allele_ids(anc), self.allele_ids(der))
+        vids = []
+        new = []
+        for key in keys:
+            vid = vd.get(key)
+            if vid is None:
+                vid = vd[key] = self.next_variant
+                new.append((vid, buildid) + key)
+                self.next_variant += 1
+            vids.append(vid)
+        if new:
+            self.dbo.dc.executemany('''insert into variants(id,buildID,pos,anc,der)
+                                       values(?,?,?,?,?)''', new)
+        return vids
 
 
 class DB(object):
 
-    def __init__(self, dbfname=config['DB_FILE'], drop=True):
+    # dbfname defaults to DB_FILE; profile is the connection profile to
+    # start with (see profile_pragmas), by default default or readonly
+    # A readonly connection never drops the file, and may be used by any
+    # thread, one at a time (see queryservice.py).
+    def __init__(self, dbfname=None, drop=True, profile=None, readonly=False):
+        if dbfname is None:
+            dbfname = config['DB_FILE']
         self.dbfname = dbfname
-        # just remove the file, which is often faster than dropping big tables
-        if drop and os.path.exists(dbfname):
-            os.unlink(dbfname)
-        self.db = sqlite3.connect(dbfname)
+        if readonly:
+            self.db = sqlite3.connect('file:{}?mode=ro'.format(quote(os.path.abspath(dbfname))),
+                                      uri=True, check_same_thread=False)
+        else:
+            # just remove the file, which is often faster than dropping big tables
+            if drop and os.path.exists(dbfname):
+                os.unlink(dbfname)
+            self.db = sqlite3.connect(dbfname)
         self.dc = self.cursor()
-        # affect whether or not to wait for data write to disk
-        self.dc.execute('PRAGMA synchronous=OFF')
-        # force single-user for slightly better performance
-        self.dc.execute('PRAGMA locking_mode=EXCLUSIVE')
+        self.vcache = None
+        self.staged = []
+        self.nstaged = 0
+        self.use_profile(profile or ('readonly' if readonly else 'default'))
 
     def cursor(self):
         return self.db.cursor()
@@ -35,8 +147,55 @@ class DB(object):
         with open(FILE,'r') as fh:
             self.dc.executescript(fh.read())
 
+    # commit, then apply the file changes staged in the transaction
     def commit(self):
         self.db.commit()
+        staged, self.staged = self.staged, []
+        for fname, new in staged:
+            if new is not None:
+                os.replace(new, fname)
+            elif os.path.exists(fname):
+                os.unlink(fname)
+
+    # roll back, discarding the staged file changes
+    def rollback(self):
+        self.db.rollback()
+        self.discard_files()
+
+    # files that belong to the database, such as the .npy files of the npy
+    # kit stores (see kitstore.py), are changed with the transaction: a file
+    # to replace fname is written under the name stage_file returns, and
+    # moved into place at the next commit; with delete, fname is removed at
+    # the next commit. Staged changes of a transaction that rolls back, or
+    # of a savepoint that rolls back (see discard_files), are dropped. Other
+    # connections only ever see the files of committed transactions, though
+    # not atomically with the database (see queryservice.py).
+    def stage_file(self, fname, delete=False):
+        if delete:
+            self.staged.append((fname, None))
+            return None
+        self.nstaged += 1
+        new = '{}.{}.new'.format(fname, self.nstaged)
+        self.staged.append((fname, new))
+        return new
+
+    # the file that stands for fname in this transaction: the file last
+    # staged for it, None if it is to be removed, else fname itself
+    def current_file(self, fname):
+        for f, new in reversed(self.staged):
+            if f == fname:
+                return new
+        return fname
+
+    # drop the file changes staged after the first mark ones, as
+    #   mark = len(dbo.staged)
+    #   ... rollback to a savepoint ...
+    #   dbo.discard_files(mark)
+    def discard_files(self, mark=0):
+        for fname, new in self.staged[mark:]:
+            if new is not None and os.path.exists(new):
+                os.unlink(new)
+        del self.staged[mark:]
 
     def close(self):
         self.dc.close()
@@ -44,32 +203,127 @@ class DB(object):
     def create_schema(self, schemafile='schema.sql'):
         self.run_sql_file(os.path.join(config['REDUX_SQL'],schemafile))
 
+    # set the PRAGMAs of a connection profile, or a list of (pragma, value)
+    # pairs; returns the previous values, to restore them with
+    # use_profile(previous)
+    # The journal mode cannot change inside a transaction, so call this
+    # between transactions.
+    def use_profile(self, profile):
+        pragmas = profile_pragmas(profile) if isinstance(profile, str) else profile
+        previous = []
+        for pragma, value in pragmas:
+            previous.append((pragma, self.dc.execute('PRAGMA {}'.format(pragma)).fetchone()[0]))
+            self.dc.execute('PRAGMA {}={}'.format(pragma, value))
+        return previous
+
+    # context manager for loading lots of data:
+    #   with dbo.bulk_load(defer=('vcfcalls',)):
+    #       ...
+    # Work done before is committed, and the block runs in one transaction
+    # with the bulk profile. The indexes of the tables in defer are dropped
+    # at the start and built again at the end, which is much faster than
+    # updating them row by row. At the end of the block the indexes are
+    # rebuilt, the transaction is committed and the previous PRAGMAs are
+    # restored. If the block raises, the transaction is rolled back, with
+    # the files staged in it (see stage_file).
+    # The definitions of dropped indexes are kept in meta until they are
+    # rebuilt, so that restore_indexes can rebuild them if a load commits
+    # part way and then fails.
+    @contextmanager
+    def bulk_load(self, defer=()):
+        self.commit()
+        previous = self.use_profile('bulk')
+        try:
+            self.dc.execute('begin')
+            if defer:
+                with span('drop indexes'):
+                    self.defer_indexes(defer)
+            yield self
+            if defer:
+                self.restore_indexes()
+            self.commit()
+        except:
+            self.rollback()
+            if defer:
+                self.restore_indexes()
+                self.commit()
+            raise
+        finally:
+            self.use_profile(previous)
+
+    # drop the indexes of tables, remembering their definitions in meta
+    def defer_indexes(self, tables):
+        marks = ','.join('?' * len(tables))
+        indexes = self.dc.execute('''select name, sql from sqlite_master
+                                     where type='index' and sql is not null
+                                     and tbl_name in ({})'''.format(marks),
+                                  tuple(tables)).fetchall()
+        for name, sql in indexes:
+            self.dc.execute('insert into meta(descr,val) values(?,?)',
+                            ('deferred_index', sql))
+            self.dc.execute('drop index {}'.format(name))
+
+    # build the indexes dropped by defer_indexes again
+    def restore_indexes(self):
+        deferred = self.dc.execute('''select rowid, val from meta
+                                      where descr='deferred_index' ''').fetchall()
+        if deferred:
+            with span('create indexes'):
+                for rowid, sql in deferred:
+                    self.dc.execute(sql)
+                    self.dc.execute('delete from meta where rowid=?', (rowid,))
+
+    # refresh the statistics of the query planner: PRAGMA optimize, which
+    # only analyzes tables whose statistics are missing or out of date, or
+    # with analyze, all tables (after loading lots of data)
+    def optimize(self, analyze=False):
+        self.dc.execute('ANALYZE' if analyze else 'PRAGMA optimize')
+        self.commit()
+
+    # switch to the query profile for reading: rebuild any deferred
+    # indexes, refresh the planner statistics (see optimize) and let other
+    # connections read through the write-ahead log
+    def query_mode(self, analyze=False):
+        self.restore_indexes()
+        self.commit()
+        self.use_profile('query')
+        self.optimize(analyze)
+
+    # the VariantCache for this database, created on first use
+    def variant_cache(self):
+        if self.vcache is None:
+            self.vcache = VariantCache(self)
+        return self.vcache
+
+    # forget cached variant IDs; needed after inserting alleles or variants
+    # with plain SQL
+    def reset_variant_cache(self):
+        self.vcache = None
+
     # insert an array of variants into variant definitions table
     # This procedure takes a list or iterator in variant_array, which are
     # pos,anc,der tuples and inserts these into the variants table.  if there
-    # are duplicates in variant_array, they are not inserted due to the unique
-    # constraint on the variants table.
+    # are duplicates in variant_array, they are only inserted once.
+    # returns the variant ids, in the same order as variant_array
     def insert_variants(self, variant_array, buildname='hg38'):
-        bid = get_build_byname(self.db, buildname)
-        alleles = set([v[1] for v in variant_array] + [v[2] for v in variant_array])
-        for allele in [a.strip() for a in alleles]:
-            db.dc.execute('insert or ignore into alleles(allele) values(?)', (allele,))
-        # fixme? may need optimization
-        self.dc.executemany('''
-            INSERT OR IGNORE INTO variants(buildID,pos,anc,der)
-            select b.ID, v.pos, aa.id, ab.id
-            from variants v
-            cross join build b on b.buildNm=?
-            cross join allele ab on ab.allele=?
-            cross join allele aa on aa.allele=?''',
-            [(bid,)+v for v in variant_array])
+        bid = get_build_byname(self, buildname)
+        variant_array = list(variant_array)
+        return self.variant_cache().variant_ids(bid,
+            [v[0] for v in variant_array],
+            [v[1].strip() for v in variant_array],
+            [v[2].strip() for v in variant_array])
 
     # insert a vector of variant ids to insert for a given person specified by
     # pID. This procedure inserts ids into the "calls" table and operates with
-    # variant ids (i.e. you already have the variant ids)
-    def insert_calls(self, pid, calls):
-        self.dc.executemany('INSERT INTO vcfcalls(pID,vID) values (?,?)',
+    # variant ids (i.e. you already have the variant ids). callinfo is an
+    # optional vector of packed call information, one per variant id
+    def insert_calls(self, pid, calls, callinfo=None):
+        if callinfo is None:
+            self.dc.executemany('INSERT INTO vcfcalls(pID,vID) values (?,?)',
                                 [(pid,v) for v in calls])
+        else:
+            self.dc.executemany('INSERT INTO vcfcalls(pID,vID,callinfo) values (?,?,?)',
+                                [(pid,v,c) for v,c in zip(calls, callinfo)])
 
 
 
@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# build the haplotree from the call matrix (see callmatrix.py)
+#
+# This is the algorithm sketched in examples/fakeHaplotreeCode.py:
+#  - per-variant statistics (first and last positive kit, counts of each call
+#    class) are computed for all variants at once
+#  - variants with no more negative calls than a clade of all kits tolerates
+#    go to the root clade; those negative calls are junked
+#  - the shared variants (two or more positive kits) are placed in order of
+#    descending number of positive calls, so well-called variants come first
+#    and the worse-called ones walk into place later
+#  - a variant whose positive kits all lie in one clade is either equivalent
+#    to that clade (no negative kit in it) or splits off a new child clade;
+#    one whose positive kits span several child clades forms a new clade
+#    above them, if no kit of those clades is negative
+#  - a variant that fits nowhere is recurrent if it occurs in at most
+#    max_recur_abs (and fewer than nkits/max_recur_rate) branches, and is
+#    placed in each of them; otherwise its positive calls are junked
+# A few negative calls inside a clade are tolerated as back mutations
+# (back_mut_tol_abs, and at most back_mut_tol_perc of the clade).
+#
+# Each kit's path from the root is kept in a kits x depth array, so that the
+# kits of any clade's subtree are found with one vectorized comparison.
+# Variants with identical kit sets (see bitset.py) are placed only once.
+# Positive calls are the call codes 4 and up (mixed or positive, passed or
+# failed); negative calls are codes 1 to 3.
+
+import numpy as np
+from callmatrix import CALL_MASK, CALL_FAILMIXED, CALL_MIXED, \
+    ASSIGN_JUNK, ASSIGN_NEG, ASSIGN_POS, ASSIGN_MASK
+from bitset import KitSets, group_rows
+from treeio import encode, read_tree, set_tree_encoding
+from reduxconfig import config
+from runstats import timed
+
+# columns of the per-variant statistics of variant_stats
+VSTAT_PFIRST = 0        # first and last kit, in kit order, with a passed
+VSTAT_PLAST = 1         # positive or mixed call
+VSTAT_ALLFIRST = 2      # first and last kit with any positive or mixed call
+VSTAT_ALLLAST = 3
+VSTAT_COUNTS = 4        # 8 columns: number of kits with call code 0..7
+VSTAT_ASSIGNED = 12     # 4 columns: number of kits with assignment 0..3
+VSTAT_NCOLS = 16
+
+
+# per-variant statistics of a dense call matrix (variants x kits), as an
+# int32 array with VSTAT_NCOLS columns (getAllPersonRanges)
+# order is the kit sort order; first and last are -1 for no such kit
+def variant_stats(calls, order=None):
+    if order is not None:
+        calls = calls[:, order]
+    nvar, nkits = calls.shape
+    stats = np.zeros((nvar, VSTAT_NCOLS), dtype=np.int32)
+    codes = calls & CALL_MASK
+    for col, low in ((VSTAT_PFIRST, CALL_MIXED), (VSTAT_ALLFIRST, CALL_FAILMIXED)):
+        hit = codes >= low
+        anyhit = hit.any(axis=1)
+        stats[:, col] = np.where(anyhit, hit.argmax(axis=1), -1)
+        stats[:, col+1] = np.where(anyhit, nkits - 1 - hit[:, ::-1].argmax(axis=1), -1)
+    for code in range(8):
+        stats[:, VSTAT_COUNTS+code] = (codes == code).sum(axis=1)
+    assigned = (calls >> 4) & 3
+    for a in range(4):
+        stats[:, VSTAT_ASSIGNED+a] = (assigned == a).sum(axis=1)
+    return stats
+
+
+# the result of build_tree
+# Clades are numbered from 0, the root; parent[0] is -1. variants[c] holds the
+# call matrix rows of the variants of clade c, kitclade the deepest clade of
+# each kit (columns of the call matrix), and calls the call matrix with the
+# assignment bits set.
+class HaploTree(object):
+
+    def __init__(self, cm, calls, parent, variants, kitclade, stats,
+                 recurrent, junk):
+        self.cm = cm
+        self.calls = calls
+        self.parent = np.asarray(parent, dtype=np.int32)
+        self.variants = variants
+        self.kitclade = kitclade
+        self.stats = stats
+        self.recurrent = recurrent
+        self.junk = junk
+
+    @property
+    def nclades(self):
+        return len(self.parent)
+
+    def children(self, clade):
+        return np.flatnonzero(self.parent == clade)
+
+    # clades from the root down to clade
+    def lineage(self, clade):
+        path = []
+        while clade >= 0:
+            path.append(clade)
+            clade = self.parent[clade]
+        return path[::-1]
+
+
+# the placement state of build_tree
+class _Placement(object):
+
+    def __init__(self, codes, tolabs, tolperc):
+        nkits = codes.shape[1]
+        self.codes = codes
+        self.tolabs = tolabs
+        self.tolperc = tolperc
+        self.parent = [-1]
+        self.depth = [0]
+        self.variants = [[]]
+        # path[k, d] is the clade at depth d above kit k, -1 below its leaf
+        self.path = np.full((nkits, 16), -1, dtype=np.int32)
+        self.path[:, 0] = 0
+        self.leaf = np.zeros(nkits, dtype=np.int32)
+        self.kdepth = np.zeros(nkits, dtype=np.int32)
+
+    # whether nneg negative calls in a clade of size kits are back mutations;
+    # nneg may be an array
+    def tolerable(self, nneg, size):
+        return (nneg == 0) | ((nneg <= self.tolabs) & (nneg <= self.tolperc*size))
+
+    # bool vector of the kits in the subtree of a clade
+    def subtree(self, clade):
+        return self.path[:, self.depth[clade]] == clade
+
+    def new_clade(self, parent, vrow):
+        self.parent.append(parent)
+        self.depth.append(self.depth[parent] + 1)
+        self.variants.append([vrow])
+        if self.depth[-1] + 2 > self.path.shape[1]:
+            self.path = np.hstack((self.path, np.full_like(self.path, -1)))
+        return len(self.parent) - 1
+
+    # place variant vrow with positive kits P; neg is the bool vector of its
+    # negative kits
+    # returns the clade the variant was placed in, or None
+    def place(self, vrow, P, neg):
+        while True:
+            lcad, below = self._common(P)
+            lca = int(self.path[P[0], lcad])
+            sub = self.subtree(lca)
+            if self.tolerable(np.count_nonzero(neg & sub), np.count_nonzero(sub)):
+                # equivalent to the common clade
+                self.variants[lca].append(vrow)
+                return lca
+            children = np.unique(below[below >= 0])
+            direct = P[below < 0]
+            # kits that were not called for the variants of the one child
+            # clade the other positive kits are in join that clade
+            if len(children) != 1 or not len(direct) or not self._joins(int(children[0]), direct):
+                break
+            self.path[direct, lcad+1] = children[0]
+            self.leaf[direct] = children[0]
+            self.kdepth[direct] = lcad + 1
+        if len(children) == 0:
+            # a new child clade of the positive kits' clade
+            n = self.new_clade(lca, vrow)
+            self.path[direct, lcad+1] = n
+            self.leaf[direct] = n
+            self.kdepth[direct] = lcad + 1
+            return n
+        inside = np.isin(self.path[:, lcad+1], children)
+        inside[direct] = True
+        if not self.tolerable(np.count_nonzero(neg & inside), np.count_nonzero(inside)):
+            return None
+        # a new clade above the child clades that the positive kits are in
+        n = self.new_clade(lca, vrow)
+        for c in children.tolist():
+            self.parent[c] = n
+        kits = np.flatnonzero(inside)
+        if self.kdepth[kits].max() + 2 > self.path.shape[1]:
+            self.path = np.hstack((self.path, np.full_like(self.path, -1)))
+        moved = self.path[kits, lcad+1:-1]
+        for c in np.unique(moved[moved >= 0]).tolist():
+            self.depth[c] += 1
+        self.path[kits, lcad+2:] = moved
+        self.path[kits, lcad+1] = n
+        self.kdepth[kits] += 1
+        self.leaf[direct] = n
+        return n
+
+    # depth of the deepest clade common to the kits P, and the clade below
+    # it on the path of each kit (-1 for kits whose leaf is the common clade)
+    def _common(self, P):
+        paths = self.path[P, :self.kdepth[P].max()+2]
+        same = (paths == paths[0]).all(axis=0) & (paths[0] >= 0)
+        lcad = int(np.argmin(same)) - 1
+        return lcad, paths[:, lcad+1]
+
+    # whether none of the kits is negative for the variants of a clade
+    def _joins(self, clade, kits):
+        codes = self.codes[np.ix_(self.variants[clade], kits)]
+        return not ((codes >= 1) & (codes < CALL_FAILMIXED)).any()
+
+    # the groups of P that lie in different child clades of their common
+    # clade, for placing a recurrent variant in each
+    def branches(self, P):
+        lcad, below = self._common(P)
+        groups = [P[below == c] for c in np.unique(below[below >= 0]).tolist()]
+        if (below < 0).any():
+            groups.append(P[below < 0])
+        return groups
+
+
+# the order in which build_tree places variant rows, given their groups of
+# identical kit sets and their numbers of positive and passed positive calls:
+# by descending npos, then by the best npass of their group, keeping each
+# group together with its best-passed member first
+def _placement_order(rows, group, npos, npass):
+    best = np.zeros(group.max(initial=-1) + 1, dtype=np.int64)
+    np.maximum.at(best, group, npass)
+    return rows[np.lexsort((rows, -npass, group, -best[group], -npos))]
+
+# build the tree of the call matrix cm (a callmatrix.CallMatrix)
+@timed('build tree')
+def build_tree(cm, tolabs=None, tolperc=None, recurabs=None, recurrate=None):
+    from lib import trace
+    if tolabs is None:
+        tolabs = config['back_mut_tol_abs']
+    if tolperc is None:
+        tolperc = config['back_mut_tol_perc']
+    if recurabs is None:
+        recurabs = config['max_recur_abs']
+    if recurrate is None:
+        recurrate = config['max_recur_rate']
+    # the assignments are made here; the other bits, such as CALL_IMPLIED,
+    # are kept
+    calls = np.array(cm.toarray(), dtype=np.int8) & ~ASSIGN_MASK
+    nvar, nkits = calls.shape
+    codes = calls & CALL_MASK
+    stats = variant_stats(calls)
+    counts = stats[:, VSTAT_COUNTS:VSTAT_COUNTS+8]
+    npos = counts[:, CALL_FAILMIXED:].sum(axis=1)
+    npass = counts[:, CALL_MIXED:].sum(axis=1)
+    nneg = counts[:, 1:CALL_FAILMIXED].sum(axis=1)
+    trace(1, 'tree of {} variants x {} kits'.format(nvar, nkits))
+
+    state = _Placement(codes, tolabs, tolperc)
+    # (nearly) no kit is negative: the variant defines the root clade, and
+    # its negative calls are junked
+    universal = (npos >= 2) & state.tolerable(nneg, nkits)
+    for v in np.flatnonzero(universal).tolist():
+        state.variants[0].append(v)
+        neg = (codes[v] >= 1) & (codes[v] < CALL_FAILMIXED)
+        calls[v] = calls[v] | np.where(neg, ASSIGN_JUNK, ASSIGN_POS).astype(np.int8)
+
+    shared = np.flatnonzero((npos >= 2) & ~universal)
+    # variants with the same positive and negative kits are placed one after
+    # the other; all but the first go straight to the first one's clade
+    sets = KitSets.from_calls(codes[shared])
+    group = group_rows(sets.pos, sets.neg)
+    order = _placement_order(shared, group, npos[shared], npass[shared])
+    group = dict(zip(shared.tolist(), group.tolist()))
+    recurrent = {}
+    junk = []
+    last = (None, None)
+    for nv, v in enumerate(order.tolist()):
+        row = codes[v]
+        P = np.flatnonzero(row >= CALL_FAILMIXED)
+        neg = (row >= 1) & (row < CALL_FAILMIXED)
+        if last[1] is not None and last[0] == group[v]:
+            clade = last[1]
+            state.variants[clade].append(v)
+        else:
+            clade = state.place(v, P, neg)
+        last = (group[v], clade)
+        if clade is not None:
+            clades = [clade]
+        else:
+            groups = state.branches(P)
+            if len(groups) <= recurabs and len(groups) < nkits/recurrate:
+                clades = [state.place(v, g, neg) for g in groups]
+                recurrent[v] = [c for c in clades if c is not None]
+                clades = recurrent[v]
+            else:
+                clades = []
+            last = (None, None)
+        if not clades:
+            junk.append(v)
+            calls[v] = calls[v] | np.where(row >= CALL_FAILMIXED, ASSIGN_JUNK, 0).astype(np.int8)
+            continue
+        inside = np.zeros(nkits, dtype=bool)
+        for c in clades:
+            inside |= state.subtree(c)
+        calls[v] = calls[v] | np.where(inside & ~neg, ASSIGN_POS, ASSIGN_NEG).astype(np.int8)
+        if nv % 5000 == 4999:
+            trace(2, '{} of {} variants placed, {} clades'.format(
+                nv+1, len(order), len(state.parent)))
+
+    trace(1, '{} clades, {} recurrent and {} junk variants'.format(
+        len(state.parent), len(recurrent), len(junk)))
+    variants = [np.array(v, dtype=np.int64) for v in state.variants]
+    return HaploTree(cm, calls, state.parent, variants, state.leaf, stats,
+                     recurrent, junk)
+
+
+# clade names: the first name of one of the clade's variants, else the
+# position of its first variant; the root is named after top_snp
+def clade_names(dbo, tree):
+    vids = tree.cm.vids
+    first = {}
+    for clade, rows in enumerate(tree.variants):
+        for v in vids[rows].tolist():
+            first.setdefault(v, clade)
+    names = {}
+    allvids = list(first.keys())
+    for start in range(0, len(allvids), 500):
+        part = allvids[start:start+500]
+        for vid, name in dbo.dc.execute('''select vID, snpname from snpnames
+                                           where vID in ({})
+                                           order by snpname'''.format(
+                                               ','.join('?'*len(part))), part):
+            names.setdefault(first[vid], name)
+    result = []
+    for clade, rows in enumerate(tree.variants):
+        if clade in names:
+            result.append(names[clade][:16])
+        elif clade == 0:
+            result.append(config['top_snp'])
+        elif len(rows):
+            result.append(str(int(tree.cm.positions[rows[0]])))
+        else:
+            result.append('')
+    return result
+
+# store a tree in the tree and treekits tables, replacing what is there
+# Clade c is stored with id c+1. variants and children are arrays of variant
+# IDs and clade ids; qualities is the percentage of positive calls of each
+# variant that passed (see treeio.py for the encoding). All clades are
+# marked dirty.
+@timed('store tree')
+def store_tree(dbo, tree):
+    dc = dbo.cursor()
+    dc.execute('delete from tree')
+    dc.execute('delete from treekits')
+    ids = np.arange(tree.nclades) + 1
+    names = clade_names(dbo, tree)
+    dc.executemany('''insert into tree(id,parendid,clade,variants,qualities,children,dirty)
+                      values(?,?,?,?,?,?,1)''', _tree_rows(tree, ids, None, names))
+    dc.executemany('insert into treekits(pID,cladeID) values(?,?)',
+                   zip(tree.cm.pids.tolist(), ids[tree.kitclade].tolist()))
+    dc.close()
+    set_tree_encoding(dbo)
+
+# tree table rows (id, parent id, name, variants, qualities, children) of the
+# clades of a tree, stored with the ids given; the root's parent is rootparent
+def _tree_rows(tree, ids, rootparent, names):
+    counts = tree.stats[:, VSTAT_COUNTS:VSTAT_COUNTS+8]
+    npos = np.maximum(counts[:, CALL_FAILMIXED:].sum(axis=1), 1)
+    quality = (100 * counts[:, CALL_MIXED:].sum(axis=1) // npos).astype(np.uint8)
+    rows = []
+    for clade in range(tree.nclades):
+        rowidx = tree.variants[clade]
+        parent = int(tree.parent[clade])
+        rows.append((int(ids[clade]), int(ids[parent]) if parent >= 0 else rootparent,
+                     names[clade], encode('variants', tree.cm.vids[rowidx]),
+                     encode('qualities', quality[rowidx]),
+                     encode('children', ids[tree.children(clade)])))
+    return rows
+
+# build the tree of all kits from their shared variants and store it
+@timed('make tree')
+def make_tree(dbo):
+    from callmatrix import build_call_matrix
+    from implications import apply_implications
+    cm = build_call_matrix(dbo)
+    apply_implications(dbo, cm)
+    tree = build_tree(cm)
+    store_tree(dbo, tree)
+    dbo.commit()
+    return tree
+
+
+# the stored tree, as arrays of clade ids and parent ids (0 for the root),
+# and a list of the variant IDs of each clade, in id order
+def load_tree(dbo):
+    tree = read_tree(dbo)
+    return tree.ids, tree.parents, tree.variant_list()
+
+# ids of the clades of the subtree of clade, including clade itself
+def _subtree_ids(ids, parents, clade):
+    inside = ids == clade
+    while True:
+        more = inside | np.isin(parents, ids[inside])
+        if (more == inside).all():
+            return ids[inside]
+        inside = more
+
+# walk kits down the stored tree; returns the id of the clade each kit of
+# cm's columns stops at
+# A kit moves into the child clade that it has positive calls for, and no
+# negative calls, among the child's variants. It stops at a clade if no child
+# qualifies, if several do, or if it is both positive and negative for the
+# variants of a child, which then has to be split.
+def walk_kits(cm, ids, parents, variants):
+    codes = cm.toarray() & CALL_MASK
+    pos = codes >= CALL_FAILMIXED
+    neg = (codes >= 1) & (codes < CALL_FAILMIXED)
+    rows = [cm.variant_index(v) for v in variants]
+    rows = [r[r >= 0] for r in rows]
+    npos = np.array([pos[r].sum(axis=0) for r in rows]).reshape(len(ids), -1)
+    nneg = np.array([neg[r].sum(axis=0) for r in rows]).reshape(len(ids), -1)
+    index = dict(zip(ids.tolist(), range(len(ids))))
+    children = {c: [index[x] for x in ids[parents == c].tolist()] for c in ids.tolist()}
+    root = int(ids[parents == 0][0])
+    land = np.full(len(cm.pids), root, dtype=np.int64)
+    for col in range(len(cm.pids)):
+        clade = root
+        while True:
+            kids = children[clade]
+            into = [c for c in kids if npos[c, col] and not nneg[c, col]]
+            split = [c for c in kids if npos[c, col] and nneg[c, col]]
+            if len(into) != 1 or split:
+                break
+            clade = int(ids[into[0]])
+        land[col] = clade
+    return land
+
+# place kits that are not in the stored tree yet (default: all kits with calls
+# but no treekits row) into it, building the tree if there is none
+# Each kit is walked down the tree (walk_kits). The subtree of the clade
+# where it stops is then built again from the kits in it, including the new
+# ones, so that new private variants shared with kits already there form new
+# clades; the rest of the tree is left alone. Rebuilt clades and their
+# ancestors are marked dirty.
+# returns the ids of the rebuilt subtrees' top clades
+@timed('place kits')
+def place_kits(dbo, pids=None):
+    from lib import trace
+    from callmatrix import build_call_matrix
+    from implications import apply_implications
+    from kitstore import call_store
+    ids, parents, variants = load_tree(dbo)
+    if not len(ids):
+        make_tree(dbo)
+        return [1]
+    kitclade = dict(dbo.dc.execute('select pID, cladeID from treekits'))
+    if pids is None:
+        pids = call_store(dbo).kit_ids()
+    pids = [p for p in pids if p not in kitclade]
+    if not pids:
+        return []
+    allvids = np.unique(np.concatenate(variants))
+    cm = build_call_matrix(dbo, pids, vids=allvids)
+    apply_implications(dbo, cm)
+    land = walk_kits(cm, ids, parents, variants)
+    # only the top-most clades of those landed at need rebuilding
+    tops = []
+    for clade in sorted(set(land.tolist())):
+        if not any(clade in _subtree_ids(ids, parents, t).tolist() for t in tops):
+            tops = [t for t in tops if t not in _subtree_ids(ids, parents, clade).tolist()]
+            tops.append(clade)
+    for top in tops:
+        sub = _subtree_ids(ids, parents, top)
+        kits = [p for p, c in kitclade.items() if c in sub.tolist()]
+        kits += [p for p, c in zip(cm.pids.tolist(), land.tolist()) if c in sub.tolist()]
+        outside = np.concatenate([v for i, v in zip(ids.tolist(), variants)
+                                  if i not in sub.tolist()] + [np.zeros(0, np.int32)])
+        trace(1, 'rebuilding clade {} with {} kits'.format(top, len(kits)))
+        _rebuild_subtree(dbo, top, sub, kits, outside)
+    dbo.commit()
+    return tops
+
+# build the subtree of clade top again from kits, leaving out the variants of
+# clades outside it, and replace it in the tree and treekits tables
+def _rebuild_subtree(dbo, top, sub, kits, outside):
+    from callmatrix import build_call_matrix, CallMatrix
+    from implications import apply_implications
+    cm = build_call_matrix(dbo, kits)
+    keep = np.flatnonzero(~np.isin(cm.vids, outside))
+    cm = CallMatrix(cm.vids[keep], cm.positions[keep], cm.pids, cm.take(keep))
+    apply_implications(dbo, cm)
+    tree = build_tree(cm)
+    dc = dbo.cursor()
+    parent, name = dc.execute('select parendid, clade from tree where id=?',
+                              (top,)).fetchone()
+    old = [c for c in sub.tolist() if c != top]
+    for start in range(0, len(old), 500):
+        part = old[start:start+500]
+        dc.execute('delete from tree where id in ({})'.format(','.join('?'*len(part))), part)
+    for start in range(0, len(kits), 500):
+        part = kits[start:start+500]
+        dc.execute('delete from treekits where pID in ({})'.format(','.join('?'*len(part))), part)
+    nextid = dc.execute('select max(id) from tree').fetchone()[0] + 1
+    ids = np.concatenate(([top], np.arange(nextid, nextid + tree.nclades - 1)))
+    names = clade_names(dbo, tree)
+    names[0] = name
+    rows = _tree_rows(tree, ids, parent, names)
+    dc.execute('''update tree set variants=?, qualities=?, children=?, dirty=1
+                  where id=?''', rows[0][3:] + (top,))
+    dc.executemany('''insert into tree(id,parendid,clade,variants,qualities,children,dirty)
+                      values(?,?,?,?,?,?,1)''', rows[1:])
+    dc.executemany('insert into treekits(pID,cladeID) values(?,?)',
+                   zip(tree.cm.pids.tolist(), ids[tree.kitclade].tolist()))
+    # the ancestors of top have new kits below them
+    while parent:
+        dc.execute('update tree set dirty=1 where id=?', (parent,))
+        parent, = dc.execute('select parendid from tree where id=?', (parent,)).fetchone()
+    dc.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# the rules of implications.txt, applied to the call matrix
+#
+# A rule line is
+#   A > B : names            a kit positive for A is positive for B
+#   A & C > B : names        a kit positive for A and C is positive for B
+# where A, B and C are positions in implications_build and the names are
+# only a comment. As in the "presumed positives" step of redux.bash, a rule
+# applies whatever the kit's call for B is, and a conjunct C that no variant
+# of the call matrix is at counts as positive. Two other kinds of line are
+# kept in the table but not applied here:
+#   ^ pos name anc der       a variant that no test calls, to be inserted
+#   < pos name anc der       a variant that is positive in the reference
+#
+# The rules are read once into the implications table. To apply them, they
+# are compiled against the positions of a call matrix: each rule becomes
+# three indexes into an array of per-position kit bitsets (bitset.py), and
+# the rules are sorted into levels so that a rule comes after the rules that
+# imply its A or C. A level is then one AND and one OR over all of its rules
+# and all kits; levels are repeated until nothing changes, which takes one
+# pass unless rules form a cycle.
+
+import re
+import numpy as np
+from callmatrix import CALL_POS, CALL_IMPLIED
+from bitset import KitSets, unpack, popcount
+from reduxconfig import config
+from runstats import timed
+
+# rule kinds
+RULE_IMPLIES = '>'
+RULE_INSERT = '^'
+RULE_REFPOS = '<'
+
+MAX_LEVELS = 64
+
+
+# parse the lines of implications.txt
+# returns tuples (kind, pos, ifpos1, ifpos2, anc, der, names); ifpos1 and
+# ifpos2 are None except for RULE_IMPLIES, anc and der for that kind
+# Comments (#) and lines that do not start with a position are skipped, as
+# redux.bash does.
+def parse_implications(lines):
+    rules = []
+    for line in lines:
+        line = line.split('#')[0]
+        if ':' in line:
+            line, names = line.split(':', 1)
+            names = names.strip()
+        else:
+            names = ''
+        toks = re.findall(r'&|>|[^\s&>]+', line)
+        if not toks:
+            continue
+        if toks[0] in (RULE_INSERT, RULE_REFPOS):
+            if len(toks) >= 5 and toks[1].isdigit():
+                rules.append((toks[0], int(toks[1]), None, None, toks[3], toks[4], toks[2]))
+            continue
+        if not toks[0].isdigit():
+            continue
+        if len(toks) >= 3 and toks[1] == '>' and toks[2].isdigit():
+            rules.append((RULE_IMPLIES, int(toks[2]), int(toks[0]), None, None, None, names))
+        elif (len(toks) >= 5 and toks[1] == '&' and toks[3] == '>' and
+              toks[2].isdigit() and toks[4].isdigit()):
+            rules.append((RULE_IMPLIES, int(toks[4]), int(toks[0]), int(toks[2]),
+                          None, None, names))
+    return rules
+
+# read implications.txt into the implications table, replacing what is there
+def populate_implications(dbo, fname=None, buildname=None):
+    from lib import trace
+    from array_api import get_build_byname
+    if fname is None:
+        fname = config['implications_file']
+    if buildname is None:
+        buildname = config['implications_build']
+    trace(1, 'populate implications table')
+    with open(fname) as implfile:
+        rules = parse_implications(implfile)
+    bid = get_build_byname(dbo, buildname)
+    dbo.dc.execute('delete from implications')
+    dbo.dc.executemany('''insert into implications(kind,buildID,pos,ifpos1,ifpos2,
+                                                   anc,der,names)
+                          values(?,?,?,?,?,?,?,?)''',
+                       [(r[0], bid) + r[1:] for r in rules])
+
+# the implication rules of the table, with positions mapped to build
+# buildname, as int64 arrays b, a and c; c is -1 for rules without a conjunct
+def get_rules(dbo, buildname='hg38'):
+    from lib import trace
+    from array_api import get_build_byname
+    bid = get_build_byname(dbo, buildname)
+    rows = dbo.dc.execute('''select buildID, pos, ifpos1, coalesce(ifpos2,-1)
+                             from implications where kind=?''',
+                          (RULE_IMPLIES,)).fetchall()
+    rules = np.array([r[1:] for r in rows], dtype=np.int64).reshape(-1, 3)
+    for rbid in set(r[0] for r in rows) - {bid}:
+        mine = np.array([r[0] == rbid for r in rows])
+        posmap = _position_map(dbo, rbid, bid)
+        mapped = np.vectorize(lambda p: posmap.get(p, -2 if p >= 0 else -1),
+                              otypes=[np.int64])(rules[mine]) if mine.any() else rules[mine]
+        rules[mine] = mapped
+    keep = (rules[:, :2] >= 0).all(axis=1) & (rules[:, 2] != -2)
+    if not keep.all():
+        trace(1, '{} implications have positions with no SNP name in {}'.format(
+            np.count_nonzero(~keep), buildname))
+    rules = rules[keep]
+    return rules[:, 0], rules[:, 1], rules[:, 2]
+
+# positions of build frombid to positions of build tobid, by SNP name
+def _position_map(dbo, frombid, tobid):
+    posmap = {}
+    for src, dst in dbo.dc.execute('''select distinct a.pos, b.pos from variants a
+                                      inner join snpnames sa on sa.vID=a.ID
+                                      inner join snpnames sb on sb.snpname=sa.snpname
+                                      inner join variants b on b.ID=sb.vID
+                                      where a.buildID=? and b.buildID=?''',
+                                   (frombid, tobid)):
+        posmap.setdefault(src, dst)
+    return posmap
+
+
+# implication rules compiled against the sorted positions of a call matrix
+# Rules are indexes into the distinct positions (slots); slot nslots is
+# always positive and stands in for a missing conjunct. Rules whose A or B is
+# at no position of the matrix are dropped.
+class CompiledRules(object):
+
+    def __init__(self, b, a, c, positions):
+        self.slots, self.first = np.unique(positions, return_index=True)
+        self.nslots = len(self.slots)
+        bs, as_, cs = self._slot(b), self._slot(a), self._slot(c)
+        keep = (bs >= 0) & (as_ >= 0)
+        cs = np.where(cs >= 0, cs, self.nslots)
+        self.b, self.a, self.c = bs[keep], as_[keep], cs[keep]
+        level = self._levels()
+        order = np.argsort(level, kind='stable')
+        self.b, self.a, self.c = self.b[order], self.a[order], self.c[order]
+        # rules of level i are [bounds[i], bounds[i+1])
+        self.bounds = np.searchsorted(level[order], np.arange(level.max(initial=-1) + 2))
+
+    def __len__(self):
+        return len(self.b)
+
+    # slot of each position, -1 for positions not in the matrix
+    def _slot(self, pos):
+        ii = np.minimum(np.searchsorted(self.slots, pos), max(self.nslots - 1, 0))
+        if not self.nslots:
+            return np.full(len(pos), -1, dtype=np.int64)
+        return np.where(self.slots[ii] == pos, ii, -1)
+
+    # the level of each rule: 0 if no rule implies its A or C, else one more
+    # than the highest level of those rules; levels stop growing after
+    # MAX_LEVELS rounds, for rules that form cycles, which apply then repeats
+    def _levels(self):
+        level = np.zeros(len(self.b), dtype=np.int64)
+        self.acyclic = False
+        for _ in range(min(len(self.b), MAX_LEVELS) + 1):
+            slotlevel = np.full(self.nslots + 1, -1, dtype=np.int64)
+            np.maximum.at(slotlevel, self.b, level)
+            new = np.maximum(slotlevel[self.a], slotlevel[self.c]) + 1
+            if (new == level).all():
+                self.acyclic = True
+                break
+            level = new
+        return level
+
+    # apply the rules to the per-slot positive bitsets, until a fixpoint;
+    # without cycles, that is after the first pass
+    # returns the number of passes
+    def apply(self, bits):
+        passes = 0
+        while True:
+            passes += 1
+            before = popcount(bits[self.b]).sum()
+            for lo, hi in zip(self.bounds[:-1].tolist(), self.bounds[1:].tolist()):
+                if lo < hi:
+                    implied = np.bitwise_and(bits[self.a[lo:hi]], bits[self.c[lo:hi]])
+                    np.bitwise_or.at(bits, self.b[lo:hi], implied)
+            if self.acyclic or popcount(bits[self.b]).sum() == before:
+                return passes
+
+
+# apply the implication rules to a call matrix (callmatrix.CallMatrix)
+# A kit that a rule makes positive for position B gets CALL_POS|CALL_IMPLIED
+# for the variant at B with the most positive calls. A sparse matrix is made
+# dense first.
+# returns the number of calls implied
+@timed('implications')
+def apply_implications(dbo, cm, buildname='hg38'):
+    from lib import trace
+    rules = CompiledRules(*get_rules(dbo, buildname), positions=cm.positions)
+    if not len(rules):
+        return 0
+    if cm.sparse:
+        cm.calls = cm.toarray()
+        cm.coverage = None
+    sets = KitSets.from_calls(cm.calls)
+    # per-slot bitsets: the matrix rows are sorted by position
+    bits = np.bitwise_or.reduceat(sets.pos, rules.first, axis=0)
+    bits = np.vstack((bits, np.full((1, bits.shape[1]), ~np.uint64(0))))
+    before = bits.copy()
+    passes = rules.apply(bits)
+    added = np.bitwise_and(bits[:-1], np.bitwise_not(before[:-1]))
+    slots = np.flatnonzero(added.any(axis=1))
+    npos = popcount(sets.pos)
+    ends = np.append(rules.first[1:], len(cm.positions))
+    count = 0
+    for s in slots.tolist():
+        lo, hi = rules.first[s], ends[s]
+        row = lo + int(np.argmax(npos[lo:hi]))
+        kits = unpack(added[s], cm.shape[1])
+        cm.calls[row, kits] = CALL_POS | CALL_IMPLIED
+        count += np.count_nonzero(kits)
+    trace(1, '{} rules implied {} calls in {} passes'.format(len(rules), count, passes))
+    return count
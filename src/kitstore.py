@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# per-kit storage of calls and BED ranges as sorted arrays instead of one
+# row per call or range
+#
+# The call store is selected with call_store in config.yaml:
+#   table - one vcfcalls(pID, vID, callinfo) row per call (the original)
+#   blob  - per kit, a sorted int32 array of variant IDs and a matching uint32
+#           array of callinfo, stored as BLOBs in the kitarrays table
+#   npy   - the same arrays as .npy files under kit_array_dir, memory-mapped
+#           when read
+# Every call store has the same access routines: put_calls, get_calls,
+# delete_calls and kit_ids.
+#
+# The BED store is selected with bed_store in config.yaml, with the same
+# choices: table (the bedranges and bed tables) or sorted int32 arrays of
+# range starts and ends in blob or npy form. BED stores have put_ranges,
+# get_ranges, delete_ranges and kit_ids.
+
+import os
+import numpy as np
+from reduxconfig import config
+
+
+# named numpy arrays per kit, stored as BLOBs in the kitarrays table
+class BlobArrayStore(object):
+
+    def __init__(self, dbo):
+        self.dbo = dbo
+
+    def put(self, pid, name, arr):
+        arr = np.ascontiguousarray(arr)
+        self.dbo.dc.execute('''insert or replace into kitarrays(pID,name,dtype,data)
+                               values(?,?,?,?)''',
+                            (pid, name, arr.dtype.str, arr.tobytes()))
+
+    # returns None if the kit has no such array
+    def get(self, pid, name):
+        row = self.dbo.dc.execute('select dtype,data from kitarrays where pID=? and name=?',
+                                  (pid, name)).fetchone()
+        if not row:
+            return None
+        return np.frombuffer(row[1], dtype=row[0])
+
+    def delete(self, pid, name):
+        self.dbo.dc.execute('delete from kitarrays where pID=? and name=?', (pid, name))
+
+    def pids(self, name):
+        return [p for (p,) in self.dbo.dc.execute(
+            'select pID from kitarrays where name=? order by pID', (name,))]
+
+
+# named numpy arrays per kit, stored as <dir>/<name>/<pid>.npy
+# Files are memory-mapped on read, so only the pages used are loaded. With a
+# database, changes are staged and only applied when the database commits
+# (see DB.stage_file), so a kit whose load rolls back keeps its old files;
+# without one, they are made right away.
+class NpyArrayStore(object):
+
+    def __init__(self, dirname, dbo=None):
+        self.dirname = dirname
+        self.dbo = dbo
+
+    def fname(self, pid, name):
+        return os.path.join(self.dirname, name, '{}.npy'.format(pid))
+
+    # the file of an array as of the current transaction, None if there is
+    # none
+    def current(self, pid, name):
+        fname = self.fname(pid, name)
+        if self.dbo is not None:
+            fname = self.dbo.current_file(fname)
+        if fname is None or not os.path.exists(fname):
+            return None
+        return fname
+
+    def put(self, pid, name, arr):
+        fname = self.fname(pid, name)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        if self.dbo is not None:
+            with open(self.dbo.stage_file(fname), 'wb') as f:
+                np.save(f, np.ascontiguousarray(arr))
+            return
+        # write to a temporary file first, so readers never see a partial file
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'wb') as f:
+            np.save(f, np.ascontiguousarray(arr))
+        os.replace(tmpname, fname)
+
+    def get(self, pid, name):
+        fname = self.current(pid, name)
+        if fname is None:
+            return None
+        return np.load(fname, mmap_mode='r')
+
+    def delete(self, pid, name):
+        if self.dbo is not None:
+            self.dbo.stage_file(self.fname(pid, name), delete=True)
+            return
+        fname = self.fname(pid, name)
+        if os.path.exists(fname):
+            os.unlink(fname)
+
+    def pids(self, name):
+        dirname = os.path.join(self.dirname, name)
+        if not os.path.isdir(dirname):
+            return []
+        pids = {int(f[:-4]) for f in os.listdir(dirname) if f.endswith('.npy')}
+        if self.dbo is not None:
+            staged = {int(os.path.basename(f)[:-4]) for f, new in self.dbo.staged
+                      if os.path.dirname(f) == dirname}
+            pids = {p for p in pids | staged if self.current(p, name)}
+        return sorted(pids)
+
+
+# calls stored as rows of the vcfcalls table
+class TableCallStore(object):
+
+    def __init__(self, dbo):
+        self.dbo = dbo
+
+    def put_calls(self, pid, vids, callinfo):
+        self.dbo.insert_calls(pid, np.asarray(vids).tolist(),
+                              np.asarray(callinfo).tolist())
+
+    # returns (vids, callinfo) arrays, sorted by variant ID
+    def get_calls(self, pid):
+        rows = self.dbo.dc.execute('''select vID, callinfo from vcfcalls
+                                      where pID=? order by vID''', (pid,)).fetchall()
+        vids = np.array([r[0] for r in rows], dtype=np.int32)
+        callinfo = np.array([r[1] or 0 for r in rows], dtype=np.uint32)
+        return vids, callinfo
+
+    def delete_calls(self, pid):
+        self.dbo.dc.execute('delete from vcfcalls where pID=?', (pid,))
+
+    # pIDs that have calls
+    def kit_ids(self):
+        return [p for (p,) in self.dbo.dc.execute(
+            'select distinct pID from vcfcalls order by pID')]
+
+
+# calls stored as per-kit arrays in a BlobArrayStore or NpyArrayStore
+class ArrayCallStore(object):
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def put_calls(self, pid, vids, callinfo):
+        vids = np.asarray(vids, dtype=np.int32)
+        order = np.argsort(vids, kind='stable')
+        self.arrays.put(pid, 'vid', vids[order])
+        self.arrays.put(pid, 'callinfo', np.asarray(callinfo, dtype=np.uint32)[order])
+
+    def get_calls(self, pid):
+        vids = self.arrays.get(pid, 'vid')
+        if vids is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint32)
+        return vids, self.arrays.get(pid, 'callinfo')
+
+    def delete_calls(self, pid):
+        self.arrays.delete(pid, 'vid')
+        self.arrays.delete(pid, 'callinfo')
+
+    def kit_ids(self):
+        return self.arrays.pids('vid')
+
+
+# BED ranges stored in the bedranges table and linked to kits by the bed table
+class TableBedStore(object):
+
+    def __init__(self, dbo):
+        self.dbo = dbo
+
+    # ranges is an (n,2) array of (minaddr, maxaddr)
+    def put_ranges(self, pid, ranges):
+        dc = self.dbo.cursor()
+        dc.execute('drop table if exists tmpt')
+        dc.execute('create temporary table tmpt(a,b,c)')
+        dc.executemany('insert into tmpt values(?,?,?)',
+                           [(pid, a, b) for (a, b) in np.asarray(ranges).tolist()])
+        dc.execute('''insert or ignore into bedranges(minaddr,maxaddr)
+                      select b,c from tmpt''')
+        dc.execute('''insert into bed(pID, bID)
+                      select t.a, br.id from bedranges br
+                      inner join tmpt t on
+                      t.b=br.minaddr and t.c=br.maxaddr''')
+        dc.execute('drop table tmpt')
+        dc.close()
+
+    # returns (minaddr, maxaddr) int32 arrays, sorted by minaddr
+    def get_ranges(self, pid):
+        rows = self.dbo.dc.execute('''select minaddr,maxaddr from bedranges r
+                                      inner join bed b on b.bID=r.id
+                                      where b.pID=?
+                                      order by 1''', (pid,)).fetchall()
+        ranges = np.array(rows, dtype=np.int32).reshape(-1, 2)
+        return ranges[:,0].copy(), ranges[:,1].copy()
+
+    # the bedranges rows are shared and stay behind
+    def delete_ranges(self, pid):
+        self.dbo.dc.execute('delete from bed where pID=?', (pid,))
+
+    def kit_ids(self):
+        return [p for (p,) in self.dbo.dc.execute(
+            'select distinct pID from bed order by pID')]
+
+
+# BED ranges stored as per-kit arrays in a BlobArrayStore or NpyArrayStore
+class ArrayBedStore(object):
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def put_ranges(self, pid, ranges):
+        ranges = np.asarray(ranges, dtype=np.int32).reshape(-1, 2)
+        ranges = ranges[np.argsort(ranges[:,0], kind='stable')]
+        self.arrays.put(pid, 'bedmin', ranges[:,0])
+        self.arrays.put(pid, 'bedmax', ranges[:,1])
+
+    def get_ranges(self, pid):
+        starts = self.arrays.get(pid, 'bedmin')
+        if starts is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        return starts, self.arrays.get(pid, 'bedmax')
+
+    def delete_ranges(self, pid):
+        self.arrays.delete(pid, 'bedmin')
+        self.arrays.delete(pid, 'bedmax')
+
+    def kit_ids(self):
+        return self.arrays.pids('bedmin')
+
+
+# the per-kit array store of a given kind ('blob' or 'npy')
+def array_store(dbo, kind):
+    if kind == 'blob':
+        return BlobArrayStore(dbo)
+    elif kind == 'npy':
+        return NpyArrayStore(os.path.join(config['REDUX_DATA'], config['kit_array_dir']), dbo)
+    raise ValueError('unknown array store {}'.format(kind))
+
+# the call store of the given kind, by default the configured call_store
+def call_store(dbo, kind=None):
+    if kind is None:
+        kind = config['call_store']
+    if kind == 'table':
+        return TableCallStore(dbo)
+    return ArrayCallStore(array_store(dbo, kind))
+
+# the BED store of the given kind, by default the configured bed_store
+def bed_store(dbo, kind=None):
+    if kind is None:
+        kind = config['bed_store']
+    if kind == 'table':
+        return TableBedStore(dbo)
+    return ArrayBedStore(array_store(dbo, kind))
+
+# move all BED ranges from one kind of BED store to another
+# Afterwards, bed_store in config.yaml must be set to the new kind.
+def migrate_bed_store(dbo, src, dst, trace=None):
+    if src == dst:
+        return
+    srcstore = bed_store(dbo, src)
+    dststore = bed_store(dbo, dst)
+    pids = srcstore.kit_ids()
+    with dbo.bulk_load(('bed',) if dst == 'table' else ()):
+        for n, pid in enumerate(pids):
+            starts, ends = srcstore.get_ranges(pid)
+            dststore.put_ranges(pid, np.column_stack((starts, ends)))
+            if trace:
+                trace(2, 'migrated ranges of {} ({}/{})'.format(pid, n+1, len(pids)))
+        for pid in pids:
+            srcstore.delete_ranges(pid)
+    dbo.query_mode(analyze=True)
+    if trace:
+        trace(1, 'migrated ranges of {} kits from {} to {} store'.format(len(pids), src, dst))
+
+# move all calls from one kind of call store to another
+# Afterwards, call_store in config.yaml must be set to the new kind.
+def migrate_call_store(dbo, src, dst, trace=None):
+    if src == dst:
+        return
+    srcstore = call_store(dbo, src)
+    dststore = call_store(dbo, dst)
+    pids = srcstore.kit_ids()
+    with dbo.bulk_load(('vcfcalls',) if dst == 'table' else ()):
+        for n, pid in enumerate(pids):
+            vids, callinfo = srcstore.get_calls(pid)
+            dststore.put_calls(pid, vids, callinfo)
+            if trace:
+                trace(2, 'migrated calls of {} ({}/{})'.format(pid, n+1, len(pids)))
+        for pid in pids:
+            srcstore.delete_calls(pid)
+    dbo.query_mode(analyze=True)
+    if trace:
+        trace(1, 'migrated calls of {} kits from {} to {} store'.format(len(pids), src, dst))
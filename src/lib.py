@@ -13,16 +13,14 @@
 # it probably only works when run from the src directory
 
 
-import os,yaml,shutil,glob,re,csv,zipfile,subprocess
+import os,shutil,glob,re,csv
 from db import DB
 from collections import defaultdict
 from array_api import *
+from reduxconfig import config
+from runstats import span, timed, record, measure
 import time
 
-# read the config file
-# todo: this might need to some bootstrapping (run outside of src dir?)
-config = yaml.load(open('config.yaml'))
-
 # add src and bin directories to path
 import sys
 sys.path.insert(0, config['REDUX_PATH'])
@@ -75,6 +73,7 @@ def setup_dirs():
 # return list of files that were unzipped
 # this procedure is probably obsolete - remove in the future
 def extract_zipdir():
+    import subprocess
     # work in progress Jef
     # fixme - interop with API from DW
     # fixme - don't purge unzip dir if requested (-k flag)
@@ -126,17 +125,63 @@ def go_db():
     dbo.create_schema()
     return dbo
 
-# call out to bash script to parse the vcf file
-# todo - pull this under python source?
-def getVCFvariants(FILE):
-    from subprocess import Popen, PIPE, STDOUT
-    cmd = os.path.join(config['REDUX_ENV'], 'getVCFvariants.sh')
-
-    p = Popen([cmd, '-'], stdout=PIPE, stdin=PIPE, stderr=STDOUT)    
-    p_stdout = p.communicate(input=FILE.read())[0]
-    output = p_stdout.decode('utf-8')
-    # trace(1, 'command output: {}'.format(output))
-    return output
+# value part of a key=value VCF INFO item, as a float; 0 if missing or not
+# numeric (which is what the awk in getVCFvariants.sh would have produced)
+def _vcf_info_value(item):
+    try:
+        return float(item.split('=', 1)[1])
+    except (IndexError, ValueError):
+        return 0.
+
+# parse a VCF file in-process; same output as the getVCFvariants.sh pipeline
+# fileobj is an open VCF file (binary, e.g. a zip member, or text)
+# This is a generator that yields lists of up to batchsize tuples:
+#     (pos, ref, alt, passfail, q1, q2, nreads, passrate)
+# pos and nreads are int, q1, q2 and passrate are float, passfail is 'PASS' or
+# 'FAIL'. q1 and q2 are the first and sixth INFO values, nreads is the sample
+# DP value and passrate is the fraction of the reads supporting alt. A
+# multi-allele line yields one tuple per alt allele, and only alleles with
+# passrate > minfrac are kept.
+def parse_VCF_file(fileobj, batchsize=10000, minfrac=0.1):
+    batch = []
+    for line in fileobj:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) < 10:
+            continue
+        info = fields[7].split(';')
+        sample = fields[9].split(':')
+        try:
+            nreads = int(sample[2])
+            depths = sample[1].split(',')
+        except (IndexError, ValueError):
+            trace(5, 'skipping VCF line: {}'.format(line.rstrip()))
+            continue
+        if nreads <= 0:
+            continue
+        pos = int(fields[1])
+        ref = fields[3]
+        passfail = 'PASS' if fields[6] == 'PASS' else 'FAIL'
+        q1 = _vcf_info_value(info[0])
+        q2 = _vcf_info_value(info[5]) if len(info) > 5 else 0.
+        # with more than one depth, the first one is the ref read count
+        if len(depths) > 1:
+            depths = depths[1:]
+        for alt, depth in zip(fields[4].split(','), depths):
+            try:
+                passrate = float(depth) / nreads
+            except ValueError:
+                continue
+            if passrate > minfrac:
+                batch.append((pos, ref, alt, passfail, q1, q2, nreads, passrate))
+                if len(batch) >= batchsize:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
 
 #routines - "arghandler" (sort prototype) - Zak
 
@@ -243,6 +288,8 @@ def populate_age(dbo):
                            select id from bedranges
                            inner join tmpt t on t.b=minaddr and t.c=maxaddr''')
         dbo.dc.execute('drop table tmpt')
+    # the age coverage of every kit changes with the age ranges
+    populate_bedstats(dbo)
 
 
 # populate a table of STR definitions
@@ -279,13 +326,14 @@ def populate_STRs(dbo, ordering=None):
 # pull information about the kits from the web api
 # if API==None, read from
 def get_kits (API='http://haplogroup-r.org/api/v1/uploads.php', qry='format=json'):
-    import requests, json
+    import json
     try:
         # choose where to pull the kit data
         if not API:
             trace(1, 'reading kit info from json.out')
             js = json.loads(open('json.out').read())
         else:
+            import requests
             trace(1, 'reading kit info from the web')
             url = '?'.join([API, qry])
             res = requests.get(url)
@@ -415,12 +463,13 @@ def updatesnps(db, snp_reference, buildname='hg38'):
                               v.pos = t.b and v.buildID=t.a''')
 
     db.dc.execute('drop table tmpt')
+    db.reset_variant_cache()
 
 # pull SNP definitions from the web at ybrowse.org
 # this should be called after the build table is populated
 # refresh files if they are older than maxage; do nothing if maxage < 0
 def get_SNPdefs_fromweb(db, maxage, url='http://ybrowse.org/gbrowse2/gff'):
-    import urllib, time
+    import urllib.request
     if maxage < 0:
         return
     # convert to seconds
@@ -432,11 +481,11 @@ def get_SNPdefs_fromweb(db, maxage, url='http://ybrowse.org/gbrowse2/gff'):
         fname = os.path.join(config['REDUX_DATA'], fbase)
         try:
             if os.path.exists(fname):
-                deltat = time.clock() - os.path.getmtime(fname)
+                deltat = time.time() - os.path.getmtime(fname)
             if deltat > maxage:
                 trace (1, 'refresh: {}'.format(fbase))
                 urllib.request.urlretrieve(fget, fname)
-                deltat = time.clock() - os.path.getmtime(fname)
+                deltat = time.time() - os.path.getmtime(fname)
         except:
             pass
         if not os.path.exists(fname) or deltat > maxage:
@@ -445,7 +494,10 @@ def get_SNPdefs_fromweb(db, maxage, url='http://ybrowse.org/gbrowse2/gff'):
 
 # populate SNP definitions; refresh from web if we have is older than maxage
 # (in days)
-def populate_SNPs(dbo, maxage=config['max_snpdef_age']):
+# maxage defaults to max_snpdef_age
+def populate_SNPs(dbo, maxage=None):
+    if maxage is None:
+        maxage = config['max_snpdef_age']
     get_SNPdefs_fromweb(dbo, maxage=maxage)
     # update known snps for hg19 and hg38
     with open(os.path.join(config['REDUX_DATA'], config['b37_snp_file'])) as snpfile:
@@ -460,35 +512,41 @@ def populate_SNPs(dbo, maxage=config['max_snpdef_age']):
 # for age calculations. This is not done in the "brute force" way because it
 # can be compute intensive to search the list for every range.
 def get_kit_coverage(dbo, pid):
-    br = dbo.dc.execute('''select 1,minaddr from bedranges r
-                           inner join bed b on b.bid=r.id and b.pid=?
-                                union
-                           select 1,maxaddr from bedranges r
-                           inner join bed b on b.bid=r.id and b.pid=?
-                                union
-                           select 2,minaddr from bedranges b, agebed a
-                           where a.bID=b.id
-                                union
-                           select 2,maxaddr from bedranges b, agebed a
-                           where a.bID=b.id
-                           order by 2,1''', (pid,pid))
-    ids = {1:0, 2:1}
-    accum1 = 0
-    toggles = [False, False]
-    post = None
-    for r in br:
-        toggles[ids[r[0]]] ^= True
-        if post and (toggles[0] ^ toggles[1]):
-            accum1 += r[1]-post
-            post = None
-        elif toggles[0] & toggles[1]:
-            post = r[1]
-    if post:
-        accum1 += r[1]-post
-    accum2 = dbo.dc.execute('''select sum(maxaddr-minaddr) from bedranges r
-                           inner join bed b on r.id=b.bid and b.pid=?''',
-                        (pid,)).fetchone()[0]
-    return accum2, accum1
+    from coverage import coverage_stats
+    from kitstore import bed_store
+    total, agecov, nranges = coverage_stats([bed_store(dbo).get_ranges(pid)],
+                                            *get_age_ranges(dbo))
+    return int(total[0]), int(agecov[0])
+
+# fill bedstats with the total coverage, the coverage within the age ranges and
+# the number of BED ranges of each kit
+# By default, the statistics of all kits are recomputed; if pids is given, only
+# those kits are updated, e.g. after loading them.
+@timed('bedstats')
+def populate_bedstats(dbo, pids=None):
+    from coverage import coverage_stats
+    from kitstore import bed_store
+    store = bed_store(dbo)
+    if pids is None:
+        pids = store.kit_ids()
+        dbo.dc.execute('delete from bedstats')
+    else:
+        dbo.dc.executemany('delete from bedstats where pID=?', [(p,) for p in pids])
+    trace(1, 'coverage statistics for {} kits'.format(len(pids)))
+    total, agecov, nranges = coverage_stats([store.get_ranges(p) for p in pids],
+                                            *get_age_ranges(dbo))
+    dbo.dc.executemany('insert into bedstats(pID,coverage1,coverage2,nranges) values(?,?,?,?)',
+                       zip(pids, total.tolist(), agecov.tolist(), nranges.tolist()))
+
+# the age ranges from the agebed table as (minaddr, maxaddr) int32 arrays,
+# sorted by minaddr
+def get_age_ranges(dbo):
+    import numpy as np
+    rows = dbo.dc.execute('''select minaddr,maxaddr from bedranges b
+                             inner join agebed a on a.bID=b.id
+                             order by 1,2''').fetchall()
+    ranges = np.array(rows, dtype=np.int32).reshape(-1, 2)
+    return ranges[:,0].copy(), ranges[:,1].copy()
 
 
 # efficiently determine if a set of positions is contained in a set of ranges
@@ -512,171 +570,225 @@ def in_range(v_vect, ranges):
     return c_vect
 
 
-# check kit coverage for a vector of variants return a vector of BED range
-# coverage for a person that represents if the call is a) in a range, b) on the
-# lower edge of a range, c) on the upper edge of a range, or d) not covered by
-# a range
+# check kit coverage for a vector of variants
+# returns a bool vector, aligned with vids, that is True where the variant is
+# inside one of the person's BED ranges, and a vector of edge flags that tells
+# if the variant is on the lower or upper edge of a range (see coverage.py)
 def get_call_coverage(dbo, pid, vids):
-    # FIXME currently only returns True/False, doesn't handle range ends
-    dc = dbo.cursor()
-    dc.execute('drop table if exists tmpt')
-    dc.execute('create table tmpt (vid integer)')
-    dc.executemany('insert into tmpt values(?)', [(a,) for a in vids])
-    calls = dc.execute('''select v.id, v.pos from variants v
-                          inner join tmpt t on t.vid=v.id
-                          order by 2''')
-    cv = [v[1] for v in calls]
-    trace(500, '{} calls: {}...'.format(len(cv), cv[:20]))
-    rc = dbo.cursor()
-    ranges = rc.execute('''select minaddr,maxaddr from bedranges r
-                           inner join bed b on b.bID=r.id
-                           where b.pid=?
-                           order by 1''', (pid,))
-    rv = [v for v in ranges]
-    if len(rv) == 0:
-        return []
-    trace(500, '{} ranges: {}...'.format(len(rv), rv[:20]))
-    coverage = in_range(cv, rv)
-    return coverage
-
-# populate regions from a FTDNA BED file
-# fname is an unpacked BED file
-def populate_from_BED_file(dbo, pid, fileobj):
-    dc = dbo.cursor()
+    from coverage import kit_coverage, variant_positions
+    from kitstore import bed_store
+    positions = variant_positions(dbo, vids)
+    starts, ends = bed_store(dbo).get_ranges(pid)
+    trace(500, '{} calls, {} ranges for {}'.format(len(positions), len(starts), pid))
+    return kit_coverage(starts, ends, positions)
+
+# read the ranges from a FTDNA BED file
+# fileobj is an open BED file, e.g. a zip member
+# returns an (n,2) int32 numpy array of (minaddr, maxaddr), or None if the
+# file could not be parsed
+def parse_BED_file(fileobj):
+    import numpy as np
     ranges = []
     try:
         for line in fileobj:
             ychr, minr, maxr = line.split()
-            ranges.append((pid, int(minr), int(maxr)))
+            ranges.append((int(minr), int(maxr)))
     except:
         trace(0, 'FAILED on file at {}'.format(fileobj.readline()))
-        return
+        return None
+    return np.array(ranges, dtype=np.int32).reshape(-1, 2)
+
+# store the BED ranges returned by parse_BED_file for a person
+def load_BED_ranges(dbo, pid, ranges):
+    from kitstore import bed_store
     trace(500, '{} ranges for pID {}'.format(len(ranges), pid))
+    bed_store(dbo).put_ranges(pid, ranges)
 
-    dc.execute('drop table if exists tmpt')
-    dc.execute('create temporary table tmpt(a,b,c)')
-    dc.executemany('insert into tmpt values(?,?,?)', ranges)
-    dc.execute('''insert or ignore into bedranges(minaddr,maxaddr)
-                  select b,c from tmpt''')
-    dc.execute('''insert into bed(pID, bID)
-                  select t.a, br.id from bedranges br
-                  inner join tmpt t on
-                  t.b=br.minaddr and t.c=br.maxaddr''')
-    dc.close()
+# populate regions from a FTDNA BED file
+# fname is an unpacked BED file
+def populate_from_BED_file(dbo, pid, fileobj):
+    ranges = parse_BED_file(fileobj)
+    if ranges is not None:
+        load_BED_ranges(dbo, pid, ranges)
     return
 
+# bit layouts of the callinfo integer in vcfcalls, by layout version
+# Each field is (name, nbits, scale). Fields are packed from bit 31 down, and
+# a value is stored as int(value*scale), clipped to fit in nbits. Version 1 is
+# the original experimental layout; a database without a callinfo_version
+# entry in meta was written with version 1. Add a new version rather than
+# changing an existing one.
+CALLINFO_LAYOUTS = {
+    1: (('passfail', 1, 1.), ('q1', 7, 3.), ('q2', 7, 2.),
+        ('nreads', 9, 1.), ('passrate', 8, 255.)),
+    }
+CALLINFO_VERSION = 1
+
+# unpacked callinfo, as returned by unpack_calls
+CALLINFO_DTYPE = [('passfail', '?'), ('q1', 'f4'), ('q2', 'f4'),
+                  ('nreads', 'u2'), ('passrate', 'f4')]
+
+# get the callinfo layout version of the database
+def get_callinfo_version(dbo):
+    row = dbo.dc.execute('select val from meta where descr=?',
+                         ('callinfo_version',)).fetchone()
+    if not row:
+        return 1
+    return int(row[0])
+
+# record the callinfo layout version used to write calls to the database
+def set_callinfo_version(dbo, version=CALLINFO_VERSION):
+    dbo.dc.execute('delete from meta where descr=?', ('callinfo_version',))
+    dbo.dc.execute('insert into meta(descr,val) values(?,?)',
+                   ('callinfo_version', str(version)))
+
 # experimental - pack call information into an integer
 # pos, anc, der, passfail, q1, q2, nreads, passrate
-def pack_call(call_tup):
-    maxshift = 31
-    nqbits = 7
-    ncbits = 9
-    npbits = 8
-    # pack in a pass/fail flag
-    bitfield = {'PASS': 1<<maxshift, 'FAIL': 0}[call_tup[3]]
-    maxshift -= 1
-    # pack in a unitless nqbits-number representing q1
-    qnum = int(float(call_tup[4]) * 3)
-    if qnum > (1<<nqbits) - 1:
-        qnum = (1<<nqbits)-1
-    bitfield |= (qnum << (maxshift - nqbits + 1))
-    maxshift -= nqbits
-    # pack in a unitless nqbits-number representing q2
-    qnum = int(float(call_tup[5]) * 2)
-    if qnum > (1<<nqbits) - 1:
-        qnum = (1<<nqbits) - 1
-    bitfield |= (qnum << (maxshift - nqbits + 1))
-    maxshift -= nqbits
-    # pack in a ncbits-bit number representing num reads
-    nreads = int(call_tup[6])
-    if nreads > (1<<ncbits) - 1:
-        nreads = (1<<ncbits) - 1
-    bitfield |= (nreads << (maxshift - ncbits + 1))
-    maxshift -= nqbits
-    # pack in a ncbits-bit number representing passrate
-    passrate = int(float(call_tup[7]) * ((1<<npbits) - 1))
-    if passrate > (1<<npbits) - 1:
-        passrate = (1<<npbits) - 1
-    bitfield |= passrate
+def pack_call(call_tup, version=CALLINFO_VERSION):
+    values = {'passfail': call_tup[3] == 'PASS', 'q1': float(call_tup[4]),
+              'q2': float(call_tup[5]), 'nreads': int(call_tup[6]),
+              'passrate': float(call_tup[7])}
+    bitfield = 0
+    shift = 32
+    for name, nbits, scale in CALLINFO_LAYOUTS[version]:
+        # the next field starts nbits below this one
+        shift -= nbits
+        num = min(max(int(values[name] * scale), 0), (1<<nbits) - 1)
+        bitfield |= num << shift
     return bitfield
 
 # experimental - unpack that corresponds to pack_call
-# if pack_call changes, this needs to change
-def unpack_call(bitfield):
-    maxshift = 31
-    nqbits = 7
-    ncbits = 9
-    npbits = 8
-    passrate = float(bitfield & (1<<npbits) - 1) / ((1<<npbits) - 1)
-    calls = (bitfield>>npbits) & ((1<<ncbits) - 1)
-    q2 = float((bitfield>>(npbits+ncbits)) & ((1<<nqbits) - 1)) / 2.
-    q1 = float((bitfield>>(npbits+ncbits+nqbits)) & ((1<<nqbits) - 1)) /3.
-    if (1<<maxshift) & bitfield:
-        passfail = True
-    else:
-        passfail = False
-    return passfail, q1, q2, calls, passrate
-
-# populate calls, quality, and variants from a VCF file
-# fname is an unzipped VCF file
-def populate_from_VCF_file(dbo, bid, pid, fileobj):
-    dc = dbo.cursor()
-    b = dc.execute('select buildNm from build where id=?', (bid,)).fetchone()[0]
-    if b != 'hg38':
-        trace(0, 'currently unable to parse build {}'.format(b))
-        return
-    # parse output of getVCFvariants(fname)
-    parsed = getVCFvariants(fileobj)
+# returns passfail, q1, q2, nreads, passrate
+def unpack_call(bitfield, version=CALLINFO_VERSION):
+    values = []
+    shift = 32
+    for name, nbits, scale in CALLINFO_LAYOUTS[version]:
+        shift -= nbits
+        values.append(((bitfield >> shift) & ((1<<nbits) - 1)) / scale)
+    values[0] = bool(values[0])
+    values[3] = int(values[3])
+    return tuple(values)
+
+# vectorized pack_call: pack whole columns of call information at once
+# passfail is a vector of booleans or of 'PASS'/'FAIL' strings; the other
+# arguments are numeric vectors of the same length
+# returns a uint32 numpy array of callinfo values
+def pack_calls(passfail, q1, q2, nreads, passrate, version=CALLINFO_VERSION):
+    import numpy as np
+    passfail = np.asarray(passfail)
+    if passfail.dtype.kind in 'SUO':
+        passfail = passfail == 'PASS'
+    columns = {'passfail': passfail, 'q1': q1, 'q2': q2, 'nreads': nreads,
+               'passrate': passrate}
+    packed = np.zeros(len(passfail), dtype=np.uint32)
+    shift = 32
+    for name, nbits, scale in CALLINFO_LAYOUTS[version]:
+        shift -= nbits
+        num = np.asarray(columns[name], dtype=np.float64) * scale
+        num = np.clip(num, 0, (1<<nbits) - 1).astype(np.uint32)
+        packed |= num << np.uint32(shift)
+    return packed
+
+# vectorized unpack_call: unpack a vector of callinfo values
+# returns a numpy structured array with the fields of CALLINFO_DTYPE
+def unpack_calls(callinfo, version=CALLINFO_VERSION):
+    import numpy as np
+    callinfo = np.asarray(callinfo, dtype=np.uint32)
+    unpacked = np.zeros(len(callinfo), dtype=CALLINFO_DTYPE)
+    shift = 32
+    for name, nbits, scale in CALLINFO_LAYOUTS[version]:
+        shift -= nbits
+        num = (callinfo >> np.uint32(shift)) & np.uint32((1<<nbits) - 1)
+        unpacked[name] = num / scale
+    return unpacked
+
+# read the calls from a VCF file into compact arrays
+# fileobj is an open VCF file, e.g. a zip member
+# returns a dict with 'pos' (int32 array), 'anc' and 'der' (lists of allele
+# strings) and 'callinfo' (uint32 array of packed call information)
+def read_VCF_calls(fileobj):
+    import numpy as np
+    # pos, anc, der, passfail, q1, q2, nreads, passrate
     tups = []
-    for line in parsed.splitlines():
-        # pos, anc, der, passfail, q1, q2, nreads, passrate
-        tups.append(line.split())
+    for batch in parse_VCF_file(fileobj):
+        tups.extend(batch)
 
-    # trace(1, 'parsed vcf: {}...'.format(tups[:3]))
     # filter down to the calls we want to store
     # fixme this is probably not the correct filtering
-    try:
-        #passes = [t for t in tups if t[2] != '.' and (t[3] == 'PASS' or
-        #          (int(t[6]) < 4 and float(t[7]) > .75))]
-        passes = [t for t in tups]
-    except ValueError:
-        trace(0, 'parsing VCF failed on {}'.format(t))
-
-    # save the distinct alleles - check performance
-    alleles = set([x[1] for x in passes] + [x[2] for x in passes])
-    dc.executemany('insert or ignore into alleles(allele) values(?)',
-                       [(x,) for x in alleles])
+    #passes = [t for t in tups if t[2] != '.' and (t[3] == 'PASS' or
+    #          (t[6] < 4 and t[7] > .75))]
+    passes = tups
+    trace(500, '{} vcf calls: {}...'.format(len(passes), passes[:5]))
 
+    if not passes:
+        return {'pos': np.zeros(0, dtype=np.int32), 'anc': [], 'der': [],
+                'callinfo': np.zeros(0, dtype=np.uint32)}
+    pos, anc, der, passfail, q1, q2, nreads, passrate = zip(*passes)
     # save the call quality info - experimental
-    call_info = [t + [pack_call(t)] for t in passes]
-
-    # execute sql on results to save in vcfcalls
-    dc.execute('drop table if exists tmpt')
-    dc.execute('''create temporary table tmpt(a integer, b integer,
-                  c text, d text, e integer, f integer)''')
-    dc.executemany('insert into tmpt values(?,?,?,?,?,?)',
-                          [[bid]+v[0:3]+[pid]+[v[-1]] for v in call_info])
-    # fixme - performance
-    trace(3,'VCF update variants at {}'.format(time.clock()))
-    dc.execute('''insert or ignore into variants(buildID, pos, anc, der)
-                  select a, b, an.id, dr.id from tmpt
-                  inner join alleles an on an.allele = c
-                  inner join alleles dr on dr.allele = d''')
-    trace(3,'done at {}'.format(time.clock()))
-    trace(3,'VCF update calls at {}'.format(time.clock()))
-    dc.execute('''insert into vcfcalls (pid,vid,callinfo)
-                  select e, v.id, f from tmpt
-                  inner join alleles an on an.allele = c
-                  inner join alleles dr on dr.allele = d
-                  inner join variants v on v.buildID = a and v.pos = b
-                  and v.anc=an.id and v.der=dr.id''')
-    trace(3,'done at {}'.format(time.clock()))
-    dc.execute('drop table tmpt')
-    dc.close()
+    return {'pos': np.array(pos, dtype=np.int32), 'anc': list(anc),
+            'der': list(der),
+            'callinfo': pack_calls(passfail, q1, q2, nreads, passrate)}
+
+# store the calls returned by read_VCF_calls for a person
+# Calls of another build than hg38 have to be lifted over first (lift_kit).
+def load_VCF_calls(dbo, bid, pid, calls):
+    from kitstore import call_store
+    b = dbo.dc.execute('select buildNm from build where id=?', (bid,)).fetchone()[0]
+    if b != 'hg38':
+        trace(0, 'currently unable to parse build {}'.format(b))
+        return
 
-    trace(500, '{} vcf calls: {}...'.format(len(passes), passes[:5]))
+    # resolve variant ids through the cache, which only inserts new ones
+    vids = dbo.variant_cache().variant_ids(bid, calls['pos'].tolist(),
+                                           calls['anc'], calls['der'])
+    call_store(dbo).put_calls(pid, vids, calls['callinfo'])
     return
 
+# the BED ranges and VCF calls of a kit of build bid, lifted over to hg38
+# ranges are as returned by parse_BED_file and calls as returned by
+# read_VCF_calls; either may be None. Returns the build ID, ranges and calls
+# to load: for hg38, and for a build without a chain file to hg38 (see
+# liftover.py), what was given. Ranges are split where they span a chain
+# gap; calls at positions that do not map are dropped, and how much did
+# not map is reported.
+def lift_kit(dbo, bid, pid, ranges, calls):
+    import numpy as np
+    from liftover import get_liftover, complement_alleles
+    b = dbo.dc.execute('select buildNm from build where id=?', (bid,)).fetchone()[0]
+    if b == 'hg38':
+        return bid, ranges, calls
+    chain = get_liftover(b, 'hg38')
+    if chain is None:
+        return bid, ranges, calls
+    with span('liftover', pid) as sp:
+        if ranges is not None:
+            starts, ends, src, lost = chain.map_ranges(ranges[:,0], ranges[:,1])
+            order = np.lexsort((ends, starts))
+            ranges = np.column_stack((starts[order], ends[order])).astype(np.int32)
+            if lost.any():
+                trace(1, 'pID {}: {} bases of {} of {} ranges not lifted from {} to hg38'.format(
+                    pid, lost.sum(), np.count_nonzero(lost), len(lost), b))
+        if calls is not None:
+            pos, reverse = chain.map_positions(calls['pos'])
+            keep = np.flatnonzero(pos >= 0)
+            keep = keep[np.argsort(pos[keep], kind='stable')]
+            if len(keep) < len(pos):
+                trace(1, 'pID {}: {} of {} calls not lifted from {} to hg38'.format(
+                    pid, len(pos) - len(keep), len(pos), b))
+            rev = reverse[keep]
+            calls = {'pos': pos[keep].astype(np.int32),
+                     'anc': complement_alleles([calls['anc'][i] for i in keep.tolist()], rev),
+                     'der': complement_alleles([calls['der'][i] for i in keep.tolist()], rev),
+                     'callinfo': calls['callinfo'][keep]}
+            sp.rows = len(pos)
+    return get_build_byname(dbo, 'hg38'), ranges, calls
+
+# populate calls, quality, and variants from a VCF file
+# fname is an unzipped VCF file
+def populate_from_VCF_file(dbo, bid, pid, fileobj):
+    bid, ranges, calls = lift_kit(dbo, bid, pid, None, read_VCF_calls(fileobj))
+    load_VCF_calls(dbo, bid, pid, calls)
+
 # unpack any zip from FTDNA that has the bed file and vcf file
 def populate_from_zip_file(dbo, fname):
     # stub work in progress Jef
@@ -691,112 +803,237 @@ def populate_from_zip_file(dbo, fname):
     # populate_from_BED_file
     return
 
-# unpack all zip files that can be handled from the HaplogroupR catalog If the
-# zip file exists, unpack it. Future - skip if already loaded?  Walk through
-# dataset table to find these files. Assume we've already pulled the list from
-# the H-R web API and downloaded zip files. Future - download file?
-def populate_from_dataset(dbo):
-    import zipfile, re
-    trace(1, 'populate from dataset with kit limit {}'.format(config['kitlimit']))
-    dc = dbo.cursor()
-    bed_re = re.compile(r'(\b(?:\w*[^_/])?regions(?:\[\d\])?\.bed)')
-    vcf_re = re.compile(r'(\b(?:\w*[^_/])?variants(?:\[\d\])?\.vcf)')
-    fl = dc.execute('select fileNm,buildID,ID from dataset')
-    allsets = list([(t[0],t[1],t[2]) for t in fl])
-    pc = dbo.cursor()
-    pl = pc.execute('select distinct pid from vcfcalls')
-    pexists = [p[0] for p in pl]
-    trace(5,'allsets: {}'.format(allsets[:config['kitlimit']]))
-    nkits = 0
-
-    # fixme - hack - better index handling (drop index for insert performance)
-    trace(3, 'drop indexes at {}'.format(time.clock()))
-    dc.execute('drop index bedidx')
-    dc.execute('drop index vcfidx')
-    dc.execute('drop index vcfpidx')
-    trace(3, 'done at {}'.format(time.clock()))
-
+# the BED and VCF members of a FTDNA zip file, or None if not found
+_bed_re = re.compile(r'(\b(?:\w*[^_/])?regions(?:\[\d\])?\.bed)')
+_vcf_re = re.compile(r'(\b(?:\w*[^_/])?variants(?:\[\d\])?\.vcf)')
+def kit_zip_members(zf):
+    bedfile = vcffile = None
+    for ff in zf.namelist():
+        dirname, basename = os.path.split(ff)
+        if _bed_re.search(basename):
+            bedfile = ff
+        elif _vcf_re.search(basename):
+            vcffile = ff
+    return bedfile, vcffile
+
+# version of the kit zip parsing (read_kit_zip and the routines it calls)
+# Bump this when a change in parsing changes what gets loaded, so that kits
+# loaded with an older parser are re-loaded by populate_from_dataset.
+KIT_PARSER_VERSION = 1
+
+# md5 hash of a file's contents
+def file_md5(fname):
+    import hashlib
+    hash_md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+# parse the BED and VCF files of one kit's zip file into compact arrays
+# This does no database work, so it can run in a worker process. task is a
+# (zip file path, build ID, pID) tuple, and the return value is the task
+# followed by the BED ranges (see parse_BED_file), the VCF calls (see
+# read_VCF_calls), an error message, which is None on success, and the
+# timing of the parse: the start, wall, cpu, maxrss and rows arguments of
+# runstats.record. The caller records it, as the spans of a worker process
+# would be lost.
+def read_kit_zip(task):
+    import zipfile
+    zipf, buildid, pid = task
+    with measure() as m:
+        try:
+            with zipfile.ZipFile(zipf) as zf:
+                bedfile, vcffile = kit_zip_members(zf)
+                if (not bedfile) or (not vcffile):
+                    result = (None, None, 'missing data')
+                else:
+                    with zf.open(bedfile,'r') as bedf:
+                        ranges = parse_BED_file(bedf)
+                    with zf.open(vcffile,'r') as vcff:
+                        calls = read_VCF_calls(vcff)
+                    result = (ranges, calls, None)
+                    m.rows = len(calls['pos'])
+        except Exception as e:
+            result = (None, None, repr(e))
+    return task + result + (m.timing() + (m.rows,),)
+
+# run read_kit_zip over tasks, yielding results in the order of tasks
+# With more than one worker, zip files are parsed by a pool of processes. At
+# most two tasks per worker are in flight, so parsed kits don't pile up in
+# memory if the caller (the database writer) is the slower side.
+def read_kit_zips(tasks, workers=1):
+    if workers <= 1:
+        for task in tasks:
+            yield read_kit_zip(task)
+        return
+    import multiprocessing
+    from collections import deque
+    tasks = iter(tasks)
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(read_kit_zip, (task,)))
+            if len(pending) >= 2*workers:
+                break
+        while pending:
+            result = pending.popleft().get()
+            for task in tasks:
+                pending.append(pool.apply_async(read_kit_zip, (task,)))
+                break
+            yield result
+
+# decide which kits need to be loaded, using the loadmanifest table
+# allsets is a list of (fileNm, buildID, pID) from the dataset table
+# returns a list of (zip file path, buildID, pID) tasks for read_kit_zip, a
+# dict of pID -> (size, mtime, md5) of those zip files and the set of pIDs
+# whose previously loaded data will be replaced
+# A kit is skipped if its manifest entry has the same zip file, size, mtime
+# and parser version. The content hash is only computed when size or mtime
+# differ, and a zip that was merely touched is not re-loaded. A kit that was
+# stored in a build other than hg38 is re-loaded once a chain file lifts its
+# build to hg38 (see lift_kit).
+def plan_kit_loads(dbo, allsets):
+    from kitstore import call_store, bed_store
+    from liftover import chain_path
+    manifest = {}
+    for row in dbo.dc.execute('''select pID,zipNm,size,mtime,md5,parserVer,loadBuildID
+                                 from loadmanifest'''):
+        manifest[row[0]] = row[1:]
+    loaded = set(call_store(dbo).kit_ids())
+    loaded |= set(bed_store(dbo).kit_ids())
+    hg38 = get_build_byname(dbo, 'hg38')
+    liftable = {bid: bid != hg38 and chain_path(b, 'hg38') is not None
+                for bid, b in dbo.dc.execute('select ID, buildNm from build').fetchall()}
+
+    tasks = []
+    fileinfo = {}
+    replace = set()
     for (fn,buildid,pid) in allsets:
-        # if there are already calls for this person, skip the load
-        if (not config['drop_tables']) and pid in pexists:
-            trace(2, 'calls exist - skip {}'.format(fn[:50]))
-            continue
         zipf = os.path.join(data_path('HaplogroupR'), fn)
         if not os.path.exists(zipf):
             trace(10, 'not present: {}'.format(zipf))
             continue
-        try:
-            with zipfile.ZipFile(zipf) as zf:
-                trace(1, '{}-{}'.format(nkits,zf.filename[:70]))
-                listfiles = zf.namelist()
-                bedfile = vcffile = None
-                for ff in listfiles:
-                    dirname, basename = os.path.split(ff)
-                    if bed_re.search(basename):
-                        bedfile = ff
-                    elif vcf_re.search(basename):
-                        vcffile = ff
-                if (not bedfile) or (not vcffile):
-                    trace(0, 'FAIL: missing data:{} (not loaded)'.format(zipf))
+        st = os.stat(zipf)
+        if pid in manifest:
+            zipnm, size, mtime, md5, parserver, loadbuild = manifest[pid]
+            if loadbuild != hg38 and liftable.get(buildid):
+                trace(2, 'lift to hg38 - reload {}'.format(fn[:50]))
+            elif parserver == KIT_PARSER_VERSION and zipnm == zipf:
+                if size == st.st_size and mtime == st.st_mtime:
+                    trace(2, 'unchanged - skip {}'.format(fn[:50]))
                     continue
-                with zf.open(bedfile,'r') as bedf:
-                    trace(2, 'populate from bed {}'.format(bedfile))
-                    populate_from_BED_file(dbo, pid, bedf)
-                with zf.open(vcffile,'r') as vcff:
-                    trace(2, 'populate from vcf {}'.format(vcffile))
-                    populate_from_VCF_file(dbo, buildid, pid, vcff)
-            nkits += 1
-        except:
-            trace(0, 'FAIL on file {} (not loaded)'.format(zipf))
-            # raise
-        if nkits >= config['kitlimit']:
+                if md5 == file_md5(zipf):
+                    trace(2, 'same content - skip {}'.format(fn[:50]))
+                    dbo.dc.execute('''update loadmanifest set size=?, mtime=?
+                                      where pID=?''', (st.st_size, st.st_mtime, pid))
+                    continue
+        fileinfo[pid] = (st.st_size, st.st_mtime, file_md5(zipf))
+        if pid in loaded:
+            replace.add(pid)
+        tasks.append((zipf, buildid, pid))
+        if len(tasks) >= config['kitlimit']:
             break
+    return tasks, fileinfo, replace
 
-    # fixme - hack
-    trace(3, 're-create indexes at {}'.format(time.clock()))
-    dc.execute('create index bedidx on bed(pID,bID)')
-    dc.execute('create index vcfidx on vcfcalls(vID)')
-    dc.execute('create index vcfpidx on vcfcalls(pID)')
-    trace(3, 'done at {}'.format(time.clock()))
+# delete the data that was loaded from a kit's zip file
+def delete_kit_data(dbo, pid):
+    from kitstore import call_store, bed_store
+    call_store(dbo).delete_calls(pid)
+    bed_store(dbo).delete_ranges(pid)
+    dbo.dc.execute('delete from bedstats where pID=?', (pid,))
+    dbo.dc.execute('delete from loadmanifest where pID=?', (pid,))
 
-    return
+# unpack all zip files that can be handled from the HaplogroupR catalog If the
+# zip file exists, unpack it. Walk through dataset table to find these
+# files. Assume we've already pulled the list from the H-R web API and
+# downloaded zip files. Future - download file?
+# Only new or changed kits are loaded (see plan_kit_loads); the data of a
+# changed kit is deleted and re-loaded. The kits are loaded in one bulk-load
+# transaction (see DB.bulk_load), and a kit that fails to load keeps its old
+# data. Coverage statistics of the loaded kits are computed after it, with
+# the indexes in place, and the database is left in query mode
+# (DB.query_mode), with fresh planner statistics.
+# Zip files are parsed by workers processes (config ingest_workers, unless
+# given) and loaded by this process in dataset order, so the result does not
+# depend on the number of workers.
+@timed('load kits')
+def populate_from_dataset(dbo, workers=None):
+    if workers is None:
+        workers = config['ingest_workers']
+    trace(1, 'populate from dataset with kit limit {}'.format(config['kitlimit']))
+    dc = dbo.cursor()
+    fl = dc.execute('select fileNm,buildID,ID from dataset')
+    allsets = list([(t[0],t[1],t[2]) for t in fl])
+    trace(5,'allsets: {}'.format(allsets[:config['kitlimit']]))
 
-    trace(1, 'calculate coverages')
-    # below: maybe not part of populating dataset?
-    # get variants in ascending order of number of calls across kits
-    vc = dbo.cursor().execute('''select v.id,v.anc,v.der,count(c.pid)
-                           from variants v
-                           inner join vcfcalls c on c.vid = v.id
-                           group by 1,2,3 order by 4''')
-    # variant list is used more than once, so make a list
-    #vl = list([s[0] for s in vc if s[3] > 1])
-    vl = []
-    for v in vc:
-        if v[3] > 1:
-            vl.append(v[0])
-    vc.close()
-    trace(2,'closed cursor')
-    try:
-        for (fn,buildid,pid) in allsets:
-            coverage = get_call_coverage(dbo, pid, vl)
-            if len(coverage) > 0:
-                trace(1, 'calculate coverage for id {}'.format(pid))
-                trace(2, 'coverage vector: {}...'.format(coverage[:20]))
-            else:
-                trace(2, 'no coverage calculated for {}'.format(pid))
-    except:
-        trace(0, 'did not calculate coverage')
-    return
+    with span('plan kit loads') as sp:
+        tasks, fileinfo, replace = plan_kit_loads(dbo, allsets)
+        sp.rows = len(tasks)
+    trace(1, '{} kits to load ({} replaced) with {} workers'.format(
+        len(tasks), len(replace), workers))
+    if not tasks:
+        dbo.commit()
+        return
+
+    # deferring the index builds only pays off when loading most of the
+    # data; replacing kits needs the pID indexes to delete their old rows
+    nloaded = dc.execute('select count(*) from loadmanifest').fetchone()[0]
+    defer = ('bed', 'vcfcalls') if (not replace) and len(tasks) > nloaded else ()
+
+    loaded = []
+    with dbo.bulk_load(defer):
+        for nk, (zipf, buildid, pid, ranges, calls, err, timing) in \
+                enumerate(read_kit_zips(tasks, workers)):
+            record('parse kit', pid, *timing, failed=err is not None)
+            if err:
+                trace(0, 'FAIL on file {}: {} (not loaded)'.format(zipf, err))
+                continue
+            trace(1, '{}/{}-{}'.format(nk+1, len(tasks), os.path.basename(zipf)[:70]))
+            dc.execute('savepoint kit')
+            staged = len(dbo.staged)
+            try:
+                with span('load kit', pid, len(calls['pos'])):
+                    if pid in replace:
+                        delete_kit_data(dbo, pid)
+                    buildid, ranges, calls = lift_kit(dbo, buildid, pid, ranges, calls)
+                    if ranges is not None:
+                        load_BED_ranges(dbo, pid, ranges)
+                    load_VCF_calls(dbo, buildid, pid, calls)
+                    dc.execute('''insert or replace into
+                                  loadmanifest(pID,zipNm,size,mtime,md5,parserVer,
+                                               loadBuildID,loadDt)
+                                  values(?,?,?,?,?,?,?,datetime('now'))''',
+                               (pid, zipf) + fileinfo[pid] + (KIT_PARSER_VERSION, buildid))
+                dc.execute('release kit')
+                loaded.append(pid)
+            except:
+                dc.execute('rollback to kit')
+                dc.execute('release kit')
+                dbo.discard_files(staged)
+                # the cache may hold variants that were just rolled back
+                dbo.reset_variant_cache()
+                trace(0, 'FAIL on file {} (not loaded)'.format(zipf))
+                # raise
+    trace(1, '{} kits loaded'.format(len(loaded)))
+    populate_bedstats(dbo, loaded)
+    dbo.query_mode(analyze=bool(defer))
 
 
 # initial database creation and table loads
 def db_creation():
+    from implications import populate_implications
     db = DB(drop=config['drop_tables'])
     if config['drop_tables']:
         db.create_schema()
-    populate_fileinfo(db, fromweb=config['use_web_api'])
-    populate_STRs(db)
-    populate_SNPs(db)
-    populate_contigs(db)
-    populate_age(db)
+    with db.bulk_load(('snpnames',)):
+        populate_fileinfo(db, fromweb=config['use_web_api'])
+        populate_STRs(db)
+        populate_SNPs(db)
+        populate_contigs(db)
+        populate_age(db)
+        populate_implications(db)
+        if config['drop_tables']:
+            set_callinfo_version(db)
+    db.query_mode()
     return db
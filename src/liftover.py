@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# liftover of positions and BED ranges between builds, e.g. hg19 to hg38
+#
+# A ChainMap is read from a UCSC chain file, such as hg19ToHg38.over.chain.gz
+# from https://hgdownload.soe.ucsc.edu/goldenPath/hg19/liftOver/. Only the
+# chains from liftover_chrom to liftover_chrom are kept (chrY; this program
+# has no use for a Y position that lands on another chromosome). Their
+# aligned blocks become sorted, non-overlapping intervals of the source
+# build, held as numpy arrays; where chains overlap, the part of the source
+# both cover maps through the chain with the higher score, as liftOver does.
+# Mapping is then a binary search of the block starts:
+#   map_positions(pos)        - 1-based positions (VCF), vectorized; returns
+#                               the new positions, -1 where unmapped, and a
+#                               flag for positions on a reverse strand block
+#   map_ranges(starts, ends)  - BED ranges (0-based, end exclusive); a range
+#                               that spans a chain gap is split into the
+#                               pieces that map, and the unmapped bases of
+#                               each range are counted
+# Positions in no block, i.e. in a chain gap, outside all chains or only in
+# chains to another chromosome, are unmapped.
+#
+# get_liftover(src, dst) returns the ChainMap of srcToDst.over.chain[.gz]
+# under REDUX_DATA in liftover_dir, read once per process, or None if there
+# is no such file.
+#
+# Run as a command to lift a BED file (or, with -p, a file with a position
+# per line), writing what does not map to an unmapped file:
+#   liftover.py [-f hg19] [-t hg38] [-c CHAINFILE] [-p] INPUT OUTPUT [-u UNMAPPED]
+
+import os,gzip,bisect,functools
+import numpy as np
+from reduxconfig import config
+
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+class ChainMap(object):
+
+    # tstart, tend are the sorted, non-overlapping blocks of the source
+    # build (0-based, end exclusive), starting at qstart in the destination
+    # build, on its reverse strand where reverse is set; qsize is the length
+    # of the destination chromosome
+    def __init__(self, tstart, tend, qstart, reverse, qsize, src=None, dst=None):
+        self.tstart = np.asarray(tstart, dtype=np.int64)
+        self.tend = np.asarray(tend, dtype=np.int64)
+        self.reverse = np.asarray(reverse, dtype=bool)
+        # a source position p in block i is at p+offset[i] in the
+        # destination, counted from the end of the chromosome if reverse
+        self.offset = np.asarray(qstart, dtype=np.int64) - self.tstart
+        self.qsize = qsize
+        self.src = src
+        self.dst = dst
+
+    def __len__(self):
+        return len(self.tstart)
+
+    # read a chain file, plain or gzipped
+    @classmethod
+    def read(cls, fname, chrom=None, src=None, dst=None):
+        if chrom is None:
+            chrom = config['liftover_chrom']
+        opener = gzip.open if fname.endswith('.gz') else open
+        chains = []
+        blocks = None
+        qsize = 0
+        with opener(fname, 'rt') as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                if fields[0] == 'chain':
+                    # chain score tName tSize tStrand tStart tEnd
+                    #       qName qSize qStrand qStart qEnd id
+                    blocks = None
+                    if fields[2] == chrom and fields[7] == chrom and fields[4] == '+':
+                        blocks = []
+                        qsize = int(fields[8])
+                        t, q = int(fields[5]), int(fields[10])
+                        chains.append((float(fields[1]), fields[9] == '-', blocks))
+                elif blocks is not None:
+                    # size [dt dq]: an aligned block and the gaps after it
+                    size = int(fields[0])
+                    blocks.append((t, q, size))
+                    if len(fields) == 3:
+                        t += size + int(fields[1])
+                        q += size + int(fields[2])
+
+        # lay the blocks of the best chains first and fill the rest of the
+        # source with what the other chains add
+        chains.sort(key=lambda c: -c[0])
+        starts, ends = [], []
+        rows = []
+        for score, reverse, chain in chains:
+            for t, q, size in chain:
+                for s, e in _uncovered(starts, ends, t, t + size):
+                    i = bisect.bisect_left(starts, s)
+                    starts.insert(i, s)
+                    ends.insert(i, e)
+                    rows.append((s, e, q + s - t, reverse))
+        rows.sort()
+        rows = list(zip(*rows)) or ((), (), (), ())
+        return cls(*rows, qsize=qsize, src=src, dst=dst)
+
+    # the block of each 0-based source position, and where it is in one
+    def _blocks(self, pos):
+        i = np.searchsorted(self.tstart, pos, side='right') - 1
+        if not len(self):
+            return i, np.zeros(len(pos), dtype=bool)
+        ic = np.maximum(i, 0)
+        return ic, (i >= 0) & (pos < self.tend[ic])
+
+    # map 1-based positions
+    # returns an int64 array of the positions in the destination build, -1
+    # where unmapped, and a bool array that is True where the position is
+    # on the reverse strand of the destination (the alleles complemented)
+    def map_positions(self, pos):
+        pos = np.asarray(pos, dtype=np.int64) - 1
+        block, ok = self._blocks(pos)
+        if not len(self):
+            return np.full(len(pos), -1, dtype=np.int64), ok
+        mapped = pos + self.offset[block]
+        reverse = ok & self.reverse[block]
+        mapped = np.where(reverse, self.qsize - 1 - mapped, mapped)
+        return np.where(ok, mapped + 1, -1), reverse
+
+    # map BED ranges (0-based, end exclusive)
+    # returns the starts and ends of the mapped pieces, the index of the
+    # range each piece is from, in order of the ranges, and the number of
+    # unmapped bases of each range; pieces of a range that are adjacent in
+    # the destination are joined
+    def map_ranges(self, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        # the blocks a range overlaps are first..last-1
+        first = np.searchsorted(self.tend, starts, side='right')
+        last = np.searchsorted(self.tstart, ends, side='left')
+        nblocks = np.maximum(last - first, 0)
+        src = np.repeat(np.arange(len(starts)), nblocks)
+        block = first[src] + np.arange(len(src)) - (np.cumsum(nblocks) - nblocks)[src]
+        ps = np.maximum(starts[src], self.tstart[block])
+        pe = np.minimum(ends[src], self.tend[block])
+        lost = (ends - starts) - np.bincount(src, weights=pe - ps,
+                                             minlength=len(starts)).astype(np.int64)
+        qs = ps + self.offset[block]
+        qe = pe + self.offset[block]
+        reverse = self.reverse[block]
+        qs, qe = np.where(reverse, self.qsize - qe, qs), np.where(reverse, self.qsize - qs, qe)
+        if len(src):
+            # a piece continues the one before if it is from the same range
+            # and strand and starts where that one ends in the destination
+            joined = (src[1:] == src[:-1]) & (reverse[1:] == reverse[:-1]) & \
+                np.where(reverse[1:], qe[1:] == qs[:-1], qs[1:] == qe[:-1])
+            heads = np.flatnonzero(np.concatenate(([True], ~joined)))
+            qs = np.minimum.reduceat(qs, heads)
+            qe = np.maximum.reduceat(qe, heads)
+            src = src[heads]
+        return qs, qe, src, lost
+
+
+# the source positions of s..e (end exclusive) that no interval of the
+# sorted, non-overlapping intervals starts..ends covers, as (s, e) pieces
+def _uncovered(starts, ends, s, e):
+    i = bisect.bisect_right(ends, s)
+    while i < len(starts) and starts[i] < e:
+        if starts[i] > s:
+            yield s, starts[i]
+        s = max(s, ends[i])
+        i += 1
+    if s < e:
+        yield s, e
+
+# the chain file of a liftover, by the UCSC naming, or None if there is none
+def chain_path(src, dst):
+    base = os.path.join(config['REDUX_DATA'], config['liftover_dir'],
+                        '{}To{}.over.chain'.format(src, dst[:1].upper() + dst[1:]))
+    for fname in (base + '.gz', base):
+        if os.path.exists(fname):
+            return fname
+    return None
+
+# the ChainMap from build src to build dst, or None if there is no chain file
+@functools.lru_cache(maxsize=None)
+def get_liftover(src, dst):
+    from lib import trace
+    fname = chain_path(src, dst)
+    if fname is None:
+        return None
+    chain = ChainMap.read(fname, src=src, dst=dst)
+    trace(2, '{} blocks from {}'.format(len(chain), fname))
+    return chain
+
+# the alleles of mapped calls, complemented where reverse is set
+def complement_alleles(alleles, reverse):
+    return [a.translate(COMPLEMENT)[::-1] if r else a
+            for a, r in zip(alleles, np.asarray(reverse).tolist())]
+
+
+if __name__ == '__main__':
+    import argparse,time
+    from lib import trace
+    parser = argparse.ArgumentParser(description='lift BED ranges or positions to another build')
+    parser.add_argument('-f', '--src', help='build of the input', default='hg19')
+    parser.add_argument('-t', '--dst', help='build of the output', default='hg38')
+    parser.add_argument('-c', '--chain', help='chain file (default: by build, under liftover_dir)')
+    parser.add_argument('-p', '--positions', help='input has a 1-based position per line',
+                        action='store_true')
+    parser.add_argument('-u', '--unmapped', help='file for what does not map (default: OUTPUT.unmap)')
+    parser.add_argument('input')
+    parser.add_argument('output')
+    args = parser.parse_args()
+    chainfile = args.chain or chain_path(args.src, args.dst)
+    if not chainfile:
+        parser.error('no chain file from {} to {}'.format(args.src, args.dst))
+    t0 = time.time()
+    chain = ChainMap.read(chainfile, src=args.src, dst=args.dst)
+    unmapped = args.unmapped or args.output + '.unmap'
+    with open(args.input) as f:
+        lines = [line.split() for line in f if line.strip() and not line.startswith(('#', 'track'))]
+    t1 = time.time()
+    with open(args.output, 'w') as out, open(unmapped, 'w') as unmap:
+        if args.positions:
+            pos = np.array([int(l[0]) for l in lines], dtype=np.int64)
+            mapped, reverse = chain.map_positions(pos)
+            for p, m in zip(pos.tolist(), mapped.tolist()):
+                print('{}\t{}'.format(p, m), file=out if m >= 0 else unmap)
+            nlost = np.count_nonzero(mapped < 0)
+        else:
+            starts = np.array([int(l[1]) for l in lines], dtype=np.int64)
+            ends = np.array([int(l[2]) for l in lines], dtype=np.int64)
+            qs, qe, src, lost = chain.map_ranges(starts, ends)
+            for s, e, i in zip(qs.tolist(), qe.tolist(), src.tolist()):
+                l = lines[i]
+                print('\t'.join([l[0], str(s), str(e)] + l[3:]), file=out)
+            for i in np.flatnonzero(lost).tolist():
+                print('\t'.join(lines[i] + [str(lost[i])]), file=unmap)
+            nlost = np.count_nonzero(lost)
+    trace(0, '{} of {} {} not fully mapped (read {:.2f}s, mapped {:.2f}s)'.format(
+        nlost, len(lines), 'positions' if args.positions else 'ranges',
+        t1 - t0, time.time() - t1))
@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# kit-to-kit matching: shared and differing variants of all pairs of kits
+#
+# For a pair of kits i and j:
+#   nshared  - variants both kits are positive for
+#   ndiff    - variants one kit is positive for and the other is not, counting
+#              only variants the other kit has a call or BED coverage for
+#   covered  - bases covered by the BED ranges of both kits, estimated from
+#              their coverage of bins of match_bin_size bases
+#   distance - ndiff per million covered bases, so that kits with little
+#              coverage in common do not look closer than they are
+# A kit is positive for a variant with any positive or mixed call, PASS or
+# not, as in bitset.KitSets. The matches of a kit are the match_top_k kits
+# with the smallest distance, ties going to more shared variants.
+#
+# With P the positive and U the uncalled variant x kit indicators of the call
+# matrix, and p the number of variants each kit is positive for,
+#   nshared = P'P
+#   ndiff = p_i - (P'U)_ij - nshared + p_j - (U'P)_ij - nshared
+# An Indicator holds, for each variant, the kits it is set for, or, if that
+# is more than half of them, the kits it is not set for, with a negative
+# sign; so no variant costs more than (nkits/2)^2 in a product, and the
+# variants every kit shares cost nothing. The products are scipy sparse
+# products, or popcounts of bitsets (see bitset.py) without scipy. Kits are
+# compared a block at a time, holding only a block of rows of the kit x kit
+# counts.
+#
+# match_all stores the matches of all kits in the matches table and saves
+# the indicators and binned coverage as the match index (match_index under
+# REDUX_DATA). match_kit compares one new or re-loaded kit with the kits in
+# the index and adds it to the index, to the matches table and to the
+# matches of the kits it is close to. Its variants that no kit of the index
+# has are private to it; how many of them each other kit covers is estimated
+# from the binned coverage. match_all recounts everything exactly.
+
+import os
+import numpy as np
+from reduxconfig import config
+from runstats import timed, span
+from callmatrix import CALL_MASK, CALL_UNCALLED, CALL_FAILMIXED
+from bitset import popcount
+
+
+# the scipy.sparse module, or None without scipy
+def _scipy_sparse():
+    try:
+        import scipy.sparse
+        return scipy.sparse
+    except ImportError:
+        return None
+
+# the cells of a bool (variants x kits) block of rows starting at row start,
+# in Indicator form: high flags of the variants, kits and variants of cells
+def _cells(mask, start):
+    high = 2 * mask.sum(axis=1) > mask.shape[1]
+    mask = np.where(high[:, None], ~mask, mask)
+    vv, kk = np.nonzero(mask)
+    return high, kk.astype(np.int32), (vv + start).astype(np.int32)
+
+
+# a variant x kit indicator matrix, held kit by kit; see above
+# high flags the variants whose cells are the kits they are not set for;
+# kits and variants are the cells held, sorted by kit. sparse selects scipy
+# (True) or bitsets (False); by default, scipy if it is installed.
+class Indicator(object):
+
+    def __init__(self, nkits, high, kits, variants, sparse=None):
+        self.nkits = nkits
+        self.high = np.asarray(high, dtype=bool)
+        self.kits = np.asarray(kits, dtype=np.int32)
+        self.variants = np.asarray(variants, dtype=np.int32)
+        self.sp = _scipy_sparse() if sparse in (None, True) else None
+        if sparse and self.sp is None:
+            raise ImportError('scipy is not available')
+        self.sign = np.where(self.high[self.variants], -1, 1).astype(np.int32)
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(self.kits, minlength=nkits))))
+        nvar = len(self.high)
+        if self.sp is not None:
+            self.rows = self.sp.csr_matrix((self.sign, self.variants, self.indptr),
+                                           shape=(nkits, nvar))
+        else:
+            # cells of variants held as they are, and of high variants
+            bits = np.zeros((2, nkits, 8 * ((nvar + 63) // 64)), dtype=np.uint8)
+            np.bitwise_or.at(bits, ((self.sign < 0).astype(np.intp), self.kits,
+                                    self.variants >> 3),
+                             (128 >> (self.variants & 7)).astype(np.uint8))
+            self.bits = bits.view(np.uint64)
+        self._counts = None
+
+    # from a list of blocks of _cells
+    @classmethod
+    def from_cells(cls, nkits, blocks, sparse=None):
+        if not blocks:
+            return cls(nkits, [], [], [], sparse)
+        high, kits, variants = [np.concatenate(parts) for parts in zip(*blocks)]
+        order = np.argsort(kits, kind='stable')
+        return cls(nkits, high, kits[order], variants[order], sparse)
+
+    @property
+    def sparse(self):
+        return self.sp is not None
+
+    # number of variants set for each kit
+    def counts(self):
+        if self._counts is None:
+            self._counts = int(self.high.sum()) + \
+                self._hdot(np.ones(len(self.high), dtype=np.int64))
+        return self._counts
+
+    # sum over the held cells of each kit of the sign times h of the variant
+    def _hdot(self, h):
+        if self.sparse:
+            return self.rows @ h
+        return np.rint(np.bincount(self.kits, weights=self.sign * h[self.variants],
+                                   minlength=self.nkits)).astype(np.int64)
+
+    # rows of X'Y for this indicator X and other Y: for each kit in rows and
+    # each kit j of other, the number of variants set for both, as an int64
+    # (len(rows), other.nkits) array
+    def dot(self, other, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        hx = self.high.astype(np.int64)
+        hy = other.high.astype(np.int64)
+        res = np.full((len(rows), other.nkits), int(hx @ hy), dtype=np.int64)
+        res += self._hdot(hy)[rows, None]
+        res += other._hdot(hx)[None, :]
+        if self.sparse:
+            res += (self.rows[rows] @ other.rows.T).toarray()
+        else:
+            oset, ohigh = other.bits
+            for n, (xset, xhigh) in enumerate(zip(self.bits[0][rows], self.bits[1][rows])):
+                res[n] += popcount(oset & xset) - popcount(ohigh & xset) - \
+                    popcount(oset & xhigh) + popcount(ohigh & xhigh)
+        return res
+
+    # this indicator with the cells of kit k set from a bool vector over the
+    # variants; k may be nkits, to add a kit
+    def set_kit(self, k, mask):
+        vv = np.flatnonzero(np.where(self.high, ~mask, mask)).astype(np.int32)
+        lo, hi = (self.indptr[k], self.indptr[k+1]) if k < self.nkits else (len(self.kits),)*2
+        return Indicator(max(self.nkits, k+1), self.high,
+                         np.concatenate((self.kits[:lo], np.full(len(vv), k, dtype=np.int32),
+                                         self.kits[hi:])),
+                         np.concatenate((self.variants[:lo], vv, self.variants[hi:])),
+                         self.sparse)
+
+    # the arrays to save an indicator in, with names starting with prefix
+    def arrays(self, prefix):
+        return {prefix + 'high': self.high, prefix + 'kits': self.kits,
+                prefix + 'variants': self.variants}
+
+
+# ndiff per million bases covered by both kits; inf if they share no coverage
+def match_distance(ndiff, covered):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(covered > 0, ndiff * 1e6 / np.maximum(covered, 1), np.inf)
+
+
+# the indicators and binned coverage of a set of kits, in the order of pids;
+# see above
+class MatchIndex(object):
+
+    def __init__(self, pids, vids, positions, pos, uncalled, binned, lo, binsize):
+        self.pids = np.asarray(pids, dtype=np.int64)
+        self.vids = vids
+        self.positions = positions
+        self.pos = pos
+        self.uncalled = uncalled
+        # whole bases per bin, so that float64 products are exact
+        self.binned = np.asarray(binned, dtype=np.float64)
+        self.lo = lo
+        self.binsize = binsize
+        self.kitrow = dict((p, ii) for ii, p in enumerate(self.pids.tolist()))
+
+    @property
+    def nkits(self):
+        return len(self.pids)
+
+    # from a CallMatrix and the (starts, ends) BED ranges of each of its kits
+    @classmethod
+    def from_call_matrix(cls, cm, kitranges, sparse=None, binsize=None, block=4096):
+        from coverage import binned_coverage
+        if binsize is None:
+            binsize = config['match_bin_size']
+        nvar, nkits = cm.shape
+        pcells, ucells = [], []
+        for start in range(0, nvar, block):
+            codes = cm.rows(start, start+block) & CALL_MASK
+            pcells.append(_cells(codes >= CALL_FAILMIXED, start))
+            ucells.append(_cells(codes == CALL_UNCALLED, start))
+        starts = [s for (s, e) in kitranges if len(s)]
+        ends = [e for (s, e) in kitranges if len(e)]
+        if starts:
+            lo = int(min(s.min() for s in starts)) // binsize * binsize
+            nbins = -(-(int(max(e.max() for e in ends)) - lo) // binsize)
+        else:
+            lo, nbins = 0, 0
+        return cls(cm.pids, cm.vids, cm.positions,
+                   Indicator.from_cells(nkits, pcells, sparse),
+                   Indicator.from_cells(nkits, ucells, sparse),
+                   binned_coverage(kitranges, lo, binsize, nbins), lo, binsize)
+
+    # nshared, ndiff, covered and distance (see above) of the kits in rows
+    # with all kits, as (len(rows), nkits) arrays; extra is added to ndiff
+    # A kit's distance to itself is inf.
+    def compare(self, rows, extra=None):
+        rows = np.asarray(rows, dtype=np.int64)
+        npos = self.pos.counts()
+        nshared = self.pos.dot(self.pos, rows)
+        ndiff = (npos[rows, None] - self.pos.dot(self.uncalled, rows) - nshared) + \
+            (npos[None, :] - self.uncalled.dot(self.pos, rows) - nshared)
+        if extra is not None:
+            ndiff += extra
+        covered = np.rint(self.binned[rows] @ self.binned.T / self.binsize).astype(np.int64)
+        distance = match_distance(ndiff, covered)
+        distance[np.arange(len(rows)), rows] = np.inf
+        return nshared, ndiff, covered, distance
+
+    # the k best matches of the kits in rows, as matches table rows
+    # (pID, rank, matchID, nshared, ndiff, covered, distance); counts are
+    # what compare returns for the rows, computed if not given
+    def matches(self, rows, k, counts=None):
+        rows = np.asarray(rows, dtype=np.int64)
+        nshared, ndiff, covered, distance = counts or self.compare(rows)
+        order = np.lexsort((-nshared, distance))[:, :k]
+        result = []
+        for n, row in enumerate(rows.tolist()):
+            best = order[n][np.isfinite(distance[n, order[n]])]
+            result.extend((int(self.pids[row]), rank+1, int(self.pids[j]),
+                           int(nshared[n, j]), int(ndiff[n, j]), int(covered[n, j]),
+                           float(distance[n, j]))
+                          for rank, j in enumerate(best.tolist()))
+        return result
+
+    # set the calls and coverage of kit pid from the stores, adding the kit
+    # if it is not in the index; returns its row and the positions of its
+    # positive variants that are not in the index
+    def set_kit(self, dbo, pid):
+        from lib import unpack_calls, get_callinfo_version
+        from kitstore import call_store, bed_store
+        from callmatrix import kit_call_codes
+        from coverage import _sorted_coverage, binned_coverage
+        kvids, callinfo = call_store(dbo).get_calls(pid)
+        kvids = np.asarray(kvids, dtype=np.int64)
+        unpacked = unpack_calls(callinfo, get_callinfo_version(dbo))
+        kpos, derived = _kit_variants(dbo, kvids)
+        starts, ends = bed_store(dbo).get_ranges(pid)
+        covered = _sorted_coverage(starts, ends, self.positions)[0]
+        codes = kit_call_codes(self.vids, self.positions, np.argsort(self.vids, kind='stable'),
+                               covered, kvids, kpos, unpacked['passfail'].astype(bool),
+                               unpacked['passrate'], config['mixed_call_rate']) & CALL_MASK
+        row = self.kitrow.get(pid, self.nkits)
+        self.pos = self.pos.set_kit(row, codes >= CALL_FAILMIXED)
+        self.uncalled = self.uncalled.set_kit(row, codes == CALL_UNCALLED)
+        binned = binned_coverage([(starts, ends)], self.lo, self.binsize, self.binned.shape[1])
+        if row == self.nkits:
+            self.pids = np.append(self.pids, pid)
+            self.kitrow[pid] = row
+            self.binned = np.vstack((self.binned, binned))
+        else:
+            self.binned[row] = binned[0]
+        # private: positive calls for variants that are not in the index
+        svids = np.sort(self.vids)
+        ii = np.minimum(np.searchsorted(svids, kvids), max(len(svids)-1, 0))
+        known = (svids[ii] == kvids) if len(svids) else np.zeros(len(kvids), dtype=bool)
+        return row, kpos[derived & ~known]
+
+    # the number of positions each kit is estimated to cover, from the binned
+    # coverage
+    def estimated_coverage(self, positions):
+        bins = (np.asarray(positions, dtype=np.int64) - self.lo) // self.binsize
+        bins = bins[(bins >= 0) & (bins < self.binned.shape[1])]
+        return np.rint(self.binned[:, bins].sum(axis=1, dtype=np.float64) /
+                       self.binsize).astype(np.int64)
+
+    def save(self, fname):
+        arrays = {'pids': self.pids, 'vids': self.vids, 'positions': self.positions,
+                  'binned': self.binned.astype(np.float32), 'lo': self.lo, 'binsize': self.binsize}
+        arrays.update(self.pos.arrays('pos_'))
+        arrays.update(self.uncalled.arrays('unc_'))
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmpname, fname)
+
+    @classmethod
+    def load(cls, fname, sparse=None):
+        with np.load(fname) as z:
+            nkits = len(z['pids'])
+            indicators = [Indicator(nkits, z[key+'high'], z[key+'kits'], z[key+'variants'],
+                                    sparse) for key in ('pos_', 'unc_')]
+            return cls(z['pids'], z['vids'], z['positions'], indicators[0], indicators[1],
+                       z['binned'], int(z['lo']), int(z['binsize']))
+
+
+# positions of a kit's variants, and which of them are not reference calls
+def _kit_variants(dbo, kvids):
+    pos = np.zeros(len(kvids), dtype=np.int32)
+    ref = np.ones(len(kvids), dtype=bool)
+    order = np.argsort(kvids, kind='stable')
+    skvids = kvids[order]
+    for start in range(0, len(kvids), 500):
+        chunk = skvids[start:start+500].tolist()
+        rows = dbo.dc.execute('''select v.id, v.pos, a.allele='.' from variants v
+                                 inner join alleles a on a.id=v.der
+                                 where v.id in ({})'''.format(','.join('?' * len(chunk))),
+                              chunk).fetchall()
+        table = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        ii = order[start + np.searchsorted(chunk, table[:, 0])]
+        pos[ii] = table[:, 1]
+        ref[ii] = table[:, 2] != 0
+    return pos, ~ref
+
+# the path of the match index
+def match_index_path():
+    return os.path.join(config['REDUX_DATA'], config['match_index'])
+
+# write the matches of kits to the matches table, replacing their old ones;
+# rows as MatchIndex.matches returns them
+def store_matches(dbo, pids, rows):
+    dbo.dc.executemany('delete from matches where pID=?', [(p,) for p in pids])
+    dbo.dc.executemany('''insert into matches(pID,rank,matchID,nshared,ndiff,covered,distance)
+                          values(?,?,?,?,?,?,?)''', rows)
+
+# compare all kits with each other, store the k (default match_top_k) best
+# matches of each kit and save the match index
+# cm is the call matrix of the kits, built if not given
+# returns the MatchIndex
+@timed('matches')
+def match_all(dbo, cm=None, k=None, sparse=None, block=256):
+    from lib import trace
+    from kitstore import bed_store
+    from callmatrix import build_call_matrix
+    if k is None:
+        k = config['match_top_k']
+    if cm is None:
+        cm = build_call_matrix(dbo)
+    with span('match index'):
+        bstore = bed_store(dbo)
+        index = MatchIndex.from_call_matrix(cm, [bstore.get_ranges(p) for p in cm.pids.tolist()],
+                                            sparse)
+    trace(1, 'matching {} kits on {} variants'.format(index.nkits, len(index.vids)))
+    rows = []
+    with span('compare kits', rows=index.nkits):
+        for start in range(0, index.nkits, block):
+            rows.extend(index.matches(np.arange(start, min(start+block, index.nkits)), k))
+            trace(2, 'matches: {} of {} kits'.format(min(start+block, index.nkits), index.nkits))
+    dbo.dc.execute('delete from matches')
+    store_matches(dbo, [], rows)
+    dbo.commit()
+    index.save(match_index_path())
+    return index
+
+# match one new or re-loaded kit against the match index (see above); runs
+# match_all if there is no index yet
+# returns the kit's matches, as matches table rows
+@timed('match kit')
+def match_kit(dbo, pid, k=None, sparse=None):
+    from lib import trace
+    if k is None:
+        k = config['match_top_k']
+    fname = match_index_path()
+    if not os.path.exists(fname):
+        trace(1, 'no match index yet - matching all kits')
+        match_all(dbo, k=k, sparse=sparse)
+    else:
+        index = MatchIndex.load(fname, sparse)
+        row, private = index.set_kit(dbo, pid)
+        counts = index.compare([row], index.estimated_coverage(private)[None, :])
+        mine = index.matches([row], k, counts)
+        # add the kit to the matches of the other kits it is closer to than
+        # their worst match, or move it in them
+        nshared, ndiff, covered, distance = [c[0] for c in counts]
+        worst = dict((p, (d, n)) for p, d, n in dbo.dc.execute(
+            'select pID, max(distance), count(*) from matches group by pID'))
+        listed = set(p for (p,) in dbo.dc.execute(
+            'select pID from matches where matchID=?', (pid,)))
+        changed = set()
+        for j in np.flatnonzero(np.isfinite(distance)).tolist() + \
+                [index.kitrow[p] for p in listed if p in index.kitrow]:
+            other = int(index.pids[j])
+            if other in changed:
+                continue
+            d, n = worst.get(other, (None, 0))
+            if other not in listed and n >= k and distance[j] > d:
+                continue
+            kept = [m for m in dbo.dc.execute('''select matchID,nshared,ndiff,covered,distance
+                                                from matches where pID=? and matchID!=?
+                                                order by rank''', (other, pid))]
+            if np.isfinite(distance[j]):
+                kept.append((pid, int(nshared[j]), int(ndiff[j]), int(covered[j]),
+                             float(distance[j])))
+            kept = sorted(kept, key=lambda m: (m[4], -m[1]))[:k]
+            changed.add(other)
+            mine.extend((other, rank+1) + m for rank, m in enumerate(kept))
+        store_matches(dbo, [pid] + sorted(changed), mine)
+        dbo.commit()
+        index.save(fname)
+        trace(1, 'matched kit {} against {} kits ({} private variants)'.format(
+            pid, index.nkits - 1, len(private)))
+    return dbo.dc.execute('''select pID,rank,matchID,nshared,ndiff,covered,distance
+                             from matches where pID=? order by rank''', (pid,)).fetchall()
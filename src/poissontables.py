@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# Poisson look-up table for the age analysis, generated on demand
+#
+# This replaces the fixed text table cpoisson.tbl of versions/redux_1-0-1:
+# one row per number of standard deviations sigma, from -cpoisson_sigma_max
+# to cpoisson_sigma_max in steps of cpoisson_sigma_step: (sigma, Phi(sigma),
+# m(0), ..., m(n), offset), where m(k) is the Poisson mean for which
+# P(X <= k) = Phi(sigma), for k up to cpoisson_max_count, and offset corrects
+# the Gaussian approximation m(k) = k - sigma*sqrt(k) + offset for larger k.
+# It gives the confidence intervals of the raw ages (ages.raw_ages). There
+# is no counterpart of poisson.tbl: the age PDFs evaluate the Poisson
+# likelihood directly, in log space (ages.snp_loglik).
+# The table is written as a .npy file under REDUX_DATA/poisson_dir and
+# loaded memory-mapped. The parameters it was generated with are kept in the
+# meta table, and it is generated again only when they change.
+
+import os,json,math
+import numpy as np
+from reduxconfig import config
+
+# column of m(0) in the cpoisson table
+CPOIS_M0 = 2
+
+# bisection steps of make_cpoisson_table; the means are found to within
+# 2**-60 of their upper bound
+BISECT_STEPS = 60
+
+
+# P(X <= k) of the Poisson distribution with mean m, for a vector of means
+def _poisson_cdf(k, m):
+    j = np.arange(k + 1)
+    lgam = np.array([math.lgamma(i + 1) for i in j.tolist()])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logterms = np.where(j[None, :] > 0, j[None, :] * np.log(m)[:, None], 0)
+    return np.exp(logterms - m[:, None] - lgam).sum(axis=1)
+
+# the cpoisson table
+# Each mean is solved for by bisection, for all sigmas of a count at once;
+# P(X <= k) falls as the mean grows, from 1 at a mean of 0.
+def make_cpoisson_table(sigstep, sigmax, maxcount):
+    nsig = int(round(sigmax / sigstep))
+    sigmas = np.arange(-nsig, nsig + 1) * sigstep
+    probs = np.array([.5 * math.erfc(-s / math.sqrt(2)) for s in sigmas.tolist()])
+    table = np.zeros((len(sigmas), maxcount + 4))
+    table[:, 0] = sigmas
+    table[:, 1] = probs
+    for k in range(maxcount + 1):
+        lo = np.zeros(len(sigmas))
+        hi = np.full(len(sigmas), k + (sigmax + 3) * math.sqrt(k + 1) + 20)
+        for _ in range(BISECT_STEPS):
+            mid = (lo + hi) / 2
+            above = _poisson_cdf(k, mid) > probs
+            lo = np.where(above, mid, lo)
+            hi = np.where(above, hi, mid)
+        table[:, CPOIS_M0 + k] = (lo + hi) / 2
+    table[:, -1] = table[:, CPOIS_M0 + maxcount] - (maxcount - sigmas * math.sqrt(maxcount))
+    return table
+
+# a table from the cache, generated with make(**params) if it is missing or
+# its parameters changed
+def _cached_table(dbo, name, make, params):
+    key = json.dumps(params, sort_keys=True)
+    fname = os.path.join(config['REDUX_DATA'], config['poisson_dir'], name + '.npy')
+    row = dbo.dc.execute('select val from meta where descr=?', (name,)).fetchone()
+    if not row or row[0] != key or not os.path.exists(fname):
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmpname = fname + '.tmp'
+        with open(tmpname, 'wb') as f:
+            np.save(f, make(**params))
+        os.replace(tmpname, fname)
+        dbo.dc.execute('delete from meta where descr=?', (name,))
+        dbo.dc.execute('insert into meta(descr,val) values(?,?)', (name, key))
+    return np.load(fname, mmap_mode='r')
+
+# the cpoisson table, memory-mapped
+def cpoisson_table(dbo, sigstep=None, sigmax=None, maxcount=None):
+    params = {'sigstep': config['cpoisson_sigma_step'] if sigstep is None else sigstep,
+              'sigmax': config['cpoisson_sigma_max'] if sigmax is None else sigmax,
+              'maxcount': config['cpoisson_max_count'] if maxcount is None else maxcount}
+    return _cached_table(dbo, 'cpoisson_table', make_cpoisson_table, params)
+
+# the Poisson means at the lower and upper end of the confidence interval of
+# +/- sigma standard deviations, for observed counts; from a cpoisson table,
+# interpolated between its rows, and by the Gaussian approximation beyond its
+# largest count
+def poisson_interval(table, counts, sigma=1.96):
+    counts = np.asarray(counts, dtype=np.float64)
+    maxcount = table.shape[1] - CPOIS_M0 - 2
+    bounds = []
+    for s in (sigma, -sigma):
+        i = int(np.clip(np.searchsorted(table[:, 0], s), 1, len(table) - 1))
+        frac = (s - table[i-1, 0]) / (table[i, 0] - table[i-1, 0])
+        row = table[i-1] + frac * (table[i] - table[i-1])
+        k = np.clip(counts, 0, maxcount).astype(np.int64)
+        gauss = counts - s * np.sqrt(counts) + row[-1]
+        bounds.append(np.where(counts <= maxcount, row[CPOIS_M0 + k], gauss))
+    return bounds[0], bounds[1]
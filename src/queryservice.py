@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# read-only queries of the variant database, while the pipeline writes to it
+#
+# A QueryService keeps a pool of up to query_pool_size read-only connections
+# (DB(readonly=True)). Each lookup takes a connection from the pool and reads
+# in one transaction: a snapshot of what the writer last committed, as the
+# database is in WAL mode (see db_readers in config.yaml), so a lookup never
+# sees part of a load. That holds for calls stored in the database (the table
+# and blob call stores) only: the files of the npy store are replaced after
+# the writer commits (see DB.stage_file) and are not part of the snapshot, so
+# a calls lookup during a load may see a kit's calls from just before or just
+# after a commit, or a mix of the two while a replaced kit's files are moved
+# into place. The lookups run the fixed statements of QUERIES,
+# which sqlite3 prepares once per connection and keeps in its statement
+# cache.
+#   kit(kitid)              - a kit, by lab kit ID or kit name
+#   variants_at(pos, build) - the variants at a position, with their names
+#   snp(name)               - the variants with a SNP name
+#   calls(kitid)            - the calls of a kit, with position, alleles and
+#                             call quality, in order of position
+#   matches(kitid)          - the closest matches of a kit (see matching.py)
+#   query(sql, params)      - any other query, e.g. of sql/sample-queries.txt
+# Results are dicts or lists of dicts, so that they are also JSON; a lookup
+# of an unknown kit returns None.
+#
+# serve answers the same lookups over HTTP, as JSON, on localhost only,
+# after prepare has put the database in query mode (DB.query_mode):
+#   GET /kit/KITID  /variants/POS[?build=hg19]  /snp/NAME  /calls/KITID
+#       /matches/KITID
+#
+# Run as a command (or redux.py --serve): queryservice.py [-p PORT]
+
+import os,json,queue,sqlite3,threading
+from contextlib import contextmanager
+from reduxconfig import config
+from db import DB
+
+# variant IDs per statement of calls; shorter lists are padded, so that
+# every call lookup runs the same statement
+ID_CHUNK = 500
+
+QUERIES = {
+    'kit': '''select d.ID as pID, d.kitId, d.kitName, s.surname, c.country,
+                     b.buildNm as build, l.labNm as lab, t.testNm as testType,
+                     d.birthYr, d.lat, d.lng, d.approxHg
+              from dataset d
+              left join surname s on s.ID=d.surnameID
+              left join country c on c.ID=d.countryID
+              left join build b on b.ID=d.buildID
+              left join lab l on l.ID=d.labID
+              left join testtype t on t.ID=d.testTypeID
+              where d.kitId=?''',
+    'kit_by_name': 'select kitId from dataset where kitName=? order by ID limit 1',
+    'variants_at': '''select v.ID as vID, b.buildNm as build, v.pos, aa.allele as anc,
+                             ab.allele as der
+                      from variants v
+                      inner join build b on b.ID=v.buildID
+                      inner join alleles aa on aa.ID=v.anc
+                      inner join alleles ab on ab.ID=v.der
+                      where v.buildID=(select ID from build where buildNm=?) and v.pos=?
+                      order by v.ID''',
+    'snp': '''select v.ID as vID, b.buildNm as build, v.pos, aa.allele as anc,
+                     ab.allele as der
+              from snpnames sn
+              inner join variants v on v.ID=sn.vID
+              inner join build b on b.ID=v.buildID
+              inner join alleles aa on aa.ID=v.anc
+              inner join alleles ab on ab.ID=v.der
+              where sn.snpname=?
+              order by v.buildID, v.pos''',
+    'names': 'select snpname from snpnames where vID=? order by snpname',
+    'call_variants': '''select v.ID, v.pos, aa.allele, ab.allele
+                        from variants v
+                        inner join alleles aa on aa.ID=v.anc
+                        inner join alleles ab on ab.ID=v.der
+                        where v.ID in ({})'''.format(','.join('?' * ID_CHUNK)),
+    'matches': '''select m.rank, d.kitId, m.nshared, m.ndiff, m.covered, m.distance
+                  from matches m
+                  inner join dataset d on d.ID=m.matchID
+                  where m.pID=?
+                  order by m.rank''',
+    }
+
+
+# rows of a cursor as dicts
+def _dicts(cursor):
+    cols = [c[0] for c in cursor.description]
+    return [dict(zip(cols, row)) for row in cursor]
+
+
+class QueryService(object):
+
+    # dbfname defaults to DB_FILE, size to query_pool_size
+    def __init__(self, dbfname=None, size=None):
+        self.dbfname = dbfname or config['DB_FILE']
+        self.size = size or config['query_pool_size']
+        self.idle = queue.LifoQueue()
+        self.nopen = 0
+        self.lock = threading.Lock()
+
+    # a connection of the pool, reading one snapshot:
+    #   with service.snapshot() as dbo:
+    #       dbo.dc.execute(...)
+    # Waits for a connection if all query_pool_size of them are in use.
+    @contextmanager
+    def snapshot(self):
+        dbo = self._acquire()
+        try:
+            dbo.dc.execute('begin')
+            yield dbo
+        finally:
+            dbo.db.rollback()
+            self.idle.put(dbo)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            opening = self.nopen < self.size
+            if opening:
+                self.nopen += 1
+        if not opening:
+            return self.idle.get()
+        try:
+            return DB(self.dbfname, readonly=True)
+        except:
+            with self.lock:
+                self.nopen -= 1
+            raise
+
+    # close the idle connections
+    def close(self):
+        while True:
+            try:
+                dbo = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            dbo.close()
+            dbo.db.close()
+            with self.lock:
+                self.nopen -= 1
+
+    # the dataset row of a kit, by lab kit ID or else kit name
+    def _kit(self, dbo, kitid):
+        row = _dicts(dbo.dc.execute(QUERIES['kit'], (kitid,)))
+        if not row:
+            alias = dbo.dc.execute(QUERIES['kit_by_name'], (kitid,)).fetchone()
+            if alias:
+                row = _dicts(dbo.dc.execute(QUERIES['kit'], alias))
+        return row[0] if row else None
+
+    # the variants of a list of dicts with a vID, with their names added
+    def _named(self, dbo, variants):
+        for v in variants:
+            v['names'] = [n for (n,) in dbo.dc.execute(QUERIES['names'], (v['vID'],))]
+        return variants
+
+    def kit(self, kitid):
+        with self.snapshot() as dbo:
+            return self._kit(dbo, kitid)
+
+    def variants_at(self, pos, build='hg38'):
+        with self.snapshot() as dbo:
+            return self._named(dbo, _dicts(dbo.dc.execute(QUERIES['variants_at'],
+                                                          (build, int(pos)))))
+
+    def snp(self, name):
+        with self.snapshot() as dbo:
+            return self._named(dbo, _dicts(dbo.dc.execute(QUERIES['snp'], (name,))))
+
+    # with the npy call store, the calls are read from files outside the
+    # snapshot (see above)
+    def calls(self, kitid):
+        import numpy as np
+        from kitstore import call_store
+        from lib import unpack_calls, get_callinfo_version
+        with self.snapshot() as dbo:
+            kit = self._kit(dbo, kitid)
+            if kit is None:
+                return None
+            vids, callinfo = call_store(dbo).get_calls(kit['pID'])
+            unpacked = unpack_calls(callinfo, get_callinfo_version(dbo))
+            variants = {}
+            ids = np.asarray(vids).tolist()
+            for start in range(0, len(ids), ID_CHUNK):
+                chunk = ids[start:start+ID_CHUNK]
+                chunk += [-1] * (ID_CHUNK - len(chunk))
+                for vid, pos, anc, der in dbo.dc.execute(QUERIES['call_variants'], chunk):
+                    variants[vid] = (pos, anc, der)
+        calls = []
+        for vid, info in zip(ids, unpacked.tolist()):
+            pos, anc, der = variants.get(vid, (None, None, None))
+            calls.append({'vID': vid, 'pos': pos, 'anc': anc, 'der': der,
+                          'pass': bool(info[0]), 'q1': info[1], 'q2': info[2],
+                          'nreads': info[3], 'passrate': info[4]})
+        calls.sort(key=lambda c: (c['pos'] is None, c['pos']))
+        return calls
+
+    def matches(self, kitid):
+        with self.snapshot() as dbo:
+            kit = self._kit(dbo, kitid)
+            if kit is None:
+                return None
+            return _dicts(dbo.dc.execute(QUERIES['matches'], (kit['pID'],)))
+
+    def query(self, sql, params=()):
+        with self.snapshot() as dbo:
+            return _dicts(dbo.dc.execute(sql, params))
+
+
+# the HTTP status and JSON-able result of a GET of path; see above
+def handle(service, path):
+    from urllib.parse import urlsplit, unquote, parse_qs
+    url = urlsplit(path)
+    parts = [unquote(p) for p in url.path.strip('/').split('/')]
+    args = parse_qs(url.query)
+    if len(parts) != 2:
+        return 404, {'error': 'not found'}
+    kind, key = parts
+    try:
+        if kind == 'kit':
+            result = service.kit(key)
+        elif kind == 'variants':
+            result = service.variants_at(int(key), args.get('build', ['hg38'])[0])
+        elif kind == 'snp':
+            result = service.snp(key)
+        elif kind == 'calls':
+            result = service.calls(key)
+        elif kind == 'matches':
+            result = service.matches(key)
+        else:
+            return 404, {'error': 'not found'}
+    except ValueError as e:
+        return 400, {'error': str(e)}
+    except sqlite3.Error as e:
+        return 500, {'error': str(e)}
+    if result is None:
+        return 404, {'error': 'unknown kit {}'.format(key)}
+    return 200, result
+
+# get the database ready for queries: rebuild any indexes that a failed
+# load left dropped and refresh the planner statistics (DB.query_mode)
+# This needs the write lock, so it is skipped while a load holds it; the
+# load ends in query mode itself.
+def prepare(dbfname):
+    from lib import trace
+    if not os.path.exists(dbfname):
+        return
+    dbo = DB(dbfname, drop=False)
+    try:
+        dbo.query_mode()
+    except sqlite3.OperationalError as e:
+        trace(1, 'database not prepared for queries: {}'.format(e))
+    finally:
+        dbo.close()
+        dbo.db.close()
+
+# answer lookups over HTTP on localhost port (default query_port) until
+# interrupted
+def serve(service=None, port=None):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from lib import trace
+    if service is None:
+        service = QueryService()
+    if port is None:
+        port = config['query_port']
+    prepare(service.dbfname)
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            status, result = handle(service, self.path)
+            body = json.dumps(result).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            trace(2, fmt % args)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    trace(0, 'answering queries of {} on http://127.0.0.1:{}/'.format(
+        service.dbfname, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='answer read-only queries of the database over HTTP on localhost')
+    parser.add_argument('-p', '--port', help='port to listen on (default query_port)', type=int)
+    args = parser.parse_args()
+    serve(port=args.port)
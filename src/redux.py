@@ -11,34 +11,20 @@
 
 import sys
 import argparse
-import yaml
 import os
-import glob
-import shutil
-import re,time,csv,zipfile
-from collections import defaultdict
+import time
+from reduxconfig import config
 from lib import *
 from db import DB
 from array_api import *
 
-# required environment vars:
-# REDUX_PATH - where the source code and config.yaml lives
+# environment variables:
+# REDUX_PATH - where config.yaml lives; without it, the config.yaml next to
+#   the source code is used (see reduxconfig.py)
 
-start_time = time.clock()
 t0 = time.time()
 trace (1, "Beginning run [%s]" % time.strftime("%H:%M:%S"))
 
-# environment variable required
-try:
-    sys.path.append(os.environ['REDUX_PATH'])
-    REDUX_CONF = os.path.join(os.environ['REDUX_PATH'], 'config.yaml')
-except:
-    trace(0,"Missing environment variable REDUX_PATH. Aborting.")
-    sys.exit()
-
-# parse the remainder of the configuration settings
-config = yaml.load(open(REDUX_CONF))
-
 
 # basic strategy for command-line arguments
 #  -command-line args mainly select one or more basic execution elements (below)
@@ -56,20 +42,36 @@ config = yaml.load(open(REDUX_CONF))
 # arg parser
 parser = argparse.ArgumentParser()
 # running
+parser.add_argument('--profile', help='time the stages of the run; save the timings in the runstats table and a JSON report (default runstats.json under REDUX_DATA)', nargs='?', const=data_path('runstats.json'), metavar='FILE')
 
 # tasks
 parser.add_argument('-a', '--all', help='perform all possible steps (prob best not to use for now)', action='store_true')
 parser.add_argument('-c', '--create', help='clean start with a new database', action='store_true')
 parser.add_argument('-l', '--loadkits', help='load all of the kits', action='store_true')
 parser.add_argument('-t', '--testdrive', help='runs some unit tests', action='store_true')
+parser.add_argument('-T', '--tree', help='build the haplotree from the loaded kits', action='store_true')
+parser.add_argument('-A', '--ages', help='compute the ages of the clades of the haplotree', action='store_true')
+parser.add_argument('-u', '--update-tree', help='place kits that are not in the haplotree yet into it', action='store_true')
+parser.add_argument('-m', '--matches', help='find the closest matches of every kit', action='store_true')
+parser.add_argument('--match-kit', help='match one new or re-loaded kit against the match index', metavar='KITID')
+parser.add_argument('-j', '--jobs', help='number of processes parsing kits (overrides ingest_workers)', type=int)
 
 # maintenance
 parser.add_argument('-b', '--backup', help='do a "backup"', action='store_true')
+parser.add_argument('--migrate-calls', help='move stored calls to another call store (table, blob or npy)', choices=('table', 'blob', 'npy'))
+parser.add_argument('--migrate-bed', help='move stored BED ranges to another BED store (table, blob or npy)', choices=('table', 'blob', 'npy'))
 
 # output
+parser.add_argument('--serve', help='answer read-only queries over HTTP on localhost (default port query_port)', nargs='?', const=config['query_port'], type=int, metavar='PORT')
+parser.add_argument('--newick', help='write the haplotree to a Newick file', metavar='FILE')
+parser.add_argument('--phyloxml', help='write the haplotree to a PhyloXML file', metavar='FILE')
 
 args = parser.parse_args()
 
+if args.profile:
+    from runstats import enable
+    enable()
+
 
 
 
@@ -81,21 +83,81 @@ if args.create:
 
 # load kits that were found in H-R web API and in zipdirs
 if args.loadkits:
-    populate_from_dataset(db)
+    populate_from_dataset(db, workers=args.jobs)
+
+# build the tree from the calls of all kits
+if args.tree:
+    from haplotree import make_tree
+    db = DB(drop=False)
+    make_tree(db)
+
+# add newly loaded kits to the tree, rebuilding only the clades they land in
+if args.update_tree:
+    from haplotree import place_kits
+    db = DB(drop=False)
+    place_kits(db)
+
+# clade ages, after the tree has been built or updated
+if args.ages:
+    from ages import populate_ages
+    db = DB(drop=False)
+    populate_ages(db, force=True)
+
+# matches of all kits, or of one kit
+if args.matches:
+    from matching import match_all
+    db = DB(drop=False)
+    match_all(db)
+
+if args.match_kit:
+    from matching import match_kit
+    db = DB(drop=False)
+    pid = db.dc.execute('select ID from dataset where kitId=?', (args.match_kit,)).fetchone()
+    if pid is None:
+        trace(0, 'unknown kit {}'.format(args.match_kit))
+    else:
+        for row in match_kit(db, pid[0]):
+            trace(0, '{:>3} {:>8} shared {:>5} differ {:>4} {:>9.2f} per Mb'.format(
+                row[1], row[2], row[3], row[4], row[6]))
+
+# move calls to another call store; call_store in config.yaml must be
+# changed to match afterwards
+if args.migrate_calls:
+    from kitstore import migrate_call_store
+    db = DB(drop=False)
+    migrate_call_store(db, config['call_store'], args.migrate_calls, trace)
+    trace(0, 'set call_store: {} in config.yaml'.format(args.migrate_calls))
+
+# move BED ranges to another BED store; bed_store in config.yaml must be
+# changed to match afterwards
+if args.migrate_bed:
+    from kitstore import migrate_bed_store
+    db = DB(drop=False)
+    migrate_bed_store(db, config['bed_store'], args.migrate_bed, trace)
+    trace(0, 'set bed_store: {} in config.yaml'.format(args.migrate_bed))
+
+# export the stored tree
+if args.newick or args.phyloxml:
+    from treeio import export_tree
+    db = DB(drop=False)
+    for fname, fmt in ((args.newick, 'newick'), (args.phyloxml, 'phyloxml')):
+        if fname:
+            trace(0, 'wrote {} clades to {}'.format(export_tree(db, fname, fmt), fname))
+
+# read-only lookups over HTTP, until interrupted; runs alongside a load
+if args.serve:
+    from queryservice import serve
+    serve(port=args.serve)
 
 # run unit tests - this is for development, test and prototyping
 # not part of the actual program
 if args.testdrive:
     db = db_creation()
-    populate_from_dataset(db)
+    populate_from_dataset(db, workers=args.jobs)
     trace(0,'get DNA ids')
     ids = get_dna_ids(db)
-    if config['kitlimit'] < 15:
-        trace(0, 'calculate array')
-        out = get_variant_csv(db,ids)
-        open('csv.out','w').write(out)
-    else:
-        trace(0, 'skipping large csv file')
+    trace(0, 'write csv file')
+    write_variant_csv(db, 'csv.out', ids)
     # no other work flow
     trace(0, 'commit work')
     db.commit()
@@ -109,6 +171,20 @@ if args.all:
     go_db()
 
 
+# save the stage timings of the run
+if args.profile:
+    import sqlite3
+    from runstats import save_runstats, write_report
+    if 'db' not in globals():
+        db = DB(drop=False)
+    try:
+        runid = save_runstats(db)
+    except sqlite3.OperationalError as e:
+        trace(0, 'timings not saved in the database: {}'.format(e))
+        runid = None
+    write_report(args.profile, runid=runid)
+    trace(0, 'stage timings of run {} written to {}'.format(runid, args.profile))
+
 trace(0, "** script complete.\n")
 trace(1, 'done at {:.2f} seconds'.format(time.time() - t0))
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# the configuration settings of config.yaml, read once for all modules
+#
+# Every module uses the same dictionary:
+#   from reduxconfig import config
+# config.yaml is the one in the REDUX_PATH directory if that environment
+# variable is set, else the one next to this file, so the modules can be
+# imported from any working directory. The directory settings and the files
+# in PATH_KEYS are made absolute, relative to the directory of config.yaml.
+#
+# Parsing YAML is slow compared to the rest of a short run, so the parsed
+# settings are also cached as JSON in __pycache__, with the modification
+# time and size of config.yaml; yaml is only imported when the cache is
+# missing or stale.
+#
+# config_changes changes settings for a block, e.g. in tests:
+#   with config_changes(REDUX_DATA=tmpdir, verbosity=0):
+
+import os,json
+from contextlib import contextmanager
+
+# settings that are paths, relative to the directory of config.yaml
+PATH_KEYS = ('REDUX_ENV', 'REDUX_PATH', 'REDUX_SQL', 'REDUX_DATA', 'REDUX_BIN',
+             'DB_FILE', 'implications_file')
+
+
+# the path of config.yaml
+def config_path():
+    confdir = os.environ.get('REDUX_PATH') or os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(confdir, 'config.yaml')
+
+# the JSON cache file of a config file
+def _cache_path(fname):
+    return os.path.join(os.path.dirname(fname), '__pycache__',
+                        os.path.basename(fname) + '.json')
+
+# the settings of config file fname, from the cache if it is current
+def _read_settings(fname):
+    st = os.stat(fname)
+    key = [st.st_mtime_ns, st.st_size]
+    cache = _cache_path(fname)
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            return cached['config']
+    except (OSError, ValueError, KeyError):
+        pass
+    import yaml
+    with open(fname) as f:
+        settings = yaml.safe_load(f) or {}
+    # the cache is only an optimization; skip it if it cannot be written
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmpname = '{}.{}'.format(cache, os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump({'key': key, 'config': settings}, f)
+        os.replace(tmpname, cache)
+    except (OSError, TypeError, ValueError):
+        pass
+    return settings
+
+# read a config file (default: config_path()), with paths made absolute
+def load_config(fname=None):
+    if fname is None:
+        fname = config_path()
+    fname = os.path.abspath(fname)
+    settings = _read_settings(fname)
+    confdir = os.path.dirname(fname)
+    for key in PATH_KEYS:
+        if isinstance(settings.get(key), str):
+            settings[key] = os.path.normpath(os.path.join(confdir, settings[key]))
+    return settings
+
+config = load_config()
+
+# context manager that updates config with changes and restores all of it
+# at the end of the block
+@contextmanager
+def config_changes(**changes):
+    saved = dict(config)
+    config.update(changes)
+    try:
+        yield config
+    finally:
+        config.clear()
+        config.update(saved)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# timing of the stages of a run
+#
+# A stage is timed as a span:
+#   with span('load kit', pid) as sp:
+#       ...
+#       sp.rows = len(calls)
+# or by decorating a function with @timed('stage name'). A span measures
+# wall time, CPU time of this process, peak resident set size at its end (in
+# kB; None where the resource module is missing) and the number of rows the
+# stage processed, if it sets them. Spans nest; each one records the names
+# of the spans it is inside.
+#
+# Spans are always timed and shown at verbosity 3 and up, but only kept when
+# profiling is enabled (redux.py --profile). Work done in another process
+# is timed with measure() there and recorded with record() here. The kept
+# spans of a run are saved to the runstats table, under a new runID, and
+# written to a JSON report with totals per stage and the slowest kits.
+
+import os,time,json
+from functools import wraps
+from reduxconfig import config
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# kept spans, and the names of the open ones
+_spans = []
+_stack = []
+_enabled = False
+
+
+# keep the spans of this run from now on
+def enable():
+    global _enabled
+    _enabled = True
+
+def enabled():
+    return _enabled
+
+# the kept spans, as dicts; forget them with clear
+def spans():
+    return list(_spans)
+
+def clear():
+    del _spans[:]
+
+# peak resident set size of this process so far, in kB
+def peak_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Span(object):
+
+    def __init__(self, stage, pid=None, rows=None):
+        self.stage = stage
+        self.pid = pid
+        self.rows = rows
+
+    def __enter__(self):
+        self.parent = '/'.join(_stack)
+        _stack.append(self.stage)
+        self.started = time.time()
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wall = time.perf_counter() - self.wall0
+        self.cpu = time.process_time() - self.cpu0
+        self.maxrss = peak_rss()
+        _stack.pop()
+        record(self.stage, self.pid, self.started, self.wall, self.cpu, self.maxrss,
+               self.rows, exc_type is not None, self.parent)
+        return False
+
+# show and keep a span that was measured elsewhere, e.g. in a worker process
+# (see measure); parent defaults to the spans open in this process
+def record(stage, pid, start, wall, cpu, maxrss, rows=None, failed=False, parent=None):
+    if parent is None:
+        parent = '/'.join(_stack)
+    if config['verbosity'] >= 3:
+        from lib import trace
+        trace(3, '{}{}: {:.3f}s wall, {:.3f}s cpu{}'.format(
+            stage, '' if pid is None else ' ({})'.format(pid),
+            wall, cpu, '' if rows is None else ', {} rows'.format(rows)))
+    if _enabled:
+        _spans.append({'stage': stage, 'parent': parent, 'pid': pid,
+                       'start': start, 'wall': wall, 'cpu': cpu,
+                       'maxrss': maxrss, 'rows': rows, 'failed': failed})
+
+# a measurement that is not shown or kept, for a process whose spans are
+# lost, such as a multiprocessing worker; its timing() is the start, wall,
+# cpu and maxrss arguments of record
+class Measure(object):
+
+    def __init__(self):
+        self.rows = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wall = time.perf_counter() - self.wall0
+        self.cpu = time.process_time() - self.cpu0
+        self.maxrss = peak_rss()
+        return False
+
+    def timing(self):
+        return (self.started, self.wall, self.cpu, self.maxrss)
+
+def measure():
+    return Measure()
+
+# a span around a block of code; see above
+def span(stage, pid=None, rows=None):
+    return Span(stage, pid, rows)
+
+# decorator: a span around each call of the function
+def timed(stage):
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# totals per stage of a list of spans: number of spans, wall and CPU time,
+# rows and the largest peak RSS, in order of decreasing wall time
+def stage_totals(spanlist):
+    totals = {}
+    for sp in spanlist:
+        key = (sp['parent'], sp['stage'])
+        tot = totals.setdefault(key, {'stage': sp['stage'], 'parent': sp['parent'],
+                                      'count': 0, 'wall': 0., 'cpu': 0.,
+                                      'rows': 0, 'maxrss': None})
+        tot['count'] += 1
+        tot['wall'] += sp['wall']
+        tot['cpu'] += sp['cpu']
+        tot['rows'] += sp['rows'] or 0
+        if sp['maxrss'] is not None:
+            tot['maxrss'] = max(tot['maxrss'] or 0, sp['maxrss'])
+    return sorted(totals.values(), key=lambda t: -t['wall'])
+
+# save the kept spans to the runstats table under a new runID
+# returns the runID
+def save_runstats(dbo, spanlist=None):
+    if spanlist is None:
+        spanlist = _spans
+    runid = dbo.dc.execute('select coalesce(max(runID),0)+1 from runstats').fetchone()[0]
+    dbo.dc.executemany('''insert into runstats(runID,stage,parent,pID,startDt,wall,
+                                               cpu,maxrss,nrows,failed)
+                          values(?,?,?,?,datetime(?,'unixepoch'),?,?,?,?,?)''',
+                       [(runid, sp['stage'], sp['parent'], sp['pid'], sp['start'],
+                         sp['wall'], sp['cpu'], sp['maxrss'], sp['rows'],
+                         int(sp['failed'])) for sp in spanlist])
+    dbo.commit()
+    return runid
+
+# write a JSON report of the kept spans to fname: the stage totals, the
+# nkits kits with the most wall time and all spans
+def write_report(fname, spanlist=None, nkits=20, runid=None):
+    if spanlist is None:
+        spanlist = _spans
+    kits = {}
+    for sp in spanlist:
+        if sp['pid'] is not None:
+            kit = kits.setdefault(sp['pid'], {'pid': sp['pid'], 'wall': 0., 'cpu': 0., 'rows': 0})
+            kit['wall'] += sp['wall']
+            kit['cpu'] += sp['cpu']
+            kit['rows'] += sp['rows'] or 0
+    report = {'runID': runid, 'peak_rss_kb': peak_rss(),
+              'stages': stage_totals(spanlist),
+              'slowest_kits': sorted(kits.values(), key=lambda k: -k['wall'])[:nkits],
+              'spans': spanlist}
+    tmpname = fname + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmpname, fname)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# synthetic cohorts of kits, for testing and benchmarking without real data
+#
+# make_cohort writes, under an output directory that takes the place of
+# REDUX_DATA:
+#   HaplogroupR/SYNnnnnn.zip - one FTDNA-style zip per kit, with
+#       SYNnnnnn/variants.vcf and SYNnnnnn/regions.bed, in hg38
+#   json.out - the kits' metadata, as get_kits reads it from the
+#       Haplogroup-R API (the file it caches the API response in)
+#   snps_hg38.csv, snps_hg19.csv - names for some of the variants, in the
+#       columns updatesnps reads (the hg19 file has no rows)
+#   synth_tree.json - the true tree, to check a built tree against
+#   cohort.json - the parameters; an existing cohort with the same
+#       parameters is not generated again
+#
+# The tree is a coalescent genealogy of the kits scaled to tmrca years.
+# Each branch gets a Poisson number of SNPs for its length at age_rate over
+# the covered bases, and the root gets nstem SNPs shared by every kit, the
+# first of them named top_snp. Each kit's coverage is a random set of BED
+# ranges with gaps; its VCF has the SNPs of its lineage inside them (and a
+# few outside), with random read depths, some low-quality and some mixed
+# calls, and a few private sequencing errors.
+#
+# cohort_db makes a cohort in a temporary directory and creates and loads a
+# database of it there, for tests.
+#
+# Run as a command: synth.py OUTDIR -n NKITS [--seed SEED]
+
+import os,json,zipfile
+from contextlib import contextmanager
+import numpy as np
+from reduxconfig import config, config_changes
+
+# the part of hg38 chrY the kits cover
+SYNTH_START = 2781480
+SYNTH_END = 26600000
+
+BASES = np.array(list('ACGT'))
+
+
+# a coalescent genealogy of nkits kits
+# returns parent (nodes 0..nkits-1 are the kits, the last node is the root,
+# whose parent is -1) and the age of each node in years, the root's being
+# tmrca
+def random_phylogeny(nkits, rng, tmrca=4500.):
+    nnodes = 2*nkits - 1
+    parent = np.full(nnodes, -1, dtype=np.int64)
+    age = np.zeros(nnodes)
+    lineages = list(range(nkits))
+    t = 0.
+    for node in range(nkits, nnodes):
+        k = len(lineages)
+        t += rng.exponential(2. / (k*(k-1)))
+        pair = []
+        for _ in range(2):
+            i = int(rng.integers(len(lineages)))
+            lineages[i], lineages[-1] = lineages[-1], lineages[i]
+            pair.append(lineages.pop())
+        parent[pair] = node
+        age[node] = t
+        lineages.append(node)
+    if nnodes > 1:
+        age *= tmrca / age[-1]
+    return parent, age
+
+# random distinct positions and alleles for the SNPs of each node
+# Each branch gets Poisson(length * rate * bases / 1e9) SNPs and the root
+# nstem. returns offsets (the SNPs of node i are offsets[i]:offsets[i+1])
+# and arrays of positions, reference and alternative bases
+def branch_snps(parent, age, rng, rate, bases, nstem):
+    length = np.where(parent >= 0, age[parent] - age, 0.)
+    nsnps = rng.poisson(length * rate * bases / 1e9)
+    nsnps[parent < 0] = nstem
+    offsets = np.concatenate(([0], np.cumsum(nsnps)))
+    total = int(offsets[-1])
+    pos = np.zeros(0, dtype=np.int64)
+    while len(pos) < total:
+        pos = np.unique(np.concatenate(
+            (pos, rng.integers(SYNTH_START, SYNTH_END, total - len(pos)))))
+    pos = rng.permutation(pos)
+    ref = rng.integers(0, 4, total)
+    alt = (ref + rng.integers(1, 4, total)) % 4
+    return offsets, pos, BASES[ref], BASES[alt]
+
+# the nodes from each kit up to the root, as a list of arrays
+def lineages(parent, nkits):
+    paths = []
+    for kit in range(nkits):
+        path = [kit]
+        while parent[path[-1]] >= 0:
+            path.append(int(parent[path[-1]]))
+        paths.append(np.array(path, dtype=np.int64))
+    return paths
+
+# random BED ranges covering SYNTH_START to SYNTH_END with gaps, as an
+# (n,2) array; range and gap lengths are exponential with the means given
+def random_coverage(rng, meanlen=25000, meangap=2500):
+    n = int(2 * (SYNTH_END - SYNTH_START) / (meanlen + meangap)) + 10
+    lens = rng.exponential(meanlen, n).astype(np.int64) + 100
+    gaps = rng.exponential(meangap, n).astype(np.int64) + 1
+    starts = SYNTH_START + np.concatenate(([0], np.cumsum(lens + gaps)[:-1]))
+    ranges = np.column_stack((starts, starts + lens))
+    return ranges[ranges[:, 1] < SYNTH_END]
+
+# bool vector: which positions are inside the ranges
+def _covered(ranges, pos):
+    i = np.searchsorted(ranges[:, 0], pos, side='right') - 1
+    return (i >= 0) & (pos < ranges[np.maximum(i, 0), 1])
+
+# the VCF and BED text of a kit with SNPs pos, ref and alt and coverage
+# ranges
+# Calls outside the ranges are kept with probability outside. A call is
+# low-quality (not PASS) with probability lowqual and mixed (30-80% of the
+# reads) with probability mixed; nerrors private false calls are added.
+def kit_files(rng, ranges, pos, ref, alt, outside=.1, lowqual=.08, mixed=.02,
+              nerrors=3):
+    keep = _covered(ranges, pos) | (rng.random(len(pos)) < outside)
+    pos, ref, alt = pos[keep], ref[keep], alt[keep]
+    nerr = rng.poisson(nerrors)
+    epos = rng.integers(SYNTH_START, SYNTH_END, nerr)
+    eref = rng.integers(0, 4, nerr)
+    pos = np.concatenate((pos, epos))
+    ref = np.concatenate((ref, BASES[eref]))
+    alt = np.concatenate((alt, BASES[(eref + rng.integers(1, 4, nerr)) % 4]))
+    pos, first = np.unique(pos, return_index=True)
+    ref, alt = ref[first], alt[first]
+    n = len(pos)
+    depth = rng.poisson(30, n) + 1
+    frac = np.where(rng.random(n) < mixed, rng.uniform(.3, .8, n), 1.)
+    altreads = np.maximum(np.rint(depth * frac).astype(np.int64), 1)
+    qual = rng.uniform(30, 3000, n)
+    filt = np.where(rng.random(n) < lowqual, 'LowQual', 'PASS')
+    lines = ['##fileformat=VCFv4.1', '##reference=hg38',
+             '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE']
+    for p, r, a, q, f, d, ar in zip(pos.tolist(), ref.tolist(), alt.tolist(),
+                                    qual.tolist(), filt.tolist(), depth.tolist(),
+                                    altreads.tolist()):
+        gt = '1/1' if ar == d else '0/1'
+        lines.append('chrY\t{}\t.\t{}\t{}\t{:.2f}\t{}\tAC={};AF={:.3f};AN=2;DP={};'
+                     'FS=0.000;MLEAF={:.3f};MQ=60.00\tGT:AD:DP\t{}:{},{}:{}'.format(
+                         p, r, a, q, f, 2 if ar == d else 1, ar/d, d, ar/d, gt,
+                         d - ar, ar, d))
+    bed = ['chrY\t{}\t{}'.format(s, e) for s, e in ranges.tolist()]
+    return '\n'.join(lines) + '\n', '\n'.join(bed) + '\n'
+
+# metadata of a kit, as the Haplogroup-R API returns it (see update_metadata)
+def kit_metadata(rng, kitid, fname):
+    return {'kitId': kitid, 'uploaded': '2018-01-01 00:00:00', 'dataFile': fname,
+            'long': '{:.3f}'.format(rng.uniform(-10, 30)),
+            'lat': '{:.3f}'.format(rng.uniform(40, 65)),
+            'otherInfo': 'synthetic', 'origFileName': fname,
+            'birthYear': int(rng.integers(1600, 1900)),
+            'approxHg': '{}-{}'.format(config['haplogroup'], config['top_snp']),
+            'country': str(rng.choice(['England', 'Germany', 'Netherlands', 'Norway'])),
+            'normalOrig': None, 'lab': 'FTDNA', 'build': 'b38',
+            'surname': 'Synth{}'.format(int(rng.integers(1000))),
+            'testType': 'Big Y', 'isNGS': 1}
+
+# write a synthetic cohort of nkits kits under outdir; see above
+# returns the parameters, as written to cohort.json
+def make_cohort(outdir, nkits, seed=0, tmrca=4500., nstem=600, named=.5,
+                rate=None, bases=15000000):
+    from lib import trace
+    if rate is None:
+        rate = config['age_rate']
+    params = {'nkits': nkits, 'seed': seed, 'tmrca': tmrca, 'nstem': nstem,
+              'named': named, 'rate': rate, 'bases': bases}
+    stamp = os.path.join(outdir, 'cohort.json')
+    if os.path.exists(stamp):
+        with open(stamp) as f:
+            if json.load(f) == params:
+                trace(1, 'synthetic cohort of {} kits exists in {}'.format(nkits, outdir))
+                return params
+    trace(1, 'making synthetic cohort of {} kits in {}'.format(nkits, outdir))
+    rng = np.random.default_rng(seed)
+    parent, age = random_phylogeny(nkits, rng, tmrca)
+    offsets, pos, ref, alt = branch_snps(parent, age, rng, rate, bases, nstem)
+    zipdir = os.path.join(outdir, 'HaplogroupR')
+    os.makedirs(zipdir, exist_ok=True)
+    meta = []
+    for kit, path in enumerate(lineages(parent, nkits)):
+        snps = np.concatenate([np.arange(offsets[n], offsets[n+1]) for n in path])
+        vcf, bed = kit_files(rng, random_coverage(rng), pos[snps], ref[snps], alt[snps])
+        kitid = 'SYN{:06d}'.format(kit)
+        fname = kitid + '.zip'
+        with zipfile.ZipFile(os.path.join(zipdir, fname), 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(kitid + '/variants.vcf', vcf)
+            zf.writestr(kitid + '/regions.bed', bed)
+        meta.append(kit_metadata(rng, kitid, fname))
+    with open(os.path.join(outdir, 'json.out'), 'w') as f:
+        json.dump(meta, f)
+    # names: top_snp for the first stem SNP, SYNn for a fraction of the rest
+    root = len(parent) - 1
+    isnamed = rng.random(len(pos)) < named
+    isnamed[offsets[root]] = True
+    with open(os.path.join(outdir, config['b38_snp_file']), 'w') as f:
+        f.write('Name,start,allele_anc,allele_der\n')
+        for i in np.flatnonzero(isnamed).tolist():
+            name = config['top_snp'] if i == offsets[root] else 'SYN{}'.format(i)
+            f.write('{},{},{},{}\n'.format(name, pos[i], ref[i], alt[i]))
+    with open(os.path.join(outdir, config['b37_snp_file']), 'w') as f:
+        f.write('Name,start,allele_anc,allele_der\n')
+    with open(os.path.join(outdir, 'synth_tree.json'), 'w') as f:
+        json.dump({'parent': parent.tolist(), 'age': age.tolist(),
+                   'offsets': offsets.tolist(), 'pos': pos.tolist()}, f)
+    with open(stamp, 'w') as f:
+        json.dump(params, f)
+    return params
+
+# context manager for tests: a database of a synthetic cohort of nkits kits,
+# made in a temporary directory that is REDUX_DATA and the working directory
+# for the block; the database is created with db_creation and, with load,
+# loaded with populate_from_dataset. changes are settings on top of those
+# of a small local run; the settings and working directory are restored
+# afterwards.
+#   with cohort_db(6, seed=1) as db:
+@contextmanager
+def cohort_db(nkits, seed=0, load=True, **changes):
+    import shutil, tempfile
+    from lib import db_creation, populate_from_dataset
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        settings = {'REDUX_DATA': tmpdir, 'DB_FILE': os.path.join(tmpdir, 'test.db'),
+                    'use_web_api': False, 'drop_tables': True, 'max_snpdef_age': -1,
+                    'call_store': 'table', 'bed_store': 'table', 'verbosity': 0}
+        settings.update(changes)
+        with config_changes(**settings):
+            make_cohort(tmpdir, nkits, seed=seed)
+            shutil.copy(os.path.join(config['REDUX_PATH'], 'age.bed'), tmpdir)
+            os.chdir(tmpdir)
+            db = None
+            try:
+                db = db_creation()
+                if load:
+                    populate_from_dataset(db)
+                yield db
+            finally:
+                if db is not None:
+                    db.db.close()
+                os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='write a synthetic cohort of kits')
+    parser.add_argument('outdir', help='directory to write the cohort to')
+    parser.add_argument('-n', '--nkits', help='number of kits', type=int, default=100)
+    parser.add_argument('-s', '--seed', help='random seed', type=int, default=0)
+    args = parser.parse_args()
+    make_cohort(args.outdir, args.nkits, args.seed)
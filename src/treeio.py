@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# Copyright (c) 2018 The Authors
+
+# Contributors: Jef Treece, Harald Alvestrand, Zak Jones, Iain McDonald
+# Purpose: Reduction and comparison script for Y-chromosome NGS test data
+# For free distribution under the terms of the GNU General Public License,
+# version 3 (29 June 2007)
+# https://www.gnu.org/licenses/gpl.html
+
+# encoding of the tree table's BLOB columns, bulk loading of the stored tree
+# and export to standard tree formats
+#
+# The BLOBs of a clade are little-endian arrays with no header:
+#   variants, children   - int32 variant IDs and clade ids
+#   qualities            - uint8 percentage of passed positive calls
+#   snpagepdf and the other PDF columns - float32 over ages.age_grid
+# The layout version is kept in the meta table (tree_encoding), like the
+# callinfo version; a database without that entry was written with version
+# 1. Add a new version rather than changing an existing one.
+#
+# read_tree loads the whole table with one query and decodes all variant
+# lists with one np.frombuffer into a flat array and offsets, so a tree of
+# tens of thousands of clades loads in a fraction of a second. write_newick
+# and write_phyloxml write a loaded tree to an open file clade by clade, so
+# the document is never held in memory.
+
+import numpy as np
+from xml.sax.saxutils import escape
+from reduxconfig import config
+from runstats import timed
+
+# dtypes of the BLOB columns, by layout version
+TREE_ENCODINGS = {
+    1: {'variants': '<i4', 'children': '<i4', 'qualities': 'u1', 'pdf': '<f4'},
+    }
+TREE_ENCODING = 1
+
+
+# get the tree BLOB layout version of the database
+def get_tree_encoding(dbo):
+    row = dbo.dc.execute('select val from meta where descr=?',
+                         ('tree_encoding',)).fetchone()
+    if not row:
+        return 1
+    version = int(row[0])
+    if version not in TREE_ENCODINGS:
+        raise ValueError('unknown tree encoding version {}'.format(version))
+    return version
+
+# record the tree BLOB layout version used to write the tree table
+def set_tree_encoding(dbo, version=TREE_ENCODING):
+    dbo.dc.execute('delete from meta where descr=?', ('tree_encoding',))
+    dbo.dc.execute('insert into meta(descr,val) values(?,?)',
+                   ('tree_encoding', str(version)))
+
+# a BLOB of column kind ('variants', 'children', 'qualities' or 'pdf')
+def encode(kind, arr, version=TREE_ENCODING):
+    return np.asarray(arr).astype(TREE_ENCODINGS[version][kind]).tobytes()
+
+# the array of a BLOB of column kind; an empty array for NULL
+def decode(kind, blob, version=TREE_ENCODING):
+    return np.frombuffer(blob or b'', dtype=TREE_ENCODINGS[version][kind])
+
+# decode a list of BLOBs of column kind at once
+# returns the concatenated arrays and offsets; BLOB i is
+# flat[offsets[i]:offsets[i+1]]
+def decode_many(kind, blobs, version=TREE_ENCODING):
+    dtype = np.dtype(TREE_ENCODINGS[version][kind])
+    blobs = [b or b'' for b in blobs]
+    sizes = np.fromiter(map(len, blobs), dtype=np.int64, count=len(blobs))
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum(sizes // dtype.itemsize, out=offsets[1:])
+    return np.frombuffer(b''.join(blobs), dtype=dtype), offsets
+
+
+# the stored tree, in id order
+#   ids, parents - clade ids and parent ids (0 for the root)
+#   names - clade names
+#   vflat, voffsets - variant IDs of all clades, see decode_many
+#   age, agelo, agehi - snpage columns as float arrays, NaN where not set
+#   pdf - snpagepdf of each clade (clades x age grid), if loaded
+# Children are found from the parent ids, not the children BLOBs.
+class StoredTree(object):
+
+    def __init__(self, ids, parents, names, vflat, voffsets, ages, pdf=None):
+        self.ids = ids
+        self.parents = parents
+        self.names = names
+        self.vflat = vflat
+        self.voffsets = voffsets
+        self.age, self.agelo, self.agehi = ages
+        self.pdf = pdf
+        # row of each clade's parent, -1 for the root
+        prow = np.searchsorted(ids, parents)
+        found = (parents != 0) & (prow < len(ids))
+        found[found] = ids[prow[found]] == parents[found]
+        self.prow = np.where(found, prow, -1)
+        # child rows of row i are crows[coffsets[i]:coffsets[i+1]]
+        haspar = np.flatnonzero(self.prow >= 0)
+        order = np.argsort(self.prow[haspar], kind='stable')
+        self.crows = haspar[order]
+        self.coffsets = np.searchsorted(self.prow[self.crows], np.arange(len(ids) + 1))
+
+    def __len__(self):
+        return len(self.ids)
+
+    # the rows of clades without parent
+    def roots(self):
+        return np.flatnonzero(self.prow < 0)
+
+    def children(self, row):
+        return self.crows[self.coffsets[row]:self.coffsets[row+1]]
+
+    def variants(self, row):
+        return self.vflat[self.voffsets[row]:self.voffsets[row+1]]
+
+    # the variant IDs of every clade, as a list of arrays
+    def variant_list(self):
+        return np.split(self.vflat, self.voffsets[1:-1])
+
+# load the tree table with one query; with pdf, the snpagepdf column too
+def read_tree(dbo, pdf=False):
+    version = get_tree_encoding(dbo)
+    rows = dbo.dc.execute('''select id, coalesce(parendid,0), clade, variants,
+                                    snpage, snpagelo, snpagehi{}
+                             from tree order by id'''.format(
+                                 ', snpagepdf' if pdf else '')).fetchall()
+    if not rows:
+        empty = np.zeros(0, dtype=np.int64)
+        return StoredTree(empty, empty, [], np.zeros(0, dtype=np.int32),
+                          np.zeros(1, dtype=np.int64), (np.zeros(0),)*3,
+                          np.zeros((0, 0), dtype=np.float32) if pdf else None)
+    cols = list(zip(*rows))
+    ids = np.array(cols[0], dtype=np.int64)
+    parents = np.array(cols[1], dtype=np.int64)
+    vflat, voffsets = decode_many('variants', cols[3], version)
+    ages = tuple(np.array(c, dtype=np.float64) for c in cols[4:7])
+    pdfs = None
+    if pdf:
+        flat, offsets = decode_many('pdf', cols[7], version)
+        # clades without a PDF get zeros
+        sizes = np.diff(offsets)
+        width = int(sizes.max())
+        if width and (sizes == width).all():
+            pdfs = flat.reshape(len(ids), width)
+        else:
+            pdfs = np.zeros((len(ids), width), dtype=np.float32)
+            full = np.flatnonzero(sizes == width)
+            if width:
+                pdfs[full] = flat[offsets[full, None] + np.arange(width)]
+    return StoredTree(ids, parents, [c or '' for c in cols[2]], vflat, voffsets,
+                      ages, pdfs)
+
+
+# the rows of a tree in depth-first order, as (row, event) with event
+# 'open' before a clade's children and 'close' after them; leaves get both
+def _walk(tree):
+    for root in tree.roots().tolist():
+        stack = [(root, False)]
+        while stack:
+            row, done = stack.pop()
+            if done:
+                yield row, 'close'
+                continue
+            yield row, 'open'
+            stack.append((row, True))
+            stack.extend((int(c), False) for c in tree.children(row)[::-1])
+
+# branch length of each clade: the age difference to its parent where both
+# have ages, else the number of the clade's variants
+def branch_lengths(tree):
+    nvar = np.diff(tree.voffsets).astype(np.float64)
+    page = np.where(tree.prow >= 0, tree.age[np.maximum(tree.prow, 0)], np.nan)
+    years = page - tree.age
+    return np.where(np.isnan(years), nvar, np.maximum(years, 0))
+
+# a Newick label, quoted if needed
+def _newick_label(name):
+    if any(ch in name for ch in " ()[]':;,\t"):
+        return "'" + name.replace("'", "''") + "'"
+    return name
+
+# write a tree (StoredTree) to the open file fileobj in Newick format
+# Clades are labelled with their names and have branch lengths as in
+# branch_lengths. Several roots are written as several trees.
+def write_newick(tree, fileobj):
+    length = branch_lengths(tree)
+    first = {}
+    for row, event in _walk(tree):
+        nkids = len(tree.children(row))
+        if event == 'open':
+            parent = int(tree.prow[row])
+            if parent >= 0:
+                if first.get(parent):
+                    fileobj.write(',')
+                first[parent] = True
+            if nkids:
+                fileobj.write('(')
+            continue
+        if nkids:
+            fileobj.write(')')
+        fileobj.write(_newick_label(tree.names[row]))
+        if tree.prow[row] >= 0:
+            fileobj.write(':{:g}'.format(length[row]))
+        else:
+            fileobj.write(';\n')
+
+# write a tree (StoredTree) to the open file fileobj in PhyloXML format
+# Each clade has its name, branch length as in branch_lengths, its age with
+# confidence interval as a date in years before present, and its number of
+# variants as a property.
+def write_phyloxml(tree, fileobj):
+    length = branch_lengths(tree)
+    fileobj.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<phyloxml xmlns="http://www.phyloxml.org">\n')
+    depth = 0
+    for row, event in _walk(tree):
+        if event == 'close':
+            depth -= 1
+            fileobj.write('  ' * (depth + 2) + '</clade>\n')
+            if tree.prow[row] < 0:
+                fileobj.write('</phylogeny>\n')
+            continue
+        if tree.prow[row] < 0:
+            fileobj.write('<phylogeny rooted="true">\n')
+        ind = '  ' * (depth + 2)
+        fileobj.write(ind + '<clade')
+        if tree.prow[row] >= 0:
+            fileobj.write(' branch_length="{:g}"'.format(length[row]))
+        fileobj.write('>\n')
+        if tree.names[row]:
+            fileobj.write(ind + '  <name>{}</name>\n'.format(escape(tree.names[row])))
+        if not np.isnan(tree.age[row]):
+            fileobj.write(ind + '  <date unit="ybp"><value>{:g}</value>'.format(tree.age[row]))
+            if not np.isnan(tree.agelo[row]) and not np.isnan(tree.agehi[row]):
+                fileobj.write('<minimum>{:g}</minimum><maximum>{:g}</maximum>'.format(
+                    tree.agelo[row], tree.agehi[row]))
+            fileobj.write('</date>\n')
+        fileobj.write(ind + '  <property ref="redux:variants" datatype="xsd:integer" '
+                      'applies_to="clade">{}</property>\n'.format(
+                          int(tree.voffsets[row+1] - tree.voffsets[row])))
+        depth += 1
+    fileobj.write('</phyloxml>\n')
+
+# export the stored tree to a file, in format 'newick' or 'phyloxml'
+@timed('export tree')
+def export_tree(dbo, fname, fmt='newick'):
+    writer = {'newick': write_newick, 'phyloxml': write_phyloxml}[fmt]
+    tree = read_tree(dbo)
+    with open(fname, 'w') as fileobj:
+        writer(tree, fileobj)
+    return len(tree)
@@ -0,0 +1,39 @@
+import unittest
+import numpy as np
+from ages import *
+
+class TestAges(unittest.TestCase):
+
+    def setUp(self):
+        self.t = age_grid(10000, 10)
+        self.rate = 0.8119
+
+    def test_loglik(self):
+        loglik = snp_loglik([0, 4], [1e7, 1e7], self.t, self.rate)
+        self.assertEqual(loglik[0, 0], 0)
+        # the peak is at t = 4*1e9/rate/coverage, about 493 years
+        self.assertEqual(self.t[np.argmax(loglik[1])], 490)
+        self.assertAlmostEqual(loglik[1].max(), 0, places=2)
+
+    def test_single_clade(self):
+        # the PDF of a clade of kits only is a Gamma distribution
+        singles = np.array([3, 5, 2, 4, 6])
+        cov = np.full(5, 8e6)
+        pdf, lo, mid, hi = clade_ages([-1], [0]*5, singles, cov, [0], self.t,
+                                      self.rate, .75, .87, .95)
+        scale = 1e9 / (cov.sum() * self.rate)
+        gamma = self.t**singles.sum() * np.exp(-self.t/scale)
+        self.assertTrue(np.allclose(pdf[0], gamma / gamma.sum()))
+        self.assertTrue(lo[0] < mid[0] < hi[0])
+        self.assertAlmostEqual(mid[0], 631, delta=10)
+
+    def test_nested(self):
+        # root > 1 > 2, and a kit with no age coverage
+        pdf, lo, mid, hi = clade_ages([-1, 0, 1], [2, 2, 2, 1, 0, 0],
+                                      [3, 4, 2, 1, 3, 9], [8e6]*5 + [0], [0, 10, 6],
+                                      self.t, self.rate, .75, .87, .95)
+        self.assertTrue(mid[0] > mid[1] > mid[2])
+        self.assertTrue(np.allclose(pdf.sum(axis=1), 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import numpy as np
+from bitset import *
+
+class TestBitset(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        self.masks = rng.random((40, 131)) < .3
+        self.sets = pack(self.masks)
+
+    def test_pack(self):
+        self.assertEqual(self.sets.shape, (40, 3))
+        self.assertTrue((unpack(self.sets, 131) == self.masks).all())
+
+    def test_operations(self):
+        a, b = self.masks[0], self.masks[1]
+        self.assertTrue((unpack(band(self.sets[0], self.sets[1]), 131) == (a & b)).all())
+        self.assertTrue((unpack(bandnot(self.sets[0], self.sets[1]), 131) == (a & ~b)).all())
+        self.assertEqual(popcount(self.sets).tolist(), self.masks.sum(axis=1).tolist())
+
+    def test_popcount_fallback(self):
+        count = np.bitwise_count if hasattr(np, 'bitwise_count') else None
+        try:
+            if count is not None:
+                del np.bitwise_count
+            self.assertEqual(popcount(self.sets).tolist(), self.masks.sum(axis=1).tolist())
+        finally:
+            if count is not None:
+                np.bitwise_count = count
+
+    def test_queries(self):
+        masks = self.masks.copy()
+        masks[5] = masks[3]
+        masks[7] = masks[3] & masks[8]
+        sets = pack(masks)
+        x = sets[3]
+        self.assertEqual(np.flatnonzero(equal_rows(sets, x)).tolist(), [3, 5])
+        want = [i for i in range(40) if not (masks[i] & ~masks[3]).any()]
+        self.assertEqual(np.flatnonzero(subset_rows(sets, x)).tolist(), want)
+        group = group_rows(sets)
+        self.assertEqual(group[0], 0)
+        self.assertEqual(group[5], group[3])
+        self.assertEqual(len(set(group.tolist())), 39)
+
+    def test_kitsets(self):
+        calls = np.array([[7, 7, 0, 1, 4],
+                          [7, 7, 2, 0, 6],
+                          [0, 5, 1, 1, 1]], dtype=np.int8)
+        sets = KitSets.from_calls(calls, block=2)
+        self.assertEqual(unpack(sets.pos, 5).astype(int).tolist(),
+                         [[1, 1, 0, 0, 1], [1, 1, 0, 0, 1], [0, 1, 0, 0, 0]])
+        self.assertEqual(unpack(sets.neg, 5).astype(int).tolist(),
+                         [[0, 0, 0, 1, 0], [0, 0, 1, 0, 0], [0, 0, 1, 1, 1]])
+        self.assertEqual(unpack(sets.nocall, 5).astype(int).tolist(),
+                         [[0, 0, 1, 0, 0], [0, 0, 0, 1, 0], [1, 0, 0, 0, 0]])
+        self.assertEqual(len(sets), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest,os,io,tempfile
+import numpy as np
+from callmatrix import *
+from db import DB
+from lib import pack_call
+from kitstore import bed_store
+from reduxconfig import config_changes
+from array_api import write_variant_csv, _csv_rows
+
+class TestCallCodes(unittest.TestCase):
+
+    def test_kit_call_codes(self):
+        # rows: variants 10..15 sorted by position; 13 and 14 share a position
+        rowvids = np.array([10, 11, 12, 13, 14, 15])
+        rowpos = np.array([100, 200, 300, 400, 400, 500])
+        roworder = np.argsort(rowvids)
+        covered = np.array([False, True, False, True, True, True])
+        # the kit: PASS call for 11, FAIL mixed call for 13, and a PASS
+        # reference call (variant 99) at position 500
+        kvids = np.array([11, 13, 99])
+        kpos = np.array([200, 400, 500])
+        passfail = np.array([True, False, True])
+        passrate = np.array([1., .5, 1.])
+        col = kit_call_codes(rowvids, rowpos, roworder, covered, kvids, kpos,
+                             passfail, passrate, .8)
+        self.assertEqual(col.tolist(), [CALL_UNCALLED, CALL_POS, CALL_UNCALLED,
+                                        CALL_FAILMIXED, CALL_FAILNEG, CALL_NEG])
+
+    def test_assignment_bits(self):
+        code = np.int8(CALL_MIXED | ASSIGN_POS)
+        self.assertEqual(code & CALL_MASK, CALL_MIXED)
+        self.assertEqual(code & ASSIGN_MASK, ASSIGN_POS)
+        self.assertEqual(code % 16, CALL_MIXED)
+        self.assertEqual(code // 16, 3)
+
+class TestBuild(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db = DB(os.path.join(self.tmpdir.name, 'test.db'))
+        db.create_schema()
+        rng = np.random.default_rng(5)
+        # 21 variants, so that coverage bits span three bytes; a reference
+        # call at the position of the last one
+        vids = db.insert_variants([(100*(i+1), 'A', 'G') for i in range(20)] +
+                                  [(2000, 'A', '.')])
+        for pid in (1, 2, 3, 5):
+            called = np.flatnonzero(rng.random(21) < .4)
+            db.insert_calls(pid, [vids[i] for i in called.tolist()],
+                            [pack_call((0, 0, 0, 'PASS' if rng.random() < .7 else 'FAIL',
+                                        50., 40., 30, float(rng.choice([1., .5]))))
+                             for i in called.tolist()])
+            bed_store(db, 'table').put_ranges(pid, [[50*pid, 50*pid + 700],
+                                                    [1200, 1200 + 100*pid]])
+        db.commit()
+        self.db = db
+        self.vids = vids[:20]
+
+    def tearDown(self):
+        self.db.db.close()
+        self.tmpdir.cleanup()
+
+    # the dense, sparse and spilled matrices hold the same calls
+    def test_dense_sparse_spill(self):
+        with config_changes(bed_store='table'):
+            dense = build_call_matrix(self.db, vids=self.vids, dense=True)
+            sparse = build_call_matrix(self.db, vids=self.vids, dense=False)
+            spill = build_call_matrix(self.db, vids=self.vids, dense=True,
+                                      spill=os.path.join(self.tmpdir.name, 'cm.npy'))
+        self.assertEqual(dense.shape, (20, 4))
+        self.assertTrue(sparse.sparse)
+        self.assertIsInstance(spill.calls, np.memmap)
+        calls = dense.toarray()
+        self.assertTrue({CALL_UNCALLED, CALL_BEDNEG, CALL_POS, CALL_FAILPOS} <= set(calls.ravel().tolist()))
+        rowidx = np.array([19, 0, 8, 7, 15, 16, 3, 8])
+        for cm in (sparse, spill):
+            self.assertEqual(cm.vids.tolist(), dense.vids.tolist())
+            self.assertEqual(cm.toarray().tolist(), calls.tolist())
+            self.assertEqual(cm.take(rowidx).tolist(), calls[rowidx].tolist())
+            self.assertEqual(cm.rows(6, 17).tolist(), calls[6:17].tolist())
+
+class TestVariantCSV(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db = DB(os.path.join(self.tmpdir.name, 'test.db'))
+        db.create_schema()
+        # variant IDs in another order than their positions
+        self.vids = db.insert_variants([(3000, 'A', 'G'), (1000, 'C', 'T'),
+                                        (2000, 'G', 'A'), (4000, 'T', 'C')])
+        call = pack_call((0, 0, 0, 'PASS', 50., 40., 30, 1.))
+        db.insert_calls(1, self.vids[:3], [call] * 3)
+        db.insert_calls(2, self.vids[2:], [call] * 2)
+        db.commit()
+        self.db = db
+
+    def tearDown(self):
+        self.db.db.close()
+        self.tmpdir.cleanup()
+
+    def csv(self, **kw):
+        out = io.BytesIO()
+        write_variant_csv(self.db, out, **kw)
+        return out.getvalue().decode('ascii').splitlines()
+
+    # the file is the same whatever the number of rows built at a time
+    def test_blocks(self):
+        for order in ('pos', 'id'):
+            whole = self.csv(order=order)
+            self.assertEqual(len(whole), 5)
+            self.assertEqual(whole[0], 'vid,pos,anc,der,1,2')
+            for chunk in (1, 3):
+                self.assertEqual(self.csv(order=order, chunk=chunk), whole)
+        self.assertEqual([int(r.split(',')[1]) for r in self.csv()[1:]],
+                         [1000, 2000, 3000, 4000])
+        self.assertEqual([int(r.split(',')[0]) for r in self.csv(order='id')[1:]],
+                         sorted(self.vids))
+        # a large matrix is memory-mapped from the spill file
+        whole = {order: self.csv(order=order) for order in ('pos', 'id')}
+        with config_changes(REDUX_DATA=self.tmpdir.name, call_matrix_max_dense=4):
+            for order in ('pos', 'id'):
+                self.assertEqual(self.csv(order=order, chunk=3), whole[order])
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name,
+                                                        config['call_matrix_spill'])))
+
+    # without kit columns, rows end with the derived allele
+    def test_no_kits(self):
+        self.assertEqual(self.csv(ppl=[]), ['vid,pos,anc,der'])
+        rows = _csv_rows(self.db, np.array(self.vids[:2]), np.array([3000, 1000]),
+                         np.zeros((2, 0), dtype=np.int8))
+        self.assertEqual(rows, '{},3000,A,G\n{},1000,C,T\n'.format(*self.vids[:2]).encode('ascii'))
+        rows = self.csv(ppl=[1], chunk=2)
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(all(not r.endswith(',') for r in rows))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest,os,tempfile
+import numpy as np
+from coverage import *
+from db import DB
+from kitstore import bed_store
+from reduxconfig import config, config_changes
+
+class TestCoverage(unittest.TestCase):
+
+    # the slow, obvious way
+    def reference(self, starts, ends, positions):
+        covered, edge = [], []
+        for p in positions:
+            inside = any(s < p < e for s, e in zip(starts, ends))
+            covered.append(inside)
+            if inside:
+                edge.append(EDGE_NONE)
+            elif any(s == p == e for s, e in zip(starts, ends)):
+                edge.append(EDGE_CBLU)
+            elif p in starts:
+                edge.append(EDGE_CBL)
+            elif p in ends:
+                edge.append(EDGE_CBU)
+            else:
+                edge.append(EDGE_NONE)
+        return covered, edge
+
+    def test_kit_coverage(self):
+        starts = [10, 20, 25, 40, 40, 60]
+        ends =   [20, 30, 28, 40, 50, 61]
+        positions = [5, 10, 11, 20, 21, 26, 28, 30, 35, 40, 45, 50, 60, 61, 62, 21]
+        covered, edge = kit_coverage(starts, ends, positions)
+        rcovered, redge = self.reference(starts, ends, positions)
+        self.assertEqual(covered.tolist(), rcovered)
+        self.assertEqual(edge.tolist(), redge)
+        self.assertEqual(edge[positions.index(10)], EDGE_CBL)
+        self.assertEqual(edge[positions.index(30)], EDGE_CBU)
+
+    def test_random(self):
+        rng = np.random.default_rng(3)
+        starts = np.sort(rng.integers(0, 1000, 50))
+        ends = starts + rng.integers(0, 40, 50)
+        positions = rng.integers(0, 1100, 500)
+        covered, edge = kit_coverage(starts, ends, positions)
+        rcovered, redge = self.reference(starts.tolist(), ends.tolist(), positions.tolist())
+        self.assertEqual(covered.tolist(), rcovered)
+        self.assertEqual(edge.tolist(), redge)
+
+    def test_matrix(self):
+        positions = np.array([15, 5, 25, 10], dtype=np.int32)
+        kits = {1: ([0, 20], [12, 30]), 2: ([], [])}
+        covered = {}
+        for pid, (s, e) in kits.items():
+            covered[pid], edge = kit_coverage(np.array(s), np.array(e), positions)
+        bits = np.array([np.packbits(covered[p]) for p in (1, 2)])
+        cm = CoverageMatrix([1, 2], positions, bits, np.array([0]),
+                            np.array([3]), np.array([EDGE_CBU], dtype=np.int8))
+        self.assertEqual(cm.covered(1).tolist(), [False, True, True, True])
+        self.assertEqual(cm.covered(2).tolist(), [False]*4)
+        self.assertEqual(cm.counts().tolist(), [0, 1, 1, 1])
+        self.assertEqual(cm.edges(1).tolist(), [0, 0, 0, EDGE_CBU])
+        self.assertEqual(cm.dense().shape, (2, 4))
+
+    # the whole-cohort matrix, from the ranges of each kind of BED store
+    def test_coverage_matrix(self):
+        rng = np.random.default_rng(7)
+        positions = rng.integers(0, 1100, 300).astype(np.int32)
+        kits = {}
+        for pid in (2, 3, 5, 8, 9):
+            starts = np.sort(rng.integers(0, 1000, 20))
+            kits[pid] = np.column_stack((starts, starts + rng.integers(0, 60, 20)))
+        # ranges that start or end on a position
+        kits[3][:4, 0] = positions[:4]
+        kits[5][:4, 1] = kits[5][:4, 0] = positions[4:8]
+        kits[9] = np.zeros((0, 2), dtype=np.int32)
+        with tempfile.TemporaryDirectory() as tmpdir, config_changes(REDUX_DATA=tmpdir):
+            db = DB(os.path.join(tmpdir, 'test.db'))
+            db.create_schema()
+            for kind in ('table', 'blob', 'npy'):
+                config['bed_store'] = kind
+                store = bed_store(db)
+                for pid, ranges in kits.items():
+                    store.put_ranges(pid, ranges)
+                db.commit()
+                pids = sorted(kits)
+                cm = coverage_matrix(db, pids, positions)
+                self.assertEqual(cm.dense().shape, (len(pids), len(positions)))
+                for pid in pids:
+                    starts, ends = store.get_ranges(pid)
+                    covered, edge = kit_coverage(starts, ends, positions)
+                    self.assertEqual(cm.covered(pid).tolist(), covered.tolist())
+                    self.assertEqual(cm.edges(pid).tolist(), edge.tolist())
+                self.assertTrue(cm.edges(3).any() and cm.edges(5).any())
+                self.assertEqual(cm.counts().tolist(),
+                                 cm.dense().sum(axis=0).tolist())
+            db.db.close()
+
+    def test_coverage_stats(self):
+        kits = [(np.array([0, 5, 30]), np.array([10, 12, 40])),
+                (np.array([], dtype=np.int32), np.array([], dtype=np.int32)),
+                (np.array([8, 10]), np.array([10, 20]))]
+        total, agecov, nranges = coverage_stats(kits, [9, 35], [11, 100])
+        self.assertEqual(total.tolist(), [22, 0, 12])
+        self.assertEqual(agecov.tolist(), [7, 0, 2])
+        self.assertEqual(nranges.tolist(), [3, 0, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,80 @@
-import unittest,sys
+import unittest,os,tempfile
 from lib import *
 from db import *
+from synth import cohort_db
 
 class TestDB(unittest.TestCase):
 
+    # create a database and load a small synthetic cohort into it
     def test_db(self):
-        cur = db_init(trace)
-        db_drop_tables(cur)
-        db_create_tables(cur)
-        db_inserts(cur,trace,unpack,readVcf)
-        #res = fact(5)
-        #self.assertEqual(res, 120)
+        with cohort_db(6, seed=1) as db:
+            count = lambda tbl: db.dc.execute('select count(*) from ' + tbl).fetchone()[0]
+            self.assertEqual(count('dataset'), 6)
+            self.assertEqual(count('loadmanifest'), 6)
+            self.assertEqual(count('bedstats'), 6)
+            self.assertTrue(count('vcfcalls') > 6 * 500)
+            self.assertEqual(db.dc.execute('''select count(*) from snpnames
+                                              where snpname=?''',
+                                           (config['top_snp'],)).fetchone()[0], 1)
+            # the deferred indexes are back and the profile restored
+            indexes = {r[0] for r in db.dc.execute('''select name from sqlite_master
+                                                       where type='index' ''')}
+            self.assertTrue({'bedidx', 'vcfidx', 'vcfpidx'} <= indexes)
+            self.assertEqual(db.dc.execute('''select count(*) from meta
+                                              where descr='deferred_index' ''').fetchone()[0], 0)
+            self.assertEqual(db.dc.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            # left in query mode
+            self.assertEqual(db.dc.execute('PRAGMA synchronous').fetchone()[0], 1)
+            self.assertEqual(db.dc.execute('PRAGMA locking_mode').fetchone()[0], 'normal')
+            db.close()
+
+    # kits parsed by worker processes are timed in the profile
+    def test_worker_spans(self):
+        import runstats
+        with cohort_db(4, seed=1, load=False) as db:
+            runstats.enable()
+            runstats.clear()
+            try:
+                populate_from_dataset(db, workers=2)
+                parsed = [s for s in runstats.spans() if s['stage'] == 'parse kit']
+                loaded = [s for s in runstats.spans() if s['stage'] == 'load kit']
+                self.assertEqual(sorted(s['pid'] for s in parsed), [1, 2, 3, 4])
+                self.assertEqual([s['rows'] for s in parsed], [s['rows'] for s in loaded])
+                self.assertTrue(all(s['wall'] > 0 and not s['failed'] for s in parsed))
+                self.assertEqual(parsed[0]['parent'], 'load kits')
+            finally:
+                runstats.clear()
+                runstats._enabled = False
+
+    # a failed bulk load is rolled back, with its indexes and PRAGMAs
+    def test_bulk_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = DB(os.path.join(tmpdir, 'test.db'))
+            db.create_schema()
+            db.commit()
+            cache = db.dc.execute('PRAGMA cache_size').fetchone()[0]
+            with self.assertRaises(RuntimeError):
+                with db.bulk_load(('vcfcalls',)):
+                    # readers keep reading through a load unless db_readers is off
+                    self.assertEqual(db.dc.execute('PRAGMA journal_mode').fetchone()[0],
+                                     'wal' if config['db_readers'] else 'memory')
+                    self.assertEqual(db.dc.execute('''select count(*) from sqlite_master
+                                                      where name='vcfidx' ''').fetchone()[0], 0)
+                    db.insert_calls(1, [1, 2, 3])
+                    raise RuntimeError('load failed')
+            self.assertEqual(db.dc.execute('select count(*) from vcfcalls').fetchone()[0], 0)
+            self.assertEqual(db.dc.execute('''select count(*) from sqlite_master
+                                              where name in ('vcfidx','vcfpidx')''').fetchone()[0], 2)
+            self.assertEqual(db.dc.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(db.dc.execute('PRAGMA cache_size').fetchone()[0], cache)
+            # indexes left deferred by a load that committed part way
+            db.defer_indexes(('bed',))
+            db.commit()
+            db.query_mode()
+            self.assertEqual(db.dc.execute('''select count(*) from sqlite_master
+                                              where name='bedidx' ''').fetchone()[0], 1)
+            self.assertEqual(db.dc.execute('PRAGMA locking_mode').fetchone()[0], 'normal')
+            db.db.close()
 
 if __name__ == '__main__':
     unittest.main()
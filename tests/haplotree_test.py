@@ -0,0 +1,176 @@
+import unittest,os,tempfile
+import numpy as np
+from callmatrix import *
+import haplotree
+from haplotree import *
+from db import DB
+from lib import pack_call
+
+# kits 0..5; clade A = kits 0-3 with subclade B = kits 0,1, and clade C = kits
+# 4,5; row 0 is positive in all kits, row 6 is a variant that fits nowhere
+P, N, U = CALL_POS, CALL_NEG, CALL_UNCALLED
+CALLS = [[P, P, P, P, P, P],
+         [P, P, P, U, N, N],   # A, kit 3 not called
+         [P, P, P, P, N, N],   # A
+         [P, P, N, N, N, N],   # B
+         [P, P, U, N, N, N],   # B
+         [N, N, N, N, P, P],   # C
+         [P, N, N, N, P, N]]   # junk
+
+class TestBuildTree(unittest.TestCase):
+
+    def setUp(self):
+        n = len(CALLS)
+        cm = CallMatrix(np.arange(n)+100, np.arange(n, dtype=np.int32)+1000,
+                        np.arange(6)+1, np.array(CALLS, dtype=np.int8))
+        self.tree = build_tree(cm, tolabs=0, tolperc=0, recurabs=3, recurrate=1000)
+
+    def kits(self, clade):
+        return [k for k in range(6) if clade in self.tree.lineage(self.tree.kitclade[k])]
+
+    def clade_of(self, row):
+        for clade, rows in enumerate(self.tree.variants):
+            if row in rows.tolist():
+                return clade
+
+    def test_clades(self):
+        tree = self.tree
+        self.assertEqual(tree.nclades, 4)
+        self.assertEqual(self.clade_of(0), 0)
+        self.assertEqual(self.clade_of(1), self.clade_of(2))
+        self.assertEqual(self.kits(self.clade_of(1)), [0, 1, 2, 3])
+        self.assertEqual(self.kits(self.clade_of(3)), [0, 1])
+        self.assertEqual(tree.parent[self.clade_of(3)], self.clade_of(1))
+        self.assertEqual(self.kits(self.clade_of(5)), [4, 5])
+        self.assertEqual(tree.junk, [6])
+
+    def test_assignment(self):
+        assigned = (self.tree.calls & ASSIGN_MASK).tolist()
+        self.assertEqual(assigned[1], [ASSIGN_POS]*3 + [ASSIGN_POS] + [ASSIGN_NEG]*2)
+        self.assertEqual(assigned[6], [ASSIGN_JUNK, 0, 0, 0, ASSIGN_JUNK, 0])
+        self.assertEqual((self.tree.calls & CALL_MASK).tolist(), CALLS)
+
+    # implied calls stay marked as implied
+    def test_implied(self):
+        calls = np.array(CALLS, dtype=np.int8)
+        calls[3, 1] |= CALL_IMPLIED
+        calls[0, 2] |= CALL_IMPLIED
+        n = len(CALLS)
+        cm = CallMatrix(np.arange(n)+100, np.arange(n, dtype=np.int32)+1000,
+                        np.arange(6)+1, calls)
+        tree = build_tree(cm, tolabs=0, tolperc=0, recurabs=3, recurrate=1000)
+        self.assertEqual(np.argwhere(tree.calls & CALL_IMPLIED).tolist(), [[0, 2], [3, 1]])
+        self.assertEqual(tree.calls[3, 1] & ASSIGN_MASK, ASSIGN_POS)
+        self.assertEqual(tree.calls[0, 2] & ASSIGN_MASK, ASSIGN_POS)
+
+    # variants with identical kit sets stay together despite different npass
+    def test_placement_order(self):
+        rows = np.array([10, 11, 12, 13])
+        order = haplotree._placement_order(rows, np.array([0, 1, 0, 2]),
+                                           np.array([5, 5, 5, 6]), np.array([5, 4, 3, 2]))
+        self.assertEqual(order.tolist(), [13, 10, 12, 11])
+
+    def test_variant_stats(self):
+        stats = variant_stats(np.array(CALLS, dtype=np.int8))
+        self.assertEqual(stats[3, VSTAT_PFIRST:VSTAT_PLAST+1].tolist(), [0, 1])
+        self.assertEqual(stats[5, VSTAT_COUNTS+CALL_POS], 2)
+        self.assertEqual(stats[1, VSTAT_COUNTS+CALL_UNCALLED], 1)
+
+    # the default tolerances only forgive back mutations in large clades
+    def test_default_tolerance(self):
+        n = len(CALLS)
+        cm = CallMatrix(np.arange(n)+100, np.arange(n, dtype=np.int32)+1000,
+                        np.arange(6)+1, np.array(CALLS, dtype=np.int8))
+        tree = build_tree(cm)
+        self.assertEqual(tree.nclades, 4)
+        self.assertEqual(tree.variants[0].tolist(), [0])
+        assigned = (tree.calls & ASSIGN_MASK).tolist()
+        self.assertEqual(assigned[2], [ASSIGN_POS]*4 + [ASSIGN_NEG]*2)
+        # one negative call among 200 kits is a back mutation
+        calls = np.full((2, 200), P, dtype=np.int8)
+        calls[0, 7] = N
+        calls[1, 100:] = N
+        cm = CallMatrix(np.array([1, 2]), np.array([10, 20], dtype=np.int32),
+                        np.arange(200)+1, calls)
+        tree = build_tree(cm, tolabs=2, tolperc=.01)
+        self.assertEqual(tree.variants[0].tolist(), [0])
+        self.assertEqual(tree.calls[0, 7] & ASSIGN_MASK, ASSIGN_JUNK)
+        self.assertEqual(tree.nclades, 2)
+
+class TestWalkKits(unittest.TestCase):
+
+    def test_walk(self):
+        # clade 1 (root, variant 10) > 2 (variants 20, 21) > 3 (variant 30),
+        # and 1 > 4 (variant 40)
+        ids = np.array([1, 2, 3, 4])
+        parents = np.array([0, 1, 2, 1])
+        variants = [np.array([10]), np.array([20, 21]), np.array([30]), np.array([40])]
+        vids = np.array([10, 20, 21, 30, 40])
+        # kits: into 3; into 2, uncalled for 30; into 4; splits 2; positive
+        # for both 2 and 4
+        calls = np.array([[P, P, P, P, P],
+                          [P, P, N, P, P],
+                          [P, U, N, N, P],
+                          [P, U, N, N, U],
+                          [N, N, P, N, P]], dtype=np.int8)
+        cm = CallMatrix(vids, vids.astype(np.int32), np.arange(5)+1, calls)
+        land = walk_kits(cm, ids, parents, variants)
+        self.assertEqual(land.tolist(), [3, 2, 4, 1, 1])
+
+    def test_subtree_ids(self):
+        ids = np.array([1, 2, 3, 4, 5])
+        parents = np.array([0, 1, 2, 1, 3])
+        self.assertEqual(sorted(haplotree._subtree_ids(ids, parents, 2).tolist()), [2, 3, 5])
+
+class TestPlaceKits(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db = DB(os.path.join(self.tmpdir.name, 'test.db'))
+        db.create_schema()
+        # root variant; clade A of kits 1-3 and clade C of kits 4 and 6; a private
+        # variant of kit 1 that kits 2 and 3 have a reference call for
+        self.vids = db.insert_variants([(1000, 'A', 'G'), (2000, 'C', 'T'),
+                                        (3000, 'G', 'A'), (4000, 'T', 'C'),
+                                        (2000, 'C', '.'), (3000, 'G', '.'),
+                                        (4000, 'T', '.')])
+        root, a, c, priv, refa, refc, refpriv = self.vids
+        kits = {1: [root, a, refc, priv], 2: [root, a, refc, refpriv],
+                3: [root, a, refc, refpriv], 4: [root, refa, c, refpriv],
+                6: [root, refa, c, refpriv]}
+        call = pack_call((0, 0, 0, 'PASS', 50., 40., 30, 1.))
+        for pid, vids in kits.items():
+            db.insert_calls(pid, vids, [call] * len(vids))
+        db.commit()
+        self.db = db
+
+    def tearDown(self):
+        self.db.db.close()
+        self.tmpdir.cleanup()
+
+    def tree(self):
+        return {i: (p, v.tolist()) for i, p, v in zip(*load_tree(self.db))}
+
+    # a new kit sharing the private variant of kit 1 splits clade A
+    def test_place_kits(self):
+        root, a, c, priv = self.vids[:4]
+        make_tree(self.db)
+        before = self.tree()
+        self.assertEqual(sorted(v for p, v in before.values()), sorted([[a], [c], [root]]))
+        clade_a = [i for i, (p, v) in before.items() if v == [a]][0]
+        call = pack_call((0, 0, 0, 'PASS', 50., 40., 30, 1.))
+        self.db.insert_calls(5, [root, a, self.vids[5], priv], [call] * 4)
+        self.db.commit()
+        self.assertEqual(place_kits(self.db), [clade_a])
+        after = self.tree()
+        # the old clades keep their ids; the new one is below clade A
+        self.assertEqual({i: after[i] for i in before}, before)
+        new = [i for i in after if i not in before]
+        self.assertEqual([after[i] for i in new], [(clade_a, [priv])])
+        kitclade = dict(self.db.dc.execute('select pID, cladeID from treekits'))
+        self.assertEqual(kitclade[1], new[0])
+        self.assertEqual(kitclade[5], new[0])
+        self.assertEqual((kitclade[2], kitclade[3]), (clade_a, clade_a))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+from bitset import pack, unpack
+from implications import *
+
+class TestImplications(unittest.TestCase):
+
+    def test_parse(self):
+        lines = ['7295098 & 8796078 > 14950507 : A763 & U106 > A1155\n',
+                 '7246726 > 23612197 : L48 > Z381\n',
+                 '7751173  & 14194740> 22485797 : A5890 & S514/Z344 > A297\n',
+                 '#10008883 > 19377086\n',
+                 'S10415 > FGC10299  : 14052210 > 7623846\n',
+                 '^ 14181107 Z301 C T\n',
+                 '< 14144641\tL77\t\t\t\tT\tG\n',
+                 '\n']
+        self.assertEqual(parse_implications(lines), [
+            ('>', 14950507, 7295098, 8796078, None, None, 'A763 & U106 > A1155'),
+            ('>', 23612197, 7246726, None, None, None, 'L48 > Z381'),
+            ('>', 22485797, 7751173, 14194740, None, None, 'A5890 & S514/Z344 > A297'),
+            ('^', 14181107, None, None, 'C', 'T', 'Z301'),
+            ('<', 14144641, None, None, 'T', 'G', 'L77')])
+
+    def test_apply(self):
+        # positions 10, 20, 30, 40; 50 is in no row
+        positions = np.array([10, 20, 30, 40])
+        pos = np.array([[1, 1, 0, 0, 1],
+                        [1, 0, 1, 0, 0],
+                        [0, 0, 0, 0, 0],
+                        [0, 0, 0, 0, 0]], dtype=bool)
+        # 30 <- 20 & 10, 40 <- 30 (listed first, so it needs the levels),
+        # 20 <- 10 & 50 (missing conjunct), 10 <- 60 (not in the matrix)
+        b = np.array([40, 30, 20, 10])
+        a = np.array([30, 20, 10, 60])
+        c = np.array([-1, 10, 50, -1])
+        rules = CompiledRules(b, a, c, positions)
+        self.assertEqual(len(rules), 3)
+        bits = np.vstack((pack(pos), pack(np.ones((1, 5), dtype=bool))))
+        self.assertEqual(rules.apply(bits), 1)
+        self.assertEqual(unpack(bits[:4], 5).astype(int).tolist(),
+                         [[1, 1, 0, 0, 1], [1, 1, 1, 0, 1], [1, 1, 0, 0, 1], [1, 1, 0, 0, 1]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import unittest,os,tempfile
+import numpy as np
+from kitstore import *
+from db import DB
+from reduxconfig import config_changes
+
+class TestArrayStores(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.arrays = NpyArrayStore(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_calls(self):
+        store = ArrayCallStore(self.arrays)
+        store.put_calls(7, [30, 10, 20], [3, 1, 2])
+        vids, callinfo = store.get_calls(7)
+        self.assertEqual(vids.tolist(), [10, 20, 30])
+        self.assertEqual(callinfo.tolist(), [1, 2, 3])
+        self.assertEqual(store.kit_ids(), [7])
+        store.delete_calls(7)
+        self.assertEqual(store.kit_ids(), [])
+        self.assertEqual(len(store.get_calls(7)[0]), 0)
+
+    def test_ranges(self):
+        store = ArrayBedStore(self.arrays)
+        store.put_ranges(3, np.array([[500, 900], [100, 200]]))
+        starts, ends = store.get_ranges(3)
+        self.assertEqual(starts.dtype.name, 'int32')
+        self.assertEqual(starts.tolist(), [100, 500])
+        self.assertEqual(ends.tolist(), [200, 900])
+        self.assertEqual(store.kit_ids(), [3])
+        store.delete_ranges(3)
+        self.assertEqual(store.kit_ids(), [])
+        self.assertEqual(len(store.get_ranges(3)[0]), 0)
+
+class TestDBStores(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        changes = config_changes(REDUX_DATA=self.tmpdir.name, verbosity=0)
+        changes.__enter__()
+        self.addCleanup(changes.__exit__, None, None, None)
+        self.db = DB(os.path.join(self.tmpdir.name, 'test.db'))
+        self.db.create_schema()
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.db.close()
+        self.tmpdir.cleanup()
+
+    def test_table_calls(self):
+        vids = self.db.insert_variants([(300, 'A', 'G'), (100, 'C', 'T')])
+        store = call_store(self.db, 'table')
+        store.put_calls(4, vids, [7, 8])
+        got, callinfo = store.get_calls(4)
+        self.assertEqual(list(zip(got.tolist(), callinfo.tolist())),
+                         sorted(zip(vids, [7, 8])))
+        self.assertEqual(store.kit_ids(), [4])
+        store.delete_calls(4)
+        self.assertEqual((store.kit_ids(), len(store.get_calls(4)[0])), ([], 0))
+
+    def test_blob_arrays(self):
+        arrays = BlobArrayStore(self.db)
+        arrays.put(2, 'vid', np.array([5, 9], dtype=np.int32))
+        arrays.put(1, 'vid', np.array([3], dtype=np.int32))
+        got = arrays.get(2, 'vid')
+        self.assertEqual((got.dtype.name, got.tolist()), ('int32', [5, 9]))
+        self.assertIsNone(arrays.get(2, 'callinfo'))
+        self.assertEqual(arrays.pids('vid'), [1, 2])
+        arrays.delete(2, 'vid')
+        self.assertEqual(arrays.pids('vid'), [1])
+
+    # calls and ranges survive a trip through every kind of store
+    def test_migrate(self):
+        vids = self.db.insert_variants([(300, 'A', 'G'), (100, 'C', 'T'), (200, 'G', 'A')])
+        calls = {1: (vids, [1, 2, 3]), 2: (vids[1:], [4, 5])}
+        ranges = {1: [[100, 400]], 2: [[50, 60], [10, 20]]}
+        for pid in calls:
+            call_store(self.db, 'table').put_calls(pid, *calls[pid])
+            bed_store(self.db, 'table').put_ranges(pid, ranges[pid])
+        self.db.commit()
+        kinds = ('table', 'npy', 'blob', 'table')
+        for src, dst in zip(kinds, kinds[1:]):
+            migrate_call_store(self.db, src, dst)
+            migrate_bed_store(self.db, src, dst)
+            self.assertEqual(call_store(self.db, src).kit_ids(), [])
+            self.assertEqual(bed_store(self.db, src).kit_ids(), [])
+            cstore, bstore = call_store(self.db, dst), bed_store(self.db, dst)
+            self.assertEqual((cstore.kit_ids(), bstore.kit_ids()), ([1, 2], [1, 2]))
+            for pid in calls:
+                got, callinfo = cstore.get_calls(pid)
+                self.assertEqual(list(zip(got.tolist(), callinfo.tolist())),
+                                 sorted(zip(*calls[pid])))
+                starts, ends = bstore.get_ranges(pid)
+                self.assertEqual(list(zip(starts.tolist(), ends.tolist())),
+                                 sorted(map(tuple, ranges[pid])))
+
+    # npy files change with the transaction
+    def test_npy_staging(self):
+        store = call_store(self.db, 'npy')
+        store.put_calls(1, [3, 1], [30, 10])
+        self.assertEqual(store.kit_ids(), [1])
+        self.assertEqual(call_store(self.db, 'npy').get_calls(1)[0].tolist(), [1, 3])
+        self.assertEqual(NpyArrayStore(store.arrays.dirname).pids('vid'), [])
+        self.db.rollback()
+        self.assertEqual(store.kit_ids(), [])
+        store.put_calls(1, [3, 1], [30, 10])
+        self.db.commit()
+        # a replaced kit whose load rolls back keeps its old files
+        with self.assertRaises(RuntimeError):
+            with self.db.bulk_load():
+                store.delete_calls(1)
+                store.put_calls(2, [5], [50])
+                self.assertEqual(store.kit_ids(), [2])
+                raise RuntimeError('load failed')
+        self.assertEqual(store.kit_ids(), [1])
+        self.assertEqual(store.get_calls(1)[1].tolist(), [10, 30])
+        mark = len(self.db.staged)
+        store.put_calls(3, [7], [70])
+        self.db.discard_files(mark)
+        store.delete_calls(1)
+        self.db.commit()
+        self.assertEqual(store.kit_ids(), [])
+        dirname = os.path.join(store.arrays.dirname, 'vid')
+        self.assertEqual(os.listdir(dirname), [])
+
+if __name__ == '__main__':
+    unittest.main()
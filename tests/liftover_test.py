@@ -0,0 +1,118 @@
+import unittest,os,tempfile
+import numpy as np
+from liftover import *
+from lib import lift_kit, load_VCF_calls, plan_kit_loads, KIT_PARSER_VERSION
+from db import DB
+from array_api import get_build_byname
+from reduxconfig import config_changes
+
+# two chains on chrY: a forward one with a gap in each build, and a worse
+# one on the reverse strand that overlaps it; and a chain to chrX
+CHAIN = '''chain 100 chrY 1000 + 100 400 chrY 1200 + 150 460 1
+50 10 0
+100 0 20
+140
+
+chain 50 chrY 1000 + 350 500 chrY 1200 - 0 150 2
+150
+
+chain 80 chrY 1000 + 600 700 chrX 1200 + 0 100 3
+100
+'''
+
+class TestChainMap(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmpdir.name, 'liftover'))
+        self.fname = os.path.join(self.tmpdir.name, 'liftover', 'hg19ToHg38.over.chain')
+        with open(self.fname, 'w') as f:
+            f.write(CHAIN)
+        self.chain = ChainMap.read(self.fname, chrom='chrY')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_read(self):
+        self.assertEqual(self.chain.tstart.tolist(), [100, 160, 260, 400])
+        self.assertEqual(self.chain.tend.tolist(), [150, 260, 400, 500])
+        self.assertEqual(self.chain.reverse.tolist(), [False, False, False, True])
+
+    def test_positions(self):
+        mapped, reverse = self.chain.map_positions([101, 156, 161, 260, 261, 421, 651, 1])
+        self.assertEqual(mapped.tolist(), [151, -1, 201, 300, 321, 1130, -1, -1])
+        self.assertEqual(reverse.tolist(), [False] * 5 + [True, False, False])
+
+    def test_ranges(self):
+        starts, ends, src, lost = self.chain.map_ranges([140, 250, 390, 0], [170, 270, 410, 50])
+        self.assertEqual(list(zip(starts.tolist(), ends.tolist(), src.tolist())),
+                         [(190, 210, 0), (290, 300, 1), (320, 330, 1),
+                          (450, 460, 2), (1140, 1150, 2)])
+        self.assertEqual(lost.tolist(), [10, 0, 0, 50])
+
+    # a one-base range maps where its position does
+    def test_consistent(self):
+        pos = np.random.default_rng(3).integers(1, 1000, 2000)
+        mapped, reverse = self.chain.map_positions(pos)
+        starts, ends, src, lost = self.chain.map_ranges(pos - 1, pos)
+        self.assertEqual(src.tolist(), np.flatnonzero(mapped >= 0).tolist())
+        self.assertEqual(ends.tolist(), mapped[mapped >= 0].tolist())
+        self.assertEqual(lost.tolist(), (mapped < 0).astype(int).tolist())
+
+    def test_lift_kit(self):
+        with config_changes(REDUX_DATA=self.tmpdir.name):
+            try:
+                get_liftover.cache_clear()
+                db = DB(os.path.join(self.tmpdir.name, 'test.db'))
+                db.create_schema()
+                hg19 = get_build_byname(db, 'hg19')
+                calls = {'pos': np.array([421, 101, 651], dtype=np.int32),
+                         'anc': ['A', 'C', 'G'], 'der': ['G', 'T', 'T'],
+                         'callinfo': np.array([1, 2, 3], dtype=np.uint32)}
+                ranges = np.array([[140, 170], [390, 410]], dtype=np.int32)
+                bid, ranges, lifted = lift_kit(db, hg19, 1, ranges, calls)
+                self.assertEqual(bid, get_build_byname(db, 'hg38'))
+                self.assertEqual(ranges.tolist(), [[190, 210], [450, 460], [1140, 1150]])
+                self.assertEqual(lifted['pos'].tolist(), [151, 1130])
+                self.assertEqual((lifted['anc'], lifted['der']), (['C', 'T'], ['T', 'C']))
+                self.assertEqual(lifted['callinfo'].tolist(), [2, 1])
+                load_VCF_calls(db, bid, 1, lifted)
+                self.assertEqual(db.dc.execute('''select v.pos from vcfcalls c
+                                                  inner join variants v on v.ID=c.vID
+                                                  where v.buildID=? order by v.pos''',
+                                               (bid,)).fetchall(), [(151,), (1130,)])
+                # no chain file: the kit is left as it is
+                get_liftover.cache_clear()
+                config['REDUX_DATA'] = os.path.join(self.tmpdir.name, 'none')
+                self.assertIs(lift_kit(db, hg19, 1, None, calls)[2], calls)
+                db.db.close()
+            finally:
+                get_liftover.cache_clear()
+
+    # only kits stored in a build that a chain file now lifts are re-loaded
+    def test_plan(self):
+        with config_changes(REDUX_DATA=self.tmpdir.name):
+            os.makedirs(os.path.join(self.tmpdir.name, 'HaplogroupR'))
+            db = DB(os.path.join(self.tmpdir.name, 'test.db'))
+            db.create_schema()
+            hg19, hg38 = get_build_byname(db, 'hg19'), get_build_byname(db, 'hg38')
+            allsets = []
+            for pid, bid in ((1, hg38), (2, hg19), (3, hg19)):
+                fn = 'kit{}.zip'.format(pid)
+                zipf = os.path.join(self.tmpdir.name, 'HaplogroupR', fn)
+                with open(zipf, 'w') as f:
+                    f.write('kit')
+                st = os.stat(zipf)
+                # kit 3 was lifted already
+                db.dc.execute('insert into loadmanifest values(?,?,?,?,?,?,?,?)',
+                              (pid, zipf, st.st_size, st.st_mtime, '', KIT_PARSER_VERSION,
+                               None, hg38 if pid != 2 else hg19))
+                allsets.append((fn, bid, pid))
+            tasks, fileinfo, replace = plan_kit_loads(db, allsets)
+            self.assertEqual([t[2] for t in tasks], [2])
+            os.unlink(self.fname)
+            self.assertEqual(plan_kit_loads(db, allsets)[0], [])
+            db.db.close()
+
+if __name__ == '__main__':
+    unittest.main()
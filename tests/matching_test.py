@@ -0,0 +1,80 @@
+import unittest,os
+import numpy as np
+from matching import *
+from matching import _cells, _scipy_sparse
+from callmatrix import CallMatrix, CALL_POS, CALL_NEG, CALL_BEDNEG, CALL_UNCALLED
+
+BACKENDS = (False, True) if _scipy_sparse() else (False,)
+
+class TestIndicator(unittest.TestCase):
+
+    # products equal dense ones, with variants set for most kits held as
+    # complements
+    def test_dot(self):
+        rng = np.random.default_rng(1)
+        nvar, nkits = 300, 70
+        x = rng.random((nvar, nkits)) < rng.random((nvar, 1))
+        y = rng.random((nvar, nkits)) < .2
+        blocks = lambda m: [_cells(m[s:s+64], s) for s in range(0, nvar, 64)]
+        for sparse in BACKENDS:
+            X = Indicator.from_cells(nkits, blocks(x), sparse)
+            Y = Indicator.from_cells(nkits, blocks(y), sparse)
+            self.assertTrue(X.high.any())
+            rows = [0, 3, 69]
+            self.assertEqual(X.dot(Y, rows).tolist(),
+                             (x[:, rows].T.astype(int) @ y).tolist())
+            self.assertEqual(X.counts().tolist(), x.sum(axis=0).tolist())
+            # replace one kit and add one
+            x[:, 3] = rng.random(nvar) < .5
+            X = X.set_kit(3, x[:, 3]).set_kit(nkits, x[:, 0])
+            xx = np.column_stack((x, x[:, 0]))
+            self.assertEqual(X.dot(X, [3, nkits]).tolist(),
+                             (xx[:, [3, nkits]].T.astype(int) @ xx).tolist())
+
+class TestMatchIndex(unittest.TestCase):
+
+    def test_compare(self):
+        rng = np.random.default_rng(2)
+        nvar, nkits = 200, 12
+        codes = rng.choice([CALL_POS, CALL_NEG, CALL_BEDNEG, CALL_UNCALLED], (nvar, nkits),
+                           p=[.5, .1, .3, .1]).astype(np.int8)
+        cm = CallMatrix(np.arange(nvar), np.arange(nvar) * 100 + 1000,
+                        np.arange(nkits) + 1, codes)
+        # two kits cover the same, one covers nothing
+        ranges = [(np.array([1000, 50000]), np.array([30000, 60000]))] * (nkits - 1) + \
+            [(np.zeros(0, dtype=int), np.zeros(0, dtype=int))]
+        for sparse in BACKENDS:
+            index = MatchIndex.from_call_matrix(cm, ranges, sparse, binsize=1000)
+            nshared, ndiff, covered, distance = index.compare(np.arange(nkits))
+            pos = (codes == CALL_POS).astype(int)
+            seen = (codes != CALL_UNCALLED).astype(int)
+            shared = pos.T @ pos
+            self.assertEqual(nshared.tolist(), shared.tolist())
+            self.assertEqual(ndiff.tolist(), (pos.T @ seen - shared + seen.T @ pos - shared).tolist())
+            self.assertEqual(covered[0, 1], 39000)
+            self.assertEqual(covered[0, -1], 0)
+            self.assertTrue(np.isinf(distance[np.arange(nkits), np.arange(nkits)]).all())
+            self.assertTrue(np.isinf(distance[:, -1]).all())
+            rows = index.matches([0], 5)
+            self.assertEqual([r[1] for r in rows], [1, 2, 3, 4, 5])
+            self.assertEqual([r[6] for r in rows], sorted(r[6] for r in rows))
+            self.assertNotIn(1, [r[2] for r in rows])
+
+class TestMatchKits(unittest.TestCase):
+
+    # matching one kit against the index agrees with matching all kits
+    def test_match_kit(self):
+        from synth import cohort_db
+        with cohort_db(8, seed=2) as db:
+            index = match_all(db, k=3)
+            self.assertEqual(index.nkits, 8)
+            self.assertTrue(os.path.exists(match_index_path()))
+            query = 'select * from matches where pID=? order by rank'
+            pid = int(index.pids[2])
+            before = db.dc.execute(query, (pid,)).fetchall()
+            self.assertEqual(len(before), 3)
+            self.assertEqual(match_kit(db, pid, k=3), before)
+            self.assertEqual(db.dc.execute('select count(*) from matches').fetchone()[0], 24)
+
+if __name__ == '__main__':
+    unittest.main()
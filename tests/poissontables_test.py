@@ -0,0 +1,60 @@
+import unittest
+import math
+import os
+import sqlite3
+import tempfile
+import numpy as np
+import poissontables
+from poissontables import *
+from reduxconfig import config_changes
+
+class FakeDB(object):
+
+    def __init__(self):
+        self.dc = sqlite3.connect(':memory:').cursor()
+        self.dc.execute('create table meta(descr TEXT, val TEXT)')
+
+class TestPoissonTables(unittest.TestCase):
+
+    def test_cpoisson(self):
+        table = make_cpoisson_table(.5, 2, 20)
+        self.assertEqual(table.shape, (9, 24))
+        # P(X <= k) at the tabulated mean is Phi(sigma)
+        for row in table:
+            for k in (0, 3, 20):
+                m = row[CPOIS_M0 + k]
+                cdf = sum(math.exp(j*math.log(m) - m - math.lgamma(j+1)) for j in range(k+1))
+                self.assertAlmostEqual(cdf, row[1], delta=1e-9)
+
+    # small counts far in the tails, where P(X <= 0) = exp(-m)
+    def test_tails(self):
+        table = make_cpoisson_table(.1, 4.9, 3)
+        self.assertAlmostEqual(table[-1, CPOIS_M0], -math.log(table[-1, 1]), delta=1e-12)
+        self.assertTrue((np.diff(table[:, CPOIS_M0:-1], axis=1) > 0).all())
+        self.assertTrue((np.diff(table[:, CPOIS_M0:-1], axis=0) < 0).all())
+
+    def test_interval(self):
+        table = make_cpoisson_table(.1, 3, 50)
+        lo, hi = poisson_interval(table, [0, 10, 50, 60], 1.96)
+        self.assertTrue((lo < hi).all())
+        self.assertAlmostEqual(hi[0], 3.69, places=2)
+        self.assertAlmostEqual(lo[1], 5.49, places=2)
+        self.assertAlmostEqual(hi[1], 18.39, places=1)
+        self.assertTrue(lo[2] < lo[3] and hi[2] < hi[3])
+
+    def test_cache(self):
+        db = FakeDB()
+        with tempfile.TemporaryDirectory() as tmpdir, config_changes(REDUX_DATA=tmpdir):
+            table = cpoisson_table(db, .5, 2, 10)
+            self.assertIsInstance(table, np.memmap)
+            fname = os.path.join(tmpdir, poissontables.config['poisson_dir'],
+                                 'cpoisson_table.npy')
+            mtime = os.path.getmtime(fname)
+            os.utime(fname, (mtime - 100, mtime - 100))
+            self.assertEqual(len(cpoisson_table(db, .5, 2, 10)), 9)
+            self.assertEqual(os.path.getmtime(fname), mtime - 100)
+            self.assertEqual(len(cpoisson_table(db, .25, 2, 10)), 17)
+            self.assertEqual(db.dc.execute('select count(*) from meta').fetchone()[0], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest,os,tempfile
+from queryservice import *
+from lib import pack_call
+
+class TestQueryService(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dbfname = os.path.join(self.tmpdir.name, 'test.db')
+        db = DB(self.dbfname)
+        db.create_schema()
+        vids = db.insert_variants([(1000, 'A', 'G'), (2000, 'C', 'T'), (2000, 'C', 'A')])
+        db.dc.executemany('insert into snpnames(vID,snpname) values(?,?)',
+                          [(vids[0], 'M1'), (vids[0], 'M1.1'), (vids[1], 'Z2')])
+        db.dc.execute("insert into dataset(ID,kitId,kitName) values(1,'B1001','kit one')")
+        db.dc.execute("insert into dataset(ID,kitId,kitName) values(2,'B1002','kit two')")
+        db.insert_calls(1, vids[:2], [pack_call((0, 0, 0, 'PASS', 50., 40., 30, 1.)),
+                                      pack_call((0, 0, 0, 'FAIL', 5., 4., 3, .5))])
+        db.dc.execute('insert into matches values(1,1,2,2,0,1000000,0.)')
+        db.commit()
+        self.writer = db
+        self.vids = vids
+        self.service = QueryService(self.dbfname, size=2)
+
+    def tearDown(self):
+        self.service.close()
+        self.writer.db.close()
+        self.tmpdir.cleanup()
+
+    def test_lookups(self):
+        s = self.service
+        self.assertEqual(s.kit('B1001')['pID'], 1)
+        self.assertEqual(s.kit('kit two')['kitId'], 'B1002')
+        self.assertIsNone(s.kit('nobody'))
+        at = s.variants_at(2000)
+        self.assertEqual([(v['anc'], v['der']) for v in at], [('C', 'T'), ('C', 'A')])
+        self.assertEqual(at[0]['names'], ['Z2'])
+        self.assertEqual(s.variants_at(2000, 'hg19'), [])
+        self.assertEqual([v['pos'] for v in s.snp('M1.1')], [1000])
+        calls = s.calls('B1001')
+        self.assertEqual([(c['pos'], c['der'], c['pass']) for c in calls],
+                         [(1000, 'G', True), (2000, 'T', False)])
+        self.assertEqual(calls[0]['nreads'], 30)
+        self.assertEqual(s.calls('B1002'), [])
+        self.assertEqual(s.matches('B1001')[0]['kitId'], 'B1002')
+        self.assertEqual(s.query('select count(*) as n from variants'), [{'n': 3}])
+        with self.assertRaises(sqlite3.OperationalError):
+            s.query('delete from variants')
+        self.assertTrue(s.nopen <= 2)
+
+    # readers see what the writer last committed, also during a bulk load
+    def test_snapshots(self):
+        with self.writer.bulk_load(('snpnames',)):
+            self.writer.dc.execute('insert into snpnames(vID,snpname) values(?,?)',
+                                   (self.vids[2], 'L3'))
+            self.assertEqual(self.service.snp('L3'), [])
+            self.assertEqual(len(self.service.snp('M1')), 1)
+        self.assertEqual([v['der'] for v in self.service.snp('L3')], ['A'])
+
+    # indexes left dropped by a failed load are rebuilt before serving
+    def test_prepare(self):
+        self.writer.defer_indexes(('snpnames',))
+        self.writer.commit()
+        prepare(self.dbfname)
+        self.assertEqual(self.writer.dc.execute('''select count(*) from sqlite_master
+                                                  where name in ('snpidx','snpvidx')''').fetchone()[0], 2)
+        self.assertEqual(self.writer.dc.execute('''select count(*) from meta
+                                                  where descr='deferred_index' ''').fetchone()[0], 0)
+
+    def test_handle(self):
+        self.assertEqual(handle(self.service, '/kit/B1001')[0], 200)
+        self.assertEqual(handle(self.service, '/kit/kit%20one')[1]['kitId'], 'B1001')
+        self.assertEqual(handle(self.service, '/calls/B1009')[0], 404)
+        self.assertEqual(handle(self.service, '/variants/x')[0], 400)
+        status, result = handle(self.service, '/variants/1000?build=hg38')
+        self.assertEqual((status, result[0]['names']), (200, ['M1', 'M1.1']))
+        self.assertEqual(handle(self.service, '/tables')[0], 404)
+
+if __name__ == '__main__':
+    unittest.main()
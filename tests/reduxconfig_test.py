@@ -0,0 +1,33 @@
+import unittest
+import os
+import json
+import tempfile
+from reduxconfig import load_config, _cache_path
+
+class TestConfig(unittest.TestCase):
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'config.yaml')
+            with open(fname, 'w') as f:
+                f.write('REDUX_DATA: ../data\nDB_FILE: variant.db\nzip_dir: zip\nverbosity: 1\n')
+            config = load_config(fname)
+            self.assertEqual(config['REDUX_DATA'],
+                             os.path.join(os.path.dirname(tmpdir), 'data'))
+            self.assertEqual(config['DB_FILE'], os.path.join(tmpdir, 'variant.db'))
+            self.assertEqual(config['zip_dir'], 'zip')
+            # a current cache is used instead of the file
+            cache = _cache_path(fname)
+            with open(cache) as f:
+                cached = json.load(f)
+            cached['config']['verbosity'] = 5
+            with open(cache, 'w') as f:
+                json.dump(cached, f)
+            self.assertEqual(load_config(fname)['verbosity'], 5)
+            # a changed file is parsed again
+            st = os.stat(fname)
+            os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            self.assertEqual(load_config(fname)['verbosity'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
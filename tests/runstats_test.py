@@ -0,0 +1,78 @@
+import unittest
+import os
+import json
+import sqlite3
+import tempfile
+import runstats
+from runstats import *
+
+class FakeDB(object):
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:')
+        self.dc = self.db.cursor()
+        self.dc.execute('''create table runstats(runID INTEGER, stage TEXT, parent TEXT,
+                           pID INTEGER, startDt TEXT, wall REAL, cpu REAL,
+                           maxrss INTEGER, nrows INTEGER, failed SMALLINT)''')
+
+    def commit(self):
+        self.db.commit()
+
+@timed('outer')
+def outer():
+    for pid in (1, 2):
+        with span('kit', pid) as sp:
+            sp.rows = 10 * pid
+    return 'done'
+
+class TestRunStats(unittest.TestCase):
+
+    def setUp(self):
+        clear()
+        runstats._enabled = False
+
+    def tearDown(self):
+        clear()
+        runstats._enabled = False
+
+    def test_disabled(self):
+        self.assertEqual(outer(), 'done')
+        self.assertEqual(spans(), [])
+
+    def test_spans(self):
+        enable()
+        outer()
+        with self.assertRaises(ZeroDivisionError):
+            with span('broken'):
+                1/0
+        sp = spans()
+        self.assertEqual([s['stage'] for s in sp], ['kit', 'kit', 'outer', 'broken'])
+        self.assertEqual([s['parent'] for s in sp], ['outer', 'outer', '', ''])
+        self.assertEqual(sp[1]['pid'], 2)
+        self.assertEqual(sp[1]['rows'], 20)
+        self.assertEqual([s['failed'] for s in sp], [False, False, False, True])
+        self.assertTrue(sp[2]['wall'] >= sp[0]['wall'] + sp[1]['wall'])
+        totals = stage_totals(sp)
+        kit = [t for t in totals if t['stage'] == 'kit'][0]
+        self.assertEqual((kit['count'], kit['rows']), (2, 30))
+
+    def test_save(self):
+        enable()
+        outer()
+        db = FakeDB()
+        self.assertEqual(save_runstats(db), 1)
+        self.assertEqual(save_runstats(db), 2)
+        self.assertEqual(db.dc.execute('''select count(*), sum(nrows) from runstats
+                                          where runID=2''').fetchone(), (3, 30))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'runstats.json')
+            write_report(fname, runid=2)
+            with open(fname) as f:
+                report = json.load(f)
+        self.assertEqual(report['runID'], 2)
+        self.assertEqual([k['pid'] for k in report['slowest_kits']], [2, 1] if
+                         spans()[1]['wall'] > spans()[0]['wall'] else [1, 2])
+        self.assertEqual(len(report['spans']), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import io
+import numpy as np
+from synth import *
+from synth import _covered
+from lib import parse_VCF_file, parse_BED_file
+
+class TestSynth(unittest.TestCase):
+
+    def test_phylogeny(self):
+        parent, age = random_phylogeny(50, np.random.default_rng(3), tmrca=1000.)
+        self.assertEqual(len(parent), 99)
+        self.assertEqual(parent[-1], -1)
+        self.assertEqual(age[-1], 1000.)
+        # every internal node has two children and is older than them
+        self.assertEqual(np.bincount(parent[:-1]).tolist()[50:], [2] * 49)
+        self.assertTrue((age[parent[:-1]] > age[:-1]).all())
+        self.assertTrue((age[:50] == 0).all())
+        paths = lineages(parent, 50)
+        self.assertTrue(all(p[-1] == 98 for p in paths))
+
+    def test_kit_files(self):
+        rng = np.random.default_rng(4)
+        parent, age = random_phylogeny(4, rng)
+        offsets, pos, ref, alt = branch_snps(parent, age, rng, .8, 15e6, 100)
+        self.assertEqual(len(np.unique(pos)), len(pos))
+        self.assertEqual(offsets[-1] - offsets[-2], 100)
+        self.assertTrue((ref != alt).all())
+        ranges = random_coverage(rng)
+        self.assertTrue((ranges[1:, 0] > ranges[:-1, 1]).all())
+        vcf, bed = kit_files(rng, ranges, pos, ref, alt, nerrors=0)
+        calls = [t for b in parse_VCF_file(io.StringIO(vcf)) for t in b]
+        # calls inside the coverage are all there, with their alleles
+        inside = set(zip(pos[_covered(ranges, pos)].tolist(),
+                         ref[_covered(ranges, pos)].tolist()))
+        self.assertTrue(inside <= set((c[0], c[1]) for c in calls))
+        self.assertTrue(all(c[3] in ('PASS', 'FAIL') and c[6] > 0 for c in calls))
+        self.assertEqual(parse_BED_file(io.StringIO(bed)).tolist(), ranges.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
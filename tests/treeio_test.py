@@ -0,0 +1,78 @@
+import unittest
+import io
+import sqlite3
+import numpy as np
+from xml.etree import ElementTree
+from treeio import *
+
+class FakeDB(object):
+
+    def __init__(self):
+        self.dc = sqlite3.connect(':memory:').cursor()
+        self.dc.execute('create table meta(descr TEXT, val TEXT)')
+        self.dc.execute('''create table tree(id INTEGER PRIMARY KEY, parendid INTEGER,
+                           clade CHARACTER(16), variants BLOB, snpage SMALLINT,
+                           snpagelo SMALLINT, snpagehi SMALLINT, snpagepdf BLOB)''')
+
+# root R with children A (child C) and B; B has no age
+CLADES = [(1, None, 'R', [5, 6, 7], 1000, 800, 1200, [.5, .5]),
+          (2, 1, 'A', [8], 600, 500, 700, [1, 0]),
+          (3, 1, 'B b', [9, 10], None, None, None, None),
+          (4, 2, 'C', [], 100, 50, 150, [0, 1])]
+
+def make_db():
+    db = FakeDB()
+    db.dc.executemany('insert into tree values(?,?,?,?,?,?,?,?)',
+                      [c[:3] + (encode('variants', c[3]),) + c[4:7] +
+                       (encode('pdf', c[7]) if c[7] else None,) for c in CLADES])
+    set_tree_encoding(db)
+    return db
+
+class TestTreeIO(unittest.TestCase):
+
+    def test_encoding(self):
+        blob = encode('variants', np.array([1, -2, 3], dtype=np.int64))
+        self.assertEqual(len(blob), 12)
+        self.assertEqual(decode('variants', blob).tolist(), [1, -2, 3])
+        self.assertEqual(len(decode('pdf', None)), 0)
+        flat, offsets = decode_many('variants', [blob, None, encode('variants', [4])])
+        self.assertEqual(flat.tolist(), [1, -2, 3, 4])
+        self.assertEqual(offsets.tolist(), [0, 3, 3, 4])
+
+    def test_version(self):
+        db = make_db()
+        self.assertEqual(get_tree_encoding(db), TREE_ENCODING)
+        set_tree_encoding(db, 99)
+        with self.assertRaises(ValueError):
+            read_tree(db)
+
+    def test_read(self):
+        tree = read_tree(make_db(), pdf=True)
+        self.assertEqual(tree.prow.tolist(), [-1, 0, 0, 1])
+        self.assertEqual(tree.children(0).tolist(), [1, 2])
+        self.assertEqual(tree.variants(2).tolist(), [9, 10])
+        self.assertEqual([len(v) for v in tree.variant_list()], [3, 1, 2, 0])
+        self.assertTrue(np.isnan(tree.age[2]))
+        self.assertEqual(tree.pdf.tolist(), [[.5, .5], [1, 0], [0, 0], [0, 1]])
+        self.assertEqual(branch_lengths(tree).tolist(), [3, 400, 2, 500])
+
+    def test_newick(self):
+        out = io.StringIO()
+        write_newick(read_tree(make_db()), out)
+        self.assertEqual(out.getvalue(), "((C:500)A:400,'B b':2)R;\n")
+
+    def test_phyloxml(self):
+        out = io.StringIO()
+        write_phyloxml(read_tree(make_db()), out)
+        ns = {'p': 'http://www.phyloxml.org'}
+        root = ElementTree.fromstring(out.getvalue()).find('p:phylogeny/p:clade', ns)
+        self.assertEqual(root.find('p:name', ns).text, 'R')
+        self.assertEqual(root.find('p:date/p:minimum', ns).text, '800')
+        kids = root.findall('p:clade', ns)
+        self.assertEqual([k.find('p:name', ns).text for k in kids], ['A', 'B b'])
+        self.assertEqual(kids[0].get('branch_length'), '400')
+        self.assertIsNone(kids[1].find('p:date', ns))
+        self.assertEqual(kids[0].find('p:clade/p:name', ns).text, 'C')
+
+if __name__ == '__main__':
+    unittest.main()
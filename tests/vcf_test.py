@@ -0,0 +1,46 @@
+import unittest,io
+from lib import *
+
+VCF = b'''##fileformat=VCFv4.1
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE
+chrY\t2781613\t.\tC\tT\t105.77\tPASS\tAC=2;AF=1.00;AN=2;DP=4;FS=0.000;MLEAF=1.00\tGT:AD:DP\t1/1:0,4:4
+chrY\t2781700\t.\tC\tT,G\t50.2\tLowQual\tAC=1;AF=0.5;AN=2;DP=10;FS=0.000;MLEAF=0.5\tGT:AD:DP\t1/2:1,5,4:10
+chrY\t2781800\t.\tA\tG,T\t50.2\tPASS\tAC=1;AF=0.5;AN=2;DP=10;FS=0.000;MLEAF=0.5\tGT:AD:DP\t1/2:0,9,1:10
+chrY\t2781900\t.\tA\t.\t50.2\tPASS\tAC=1;AF=0.5;AN=2;DP=8;FS=0.000;MLEAF=0.5\tGT:AD:DP\t0/0:8:8
+'''
+
+class TestVCF(unittest.TestCase):
+
+    # expected values are what getVCFvariants.sh produces for VCF
+    def test_parse_VCF_file(self):
+        calls = []
+        for batch in parse_VCF_file(io.BytesIO(VCF), batchsize=2):
+            self.assertTrue(len(batch) <= 2)
+            calls.extend(batch)
+        self.assertEqual(calls, [
+            (2781613, 'C', 'T', 'PASS', 2., 1., 4, 1.),
+            (2781700, 'C', 'T', 'FAIL', 1., .5, 10, .5),
+            (2781700, 'C', 'G', 'FAIL', 1., .5, 10, .4),
+            (2781800, 'A', 'G', 'PASS', 1., .5, 10, .9),
+            (2781900, 'A', '.', 'PASS', 1., .5, 8, 1.)])
+
+class TestCallinfo(unittest.TestCase):
+
+    def test_pack_calls(self):
+        tups = [t for b in parse_VCF_file(io.BytesIO(VCF)) for t in b]
+        packed = pack_calls(*zip(*[t[3:] for t in tups]))
+        self.assertEqual(packed.dtype.name, 'uint32')
+        self.assertEqual(packed.tolist(), [pack_call(t) for t in tups])
+        unpacked = unpack_calls(packed)
+        for t, c, u in zip(tups, packed.tolist(), unpacked):
+            passfail, q1, q2, nreads, passrate = unpack_call(c)
+            self.assertEqual(passfail, t[3] == 'PASS')
+            self.assertEqual(nreads, t[6])
+            self.assertAlmostEqual(passrate, t[7], delta=1./255)
+            self.assertEqual(u['passfail'], passfail)
+            self.assertEqual(u['nreads'], nreads)
+            self.assertAlmostEqual(float(u['q1']), q1, places=5)
+            self.assertAlmostEqual(float(u['passrate']), passrate, places=5)
+
+if __name__ == '__main__':
+    unittest.main()